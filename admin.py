@@ -8,27 +8,19 @@ from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandle
 import sqlite3
 from dotenv import load_dotenv
 import mysql.connector
+import asyncio
+import logging
+from database import init_db, fetch_one, fetch_all, execute, transaction
+import rollups
+from logs import configure_logging
 
 
 # Load environment variables
 load_dotenv()
-
-# Initialize the database
+logger = logging.getLogger(__name__)
 
 
 ADMIN_BOT_TOKEN = os.getenv("ADMIN_BOT_TOKEN")
-DATABASE_PASSWORD= os.getenv("DATABASE_PASSWORD")
-DATABASE_USER=os.getenv("DATABASE_USER")
-DATABASE_NAME=os.getenv("DATABASE_NAME")
-DATABASE_HOST=os.getenv("DATABASE_HOST")
-
-def connect_db():
-    return mysql.connector.connect(
-        host= DATABASE_HOST,
-        user=DATABASE_USER,
-        password=DATABASE_PASSWORD,
-        database=DATABASE_NAME
-    )
 
 def admin_only(func):
     
@@ -88,17 +80,9 @@ async def handle_admin_password(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("⚠️ *حدث خطأ! يرجى محاولة تسجيل الدخول مرة أخرى.*", parse_mode="Markdown")
         return
 
-    conn = None
-    cursor = None
-
     try:
-        # Connect to the database
-        conn = connect_db()
-        cursor = conn.cursor()
-
         # Fetch stored password from database
-        cursor.execute("SELECT password FROM admins WHERE username = %s", (username,))
-        result = cursor.fetchone()
+        result = await fetch_one("SELECT password FROM admins WHERE username = %s", (username,))
 
         if not result:
             await update.message.reply_text("❌ *اسم المستخدم غير صحيح!*", parse_mode="Markdown")
@@ -107,13 +91,12 @@ async def handle_admin_password(update: Update, context: ContextTypes.DEFAULT_TY
         stored_password = result[0]
 
         # Verify the entered password
-        if bcrypt.checkpw(password.encode(), stored_password.encode()):  # Ensure proper encoding
+        if await asyncio.to_thread(bcrypt.checkpw, password.encode(), stored_password.encode()):  # Ensure proper encoding
             context.user_data["is_admin"] = True
             context.user_data["admin_username"] = username
 
             # ✅ Store Telegram user ID for this admin
-            cursor.execute("UPDATE admins SET user_id = %s WHERE username = %s", (user_id, username))
-            conn.commit()
+            await execute("UPDATE admins SET user_id = %s WHERE username = %s", (user_id, username))
 
             await update.message.reply_text("✅ *تم تسجيل الدخول بنجاح!*", parse_mode="Markdown")
 
@@ -124,15 +107,9 @@ async def handle_admin_password(update: Update, context: ContextTypes.DEFAULT_TY
             await update.message.reply_text("❌ *كلمة المرور غير صحيحة!*", parse_mode="Markdown")
 
     except mysql.connector.Error as err:
-        print(f"❌ MySQL Error: {err}")
+        logger.error("❌ MySQL Error: %s", err)
         await update.message.reply_text("⚠️ *خطأ في قاعدة البيانات، يرجى المحاولة لاحقاً!*", parse_mode="Markdown")
 
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 async def handle_admin_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     action = query.data
@@ -268,12 +245,8 @@ async def show_approved_transactions(update: Update, context: ContextTypes.DEFAU
         return  # Prevents crashes if neither exists
 
     try:
-        # ✅ Connect to MySQL Database
-        conn = connect_db()
-        cursor = conn.cursor()
-
         # ✅ Query to fetch transactions that need to be processed
-        cursor.execute("""
+        transactions = await fetch_all("""
             SELECT t.transaction_id, t.user_id, a.player_id, a.username, t.payment_method, 
                    t.account_number, t.timestamp, t.fee, t.final_amount, t.status 
             FROM transactions t
@@ -282,17 +255,16 @@ async def show_approved_transactions(update: Update, context: ContextTypes.DEFAU
             ORDER BY t.timestamp DESC
             LIMIT 10  -- Fetch only 10 transactions (Modify as needed)
         """)
-        transactions = cursor.fetchall()
 
         if not transactions:
             await send_message("✅ *لا توجد معاملات بحاجة إلى التنفيذ حاليًا!*", parse_mode="Markdown")
             return
 
         # ✅ Process and Display Each Transaction
-        for transaction in transactions:
+        for row in transactions:
             (transaction_id, user_id, player_id, username, 
              payment_method, account_number, timestamp, fee, 
-             final_amount, status) = transaction
+             final_amount, status) = row
 
             message = (
                 f"🆔 *رقم العملية:* `{transaction_id}`\n"
@@ -313,15 +285,8 @@ async def show_approved_transactions(update: Update, context: ContextTypes.DEFAU
             await send_message(message, reply_markup=reply_markup, parse_mode="Markdown")
 
     except mysql.connector.Error as err:
-        print(f"❌ MySQL Error: {err}")
+        logger.error("❌ MySQL Error: %s", err)
         await send_message("❌ *حدث خطأ في قاعدة البيانات!*", parse_mode="Markdown")
-
-    finally:
-        # ✅ Ensure proper closing of database connection
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
    
 @admin_only
 async def show_monthly_financial_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -338,32 +303,13 @@ async def show_monthly_financial_summary(update: Update, context: ContextTypes.D
         return  # Prevent crashes if neither exists
 
     try:
-        # ✅ Connect to MySQL Database
-        conn = connect_db()
-        cursor = conn.cursor()
-
-        # ✅ Fetch financial summary for the current month (MySQL query)
-        cursor.execute("""
-            SELECT 
-                COALESCE(SUM(fee), 0) AS total_fees, 
-                COALESCE(SUM(final_amount), 0) AS total_payments
-                
-            FROM transactions
-            WHERE DATE_FORMAT(timestamp, '%Y-%m') = DATE_FORMAT(NOW(), '%Y-%m')
-        """)
-
-        result = cursor.fetchone()
-        
-        cursor.execute("""
-                       select sum(amount) from transactions where transaction_type = 'deposit' 
-                       and DATE_FORMAT(timestamp, '%Y-%m') = DATE_FORMAT(NOW(), '%Y-%m')
-                       """)
-        results = cursor.fetchone()
+        # ✅ Fetch financial summary for the current month (rollup lookup)
+        result = await rollups.monthly_summary()
         
         # Extract values safely
         total_fees = round(result[0]) if result else 0
         total_payments = round(result[1]) if result else 0
-        total_received = round(results[0]) if results else 0
+        total_received = round(result[2]) if result else 0
         profit = total_received - total_payments
 
         # ✅ Format response message
@@ -372,22 +318,16 @@ async def show_monthly_financial_summary(update: Update, context: ContextTypes.D
             f"💵 *إجمالي الرسوم:* `{total_fees}` SYP\n"
             f"💰 *إجمالي المدفوعات:* `{total_payments}` SYP\n"
             f"📥 *إجمالي المبالغ المستلمة:* `{total_received}` SYP\n"
-            f"💴 *إجمالي الربح:* `{profit}` SYP"
+            f"💴 *إجمالي الربح:* `{profit}` SYP\n\n"
+            f"{rollups.SUMMARY_SCOPE_NOTE}"
         )
 
         await send_message(message, parse_mode="Markdown")
 
     except mysql.connector.Error as err:
-        print(f"❌ MySQL Error: {err}")
+        logger.error("❌ MySQL Error: %s", err)
         await send_message("❌ *حدث خطأ في قاعدة البيانات!*", parse_mode="Markdown")
 
-    finally:
-        # ✅ Ensure proper closing of database connection
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
    
 
 
@@ -415,13 +355,8 @@ async def complete_transaction(update: Update, context: ContextTypes.DEFAULT_TYP
     transaction_id = query.data.split("_")[1]
 
     try:
-        # ✅ Connect to MySQL Database
-        conn = connect_db()
-        cursor = conn.cursor()
-
         # ✅ Check if transaction already marked as 'completed'
-        cursor.execute("SELECT status FROM transactions WHERE transaction_id = %s", (transaction_id,))
-        result = cursor.fetchone()
+        result = await fetch_one("SELECT status FROM transactions WHERE transaction_id = %s", (transaction_id,))
 
         if not result:
             await send_message("❌ *لم يتم العثور على المعاملة!*", parse_mode="Markdown")
@@ -431,9 +366,17 @@ async def complete_transaction(update: Update, context: ContextTypes.DEFAULT_TYP
             await query.answer("⚠️ هذه المعاملة مكتملة بالفعل!", show_alert=True)
             return
 
-        # ✅ Update transaction status to 'completed'
-        cursor.execute("UPDATE transactions SET status = 'completed' WHERE transaction_id = %s", (transaction_id,))
-        conn.commit()
+        def mark_completed(cursor):
+            # ✅ Update transaction status to 'completed' (only once) and count the payout
+            cursor.execute("UPDATE transactions SET status = 'completed' WHERE transaction_id = %s AND status != 'completed'",
+                           (transaction_id,))
+            if cursor.rowcount == 1:
+                rollups.add_completed(cursor, transaction_id)
+            return cursor.rowcount == 1
+
+        if not await transaction(mark_completed):
+            await query.answer("⚠️ هذه المعاملة مكتملة بالفعل!", show_alert=True)
+            return
 
         # ✅ Update the message with confirmation
         await query.edit_message_text(
@@ -442,16 +385,9 @@ async def complete_transaction(update: Update, context: ContextTypes.DEFAULT_TYP
         )
 
     except mysql.connector.Error as err:
-        print(f"❌ MySQL Error: {err}")
+        logger.error("❌ MySQL Error: %s", err)
         await send_message("❌ *حدث خطأ أثناء تحديث المعاملة!*", parse_mode="Markdown")
 
-    finally:
-        # ✅ Ensure proper database connection closure
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 # ✅ Show Financial Summary
 @admin_only
 async def show_financial_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -473,13 +409,8 @@ async def show_financial_summary(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     try:
-        # ✅ Connect to MySQL Database
-        conn = connect_db()
-        cursor = conn.cursor()
-
         # ✅ Fetch financial summary
-        cursor.execute("SELECT SUM(fee), SUM(final_amount), SUM(amount) FROM transactions where transaction_type ='deposit'")
-        result = cursor.fetchone()
+        result = await rollups.overall_summary()
 
         # ✅ Extract values safely
         total_fees = result[0] if result[0] else 0
@@ -499,22 +430,16 @@ async def show_financial_summary(update: Update, context: ContextTypes.DEFAULT_T
             f"💵 *إجمالي الرسوم:* `{total_fees}` SYP\n"
             f"💰 *إجمالي المدفوعات:* `{total_payments}` SYP\n"
             f"📥 *إجمالي المبالغ المستلمة:* `{total_received}` SYP\n"
-            f"💴 *إجمالي الربح:* `{profit}` SYP"
+            f"💴 *إجمالي الربح:* `{profit}` SYP\n\n"
+            f"{rollups.SUMMARY_SCOPE_NOTE}"
         )
 
         await send_message(message, parse_mode="Markdown")
 
     except mysql.connector.Error as err:
-        print(f"❌ MySQL Error: {err}")
+        logger.error("❌ MySQL Error: %s", err)
         await send_message("❌ *حدث خطأ أثناء جلب البيانات!*", parse_mode="Markdown")
 
-    finally:
-        # ✅ Ensure proper database connection closure
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
     
     
 async def show_daily_financial_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -531,32 +456,13 @@ async def show_daily_financial_summary(update: Update, context: ContextTypes.DEF
         return  # Prevent crashes if neither exists
 
     try:
-        # ✅ Connect to MySQL Database
-        conn = connect_db()
-        cursor = conn.cursor()
-
-        # ✅ Fetch daily financial summary
-        cursor.execute("""
-            SELECT 
-                SUM(fee) AS total_fees, 
-                SUM(final_amount) AS total_payments
-                
-            FROM transactions
-            WHERE DATE(timestamp) = CURDATE()
-        """)
-
-        result = cursor.fetchone()
-
-        cursor.execute("""
-                       select sum(amount) from transactions where transaction_type = 'deposit' 
-                       and DATE(timestamp) = CURDATE()
-                       """)
-        results = cursor.fetchone()
+        # ✅ Fetch daily financial summary (rollup lookup)
+        result = await rollups.daily_summary()
 
         # ✅ Extract values safely
         total_fees = result[0] if result[0] else 0
         total_payments = result[1] if result[1] else 0
-        total_received = round(results[0]) if results else 0
+        total_received = result[2] if result[2] else 0
         profit = total_received - total_payments
 
         # ✅ Format numbers properly
@@ -571,22 +477,16 @@ async def show_daily_financial_summary(update: Update, context: ContextTypes.DEF
             f"💵 *إجمالي الرسوم:* `{total_fees}` SYP\n"
             f"💰 *إجمالي المدفوعات:* `{total_payments}` SYP\n"
             f"📥 *إجمالي المبالغ المستلمة:* `{total_received}` SYP\n"
-            f"💴 *إجمالي الربح:* `{profit}` SYP"
+            f"💴 *إجمالي الربح:* `{profit}` SYP\n\n"
+            f"{rollups.SUMMARY_SCOPE_NOTE}"
         )
 
         await send_message(message, parse_mode="Markdown")
 
     except mysql.connector.Error as err:
-        print(f"❌ MySQL Error: {err}")
+        logger.error("❌ MySQL Error: %s", err)
         await send_message("❌ *حدث خطأ أثناء جلب البيانات!*", parse_mode="Markdown")
 
-    finally:
-        # ✅ Ensure proper database connection closure
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 
 async def confirm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Broadcasts a message (or photo with caption) from the admin bot to all users of bot.py."""
@@ -605,22 +505,14 @@ async def confirm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # ✅ Connect to MySQL
     try:
-        conn = connect_db()
-        cursor = conn.cursor()
-
         # ✅ Fetch user IDs
-        cursor.execute("SELECT user_id FROM accounts WHERE user_id IS NOT NULL")
-        users = cursor.fetchall()
+        users = await fetch_all("SELECT user_id FROM accounts WHERE user_id IS NOT NULL")
 
     except mysql.connector.Error as err:
-        print(f"❌ MySQL Error: {err}")
+        logger.error("❌ MySQL Error: %s", err)
         await query.message.reply_text("❌ *حدث خطأ أثناء جلب المستخدمين!*", parse_mode="Markdown")
         return
 
-    finally:
-        cursor.close()
-        conn.close()
-
     # ✅ Ensure there are users to send the message
     if not users:
         await query.message.reply_text("❌ *لا يوجد مستخدمون مسجلون لإرسال الرسالة لهم!*", parse_mode="Markdown")
@@ -649,7 +541,7 @@ async def confirm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
             sent_count += 1
 
         except Exception as e:
-            print(f"❌ Failed to send message to {user_id}: {e}")  # Debugging
+            logger.error("❌ Failed to send message to %s: %s", user_id, e)
             failed_count += 1
 
     # ✅ Report results
@@ -678,5 +570,7 @@ app.add_handler(CommandHandler("admin", admin_panel))
 app.add_handler(CallbackQueryHandler(handle_admin_buttons))
 
 if __name__ == "__main__":
-    print("🚀 Admin bot is running...")
+    configure_logging()
+    init_db()
+    logger.info("🚀 Admin bot is running...")
     app.run_polling()
\ No newline at end of file
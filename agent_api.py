@@ -0,0 +1,524 @@
+"""Async client for the WayXbet agent API.
+
+One httpx.AsyncClient per agent keeps a small pool of keep-alive connections
+and the session cookie. Every call has a timeout, so a slow agent API can only
+delay the handler waiting on it, never the event loop. Responses are parsed
+into the dataclasses below; failures raise AgentAPIError.
+
+Every endpoint has an overall deadline (ENDPOINT_DEADLINES). Reads are
+retried with jitter on transient failures; deposits, withdrawals and
+registrations are sent at most once, and a write that may have reached the
+API before failing raises AgentOutcomeUnknown instead of a plain error.
+Repeated transport failures open a circuit breaker, after which calls fail
+fast with AgentServiceBusy until the API recovers. All calls also pass a
+TrafficGovernor (rate and in-flight budgets, writes first; see resilience.py).
+
+Several agent accounts can be configured (AGENT_ACCOUNTS); each gets its own
+AgentClient, session, breaker and budgets. AgentPool routes a player's calls
+to the agent that owns it (accounts.parent_id, passed in by the caller) and
+spreads new registrations.
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+import httpx
+from dotenv import load_dotenv
+
+from resilience import CircuitBreaker, ServiceBusy, TrafficGovernor, CLOSED, READ, WRITE, retry_with_jitter
+
+
+load_dotenv()
+
+AGENT_USERNAME = os.getenv("AGENT_USERNAME")
+AGENT_PASSWORD = os.getenv("AGENT_PASSWORD")
+# Point at agent_simulator.py (e.g. http://127.0.0.1:8081) to run offline.
+AGENT_API_BASE_URL = os.getenv("AGENT_API_BASE_URL", "https://agents.wayxbet.com").rstrip("/")
+FIXED_PARENT_ID = "2301209"
+# Optional JSON list of {"username", "password", "parent_id"}; defaults to the single agent above.
+AGENT_ACCOUNTS = os.getenv("AGENT_ACCOUNTS")
+CURRENCY_CODE = "NSP"
+
+# Reads (balance, search) should be quick; money transfers get longer before we give up.
+AGENT_CONNECT_TIMEOUT = float(os.getenv("AGENT_CONNECT_TIMEOUT", "5"))
+AGENT_READ_TIMEOUT = float(os.getenv("AGENT_READ_TIMEOUT", "10"))
+AGENT_WRITE_TIMEOUT = float(os.getenv("AGENT_WRITE_TIMEOUT", "30"))
+AGENT_MAX_CONNECTIONS = int(os.getenv("AGENT_MAX_CONNECTIONS", "20"))
+AGENT_MAX_KEEPALIVE = int(os.getenv("AGENT_MAX_KEEPALIVE", "10"))
+# A cheap authenticated call this often keeps the session cookie alive (and re-logs in off the hot path).
+AGENT_KEEPALIVE_INTERVAL = float(os.getenv("AGENT_KEEPALIVE_INTERVAL", "240"))
+# Recent call latencies kept per agent for the p50/p95 metrics.
+AGENT_LATENCY_WINDOW = int(os.getenv("AGENT_LATENCY_WINDOW", "500"))
+
+LOGIN_PATH = "/global/api/User/signIn"
+REGISTER_PLAYER_PATH = "/global/api/Player/registerPlayer"
+PLAYER_STATISTICS_PATH = "/global/api/Statistics/getPlayersStatisticsPro"
+PLAYER_BALANCE_PATH = "/global/api/Player/getPlayerBalanceById"
+DEPOSIT_PATH = "/global/api/Player/depositToPlayer"
+WITHDRAW_PATH = "/global/api/Player/withdrawFromPlayer"
+
+# Overall budget per call, including login and (for reads) retries.
+ENDPOINT_DEADLINES = {
+    PLAYER_STATISTICS_PATH: float(os.getenv("AGENT_SEARCH_DEADLINE", "15")),
+    PLAYER_BALANCE_PATH: float(os.getenv("AGENT_BALANCE_DEADLINE", "12")),
+    REGISTER_PLAYER_PATH: float(os.getenv("AGENT_REGISTER_DEADLINE", "35")),
+    DEPOSIT_PATH: float(os.getenv("AGENT_TRANSFER_DEADLINE", "35")),
+    WITHDRAW_PATH: float(os.getenv("AGENT_TRANSFER_DEADLINE", "35")),
+}
+
+DEFAULT_HEADERS = {
+    "Content-Type": "application/json",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+    "Origin": AGENT_API_BASE_URL,
+    "Referer": AGENT_API_BASE_URL,
+}
+
+logger = logging.getLogger(__name__)
+
+
+class AgentAPIError(Exception):
+    """The agent API could not be reached or rejected the request."""
+
+
+class AgentAuthError(AgentAPIError):
+    """The agent session was rejected even after logging in again."""
+
+
+class AgentUnavailable(AgentAPIError):
+    """Transient failure (connection, timeout, 5xx); reads may be retried."""
+
+
+class AgentServiceBusy(AgentAPIError):
+    """The circuit breaker is open; the call was not attempted."""
+
+
+class AgentNotConfigured(AgentAPIError):
+    """No configured agent owns the player (accounts.parent_id); the call was not attempted."""
+
+
+class AgentOutcomeUnknown(AgentAPIError):
+    """A write may have been executed before the request failed; do not retry or refund blindly."""
+
+
+@dataclass(frozen=True)
+class PlayerDetails:
+    player_id: str
+    username: str
+
+
+@dataclass(frozen=True)
+class PlayerBalance:
+    balance: float
+    currency: str
+
+
+@dataclass(frozen=True)
+class PlayerStatistics:
+    """One row of getPlayersStatisticsPro."""
+
+    player_id: str
+    username: str
+    balance: Optional[float]
+    currency: str
+
+
+@dataclass(frozen=True)
+class TransferResult:
+    """Outcome of a deposit or withdrawal; `error` holds the API's message when it failed."""
+
+    success: bool
+    error: Optional[str] = None
+
+
+# Errors raised before the request left this process: safe to treat as "not executed".
+_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# Gateway errors where the upstream may still have processed the request.
+_AMBIGUOUS_STATUSES = (502, 504)
+
+# Notification texts seen when the agent cookie is missing or has expired.
+_AUTH_FAILURE_HINTS = ("unauthorized", "unauthenticated", "not authorized", "not authenticated",
+                       "session expired", "session has expired", "please log in")
+
+
+def _is_auth_failure(response, data):
+    """True when the API refused the call because the agent session is missing or expired."""
+    if response.status_code in (401, 403, 419, 440) or response.is_redirect:
+        return True
+    if not isinstance(data, dict) or data.get("status"):
+        return False
+    text = " ".join(str(n.get("content", "")) for n in data.get("notification") or [] if isinstance(n, dict))
+    return any(hint in text.lower() for hint in _AUTH_FAILURE_HINTS)
+
+
+def _notification_error(data):
+    notifications = data.get("notification", [])
+    if notifications and isinstance(notifications, list):
+        return notifications[0].get("content", "Unknown error")
+    return "Unknown error (No notifications provided)"
+
+
+class AgentClient:
+    """Logged-in agent API session on top of a pooled httpx.AsyncClient."""
+
+    def __init__(self, username=AGENT_USERNAME, password=AGENT_PASSWORD, base_url=AGENT_API_BASE_URL,
+                 parent_id=FIXED_PARENT_ID):
+        self.username = username
+        self.password = password
+        self.base_url = base_url
+        self.parent_id = str(parent_id)
+        self._http = None
+        self._logged_in = False
+        self._generation = 0  # Bumped on every successful login
+        self._logged_in_at = None
+        self._login_lock = None
+        self._keepalive_task = None
+        self._breaker = CircuitBreaker(f"agent_api[{username}]")
+        self._governor = TrafficGovernor(f"agent_api[{username}]")
+        self._latencies = deque(maxlen=AGENT_LATENCY_WINDOW)
+        self._stats = {"logins": 0, "login_failures": 0, "auth_failures": 0, "retries": 0, "keepalives": 0,
+                       "read_retries": 0, "deadline_exceeded": 0, "outcome_unknown": 0,
+                       "requests": 0, "errors": 0}
+
+    def _client(self):
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers=DEFAULT_HEADERS,
+                timeout=httpx.Timeout(AGENT_READ_TIMEOUT, connect=AGENT_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=AGENT_MAX_CONNECTIONS,
+                                    max_keepalive_connections=AGENT_MAX_KEEPALIVE),
+            )
+        return self._http
+
+    async def _login(self):
+        try:
+            response = await self._client().post(
+                LOGIN_PATH, json={"username": self.username, "password": self.password})
+            response.raise_for_status()
+            data = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            logger.error("❌ Agent %s login request failed: %s", self.username, e)
+            return False
+
+        if data.get("result", {}).get("message") == "dashboard":
+            logger.info("✅ Agent %s login successful!", self.username)
+            return True
+
+        logger.error("❌ Agent %s login failed: %s", self.username, data)
+        return False
+
+    async def login(self, stale_generation=None):
+        """Sign in once, however many callers ask at the same time. Returns True on success.
+
+        Callers that saw a session fail pass the generation they used; if
+        someone else has logged in since, that fresh session is reused.
+        """
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+        async with self._login_lock:
+            if self._logged_in and stale_generation != self._generation:
+                return True  # ✅ Another caller already logged in while we waited
+            self._logged_in = False
+            if not await self._login():
+                self._stats["login_failures"] += 1
+                return False
+            self._logged_in = True
+            self._generation += 1
+            self._logged_in_at = time.monotonic()
+            self._stats["logins"] += 1
+            return True
+
+    def _check_breaker(self, claim=True):
+        try:
+            if claim:
+                self._breaker.before_call()
+            else:
+                self._breaker.fail_fast()
+        except ServiceBusy as e:
+            raise AgentServiceBusy(str(e)) from None
+
+    def _record_failure(self):
+        self._stats["errors"] += 1
+        self._breaker.record_failure()
+
+    async def _send(self, path, payload, timeout, idempotent):
+        self._check_breaker()
+        self._stats["requests"] += 1
+        started = time.monotonic()
+        try:
+            response = await self._client().post(path, json=payload, timeout=timeout)
+        except _NOT_SENT_ERRORS as e:
+            self._record_failure()
+            raise AgentUnavailable(f"Request failed: {e}") from e
+        except httpx.HTTPError as e:
+            self._record_failure()
+            if idempotent:
+                raise AgentUnavailable(f"Request failed: {e}") from e
+            self._stats["outcome_unknown"] += 1
+            raise AgentOutcomeUnknown(f"No response to {path}: {e}") from e
+        except asyncio.CancelledError:
+            self._record_failure()  # Deadline hit mid-request; also frees a half-open trial
+            raise
+        finally:
+            self._latencies.append(time.monotonic() - started)
+
+        if response.status_code >= 500:
+            self._record_failure()
+            if not idempotent and response.status_code in _AMBIGUOUS_STATUSES:
+                self._stats["outcome_unknown"] += 1
+                raise AgentOutcomeUnknown(f"{path} returned {response.status_code}")
+            raise AgentUnavailable(f"{path} returned {response.status_code}")
+        self._breaker.record_success()
+
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+        if _is_auth_failure(response, data):
+            return None
+        try:
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            raise AgentAPIError(f"Request failed: {e}") from e
+        if data is None:
+            raise AgentAPIError("Invalid JSON from agent API")
+        return data
+
+    async def _post(self, path, payload, timeout=AGENT_READ_TIMEOUT, idempotent=True):
+        """POST within the endpoint's deadline; see _post_with_session.
+
+        Only idempotent calls are retried on transient failures.
+        """
+        deadline = ENDPOINT_DEADLINES.get(path, timeout)
+        try:
+            # ✅ Time spent queueing for a slot doesn't count against the deadline
+            async with self._governor.slot(READ if idempotent else WRITE):
+                return await asyncio.wait_for(self._post_with_session(path, payload, timeout, idempotent), deadline)
+        except ServiceBusy as e:
+            raise AgentServiceBusy(str(e)) from None
+        except asyncio.TimeoutError:
+            self._stats["deadline_exceeded"] += 1
+            if idempotent:
+                raise AgentUnavailable(f"{path} exceeded its {deadline}s deadline") from None
+            self._stats["outcome_unknown"] += 1
+            raise AgentOutcomeUnknown(f"{path} exceeded its {deadline}s deadline") from None
+
+    async def _post_with_session(self, path, payload, timeout, idempotent):
+        """POST with a live session; on an auth failure log in again (once) and retry once.
+
+        Retrying is safe even for transfers: a call rejected for auth was not executed.
+        """
+        self._check_breaker(claim=False)  # Don't even try to log in while the API is known to be down
+        if not self._logged_in and not await self.login():
+            raise AgentAPIError("Failed to log in as agent")
+
+        for attempt in range(2):
+            generation = self._generation
+            if idempotent:
+                data = await retry_with_jitter(lambda: self._send(path, payload, timeout, True), AgentUnavailable,
+                                               on_retry=self._count_read_retry)
+            else:
+                data = await self._send(path, payload, timeout, False)
+            if data is not None:
+                return data
+            self._stats["auth_failures"] += 1
+            if attempt == 0:
+                logger.warning("⚠️ Agent session rejected on %s, logging in again", path)
+                if not await self.login(stale_generation=generation):
+                    raise AgentAPIError("Failed to log in as agent")
+                self._stats["retries"] += 1
+
+        raise AgentAuthError("Agent session rejected after re-login")
+
+    def _count_read_retry(self):
+        self._stats["read_retries"] += 1
+
+    async def _keepalive(self):
+        while True:
+            await asyncio.sleep(AGENT_KEEPALIVE_INTERVAL)
+            try:
+                # Cheapest authenticated call; an expired session is renewed here, not on a user's request.
+                await self._post(PLAYER_STATISTICS_PATH, {"start": 0, "limit": 1, "filter": {}, "searchBy": {}})
+                self._stats["keepalives"] += 1
+            except AgentAPIError as e:
+                logger.warning("⚠️ Agent %s keepalive failed: %s", self.username, e)
+
+    def start_keepalive(self):
+        """Start the background keepalive on the running event loop."""
+        if self._keepalive_task is None:
+            self._keepalive_task = asyncio.get_running_loop().create_task(self._keepalive())
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["logged_in"] = self._logged_in
+        stats["session_age"] = time.monotonic() - self._logged_in_at if self._logged_in_at else None
+        stats["breaker"] = self._breaker.stats()
+        stats["governor"] = self._governor.stats()
+        latencies = sorted(self._latencies)
+        if latencies:
+            stats["latency_p50"] = latencies[len(latencies) // 2]
+            stats["latency_p95"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        stats["error_rate"] = stats["errors"] / stats["requests"] if stats["requests"] else 0.0
+        return stats
+
+    def healthy(self):
+        return self._breaker.state == CLOSED
+
+    async def find_player(self, username):
+        """Look a player up by login; returns PlayerDetails or None."""
+        data = await self._post(PLAYER_STATISTICS_PATH, {
+            "start": 0,
+            "limit": 10,
+            "filter": {},
+            "searchBy": {"players": username},
+        })
+        if not data.get("status"):
+            return None
+        records = (data.get("result") or {}).get("records") or []
+        if not records:
+            return None
+        return PlayerDetails(player_id=records[0]["playerId"], username=records[0]["username"])
+
+    async def list_players(self, start, limit, parent_id=None):
+        """One page of players under parent_id (default: this agent's), with balances; fewer than `limit` rows means last page."""
+        data = await self._post(PLAYER_STATISTICS_PATH, {
+            "start": start,
+            "limit": limit,
+            "filter": {"parentId": parent_id or self.parent_id},
+            "searchBy": {},
+        })
+        if not data.get("status"):
+            raise AgentAPIError(_notification_error(data))
+        records = (data.get("result") or {}).get("records") or []
+        return [
+            PlayerStatistics(
+                player_id=str(record["playerId"]),
+                username=record.get("username", ""),
+                balance=record.get("balance"),
+                currency=record.get("currencyCode", "Unknown"),
+            )
+            for record in records
+        ]
+
+    async def get_balance(self, player_id):
+        data = await self._post(PLAYER_BALANCE_PATH, {"playerId": str(player_id)})
+        if not data.get("status") or "result" not in data:
+            raise AgentAPIError("Invalid response structure or player not found")
+        balance_info = data["result"]
+        if isinstance(balance_info, list):
+            if not balance_info:
+                raise AgentAPIError("Invalid response structure or player not found")
+            balance_info = balance_info[0]
+        return PlayerBalance(balance=balance_info.get("balance", 0),
+                             currency=balance_info.get("currencyCode", "Unknown"))
+
+    async def register_player(self, username, password):
+        """Create a player under this agent; returns the raw `result` on success, else None."""
+        data = await self._post(REGISTER_PLAYER_PATH, {
+            "player": {
+                "email": f"{username}{random.randint(1000, 9999)}@fakeemail.com",
+                "password": password,
+                "parentId": self.parent_id,
+                "login": username,
+            }
+        }, timeout=AGENT_WRITE_TIMEOUT, idempotent=False)
+        if not data.get("status"):
+            return None
+        return data.get("result") or {}
+
+    async def _transfer(self, path, player_id, amount, comment):
+        data = await self._post(path, {
+            "amount": amount,
+            "comment": comment,
+            "playerId": str(player_id),
+            "currencyCode": CURRENCY_CODE,
+            "currency": CURRENCY_CODE,
+            "moneyStatus": 5,
+        }, timeout=AGENT_WRITE_TIMEOUT, idempotent=False)
+        if data.get("status") and isinstance(data.get("result"), dict):
+            return TransferResult(success=True)
+        return TransferResult(success=False, error=_notification_error(data))
+
+    async def deposit(self, player_id, amount, comment=None):
+        """`comment` is stored with the transfer on the website (used for reconciliation)."""
+        return await self._transfer(DEPOSIT_PATH, player_id, amount, comment)
+
+    async def withdraw(self, player_id, amount, comment=None):
+        return await self._transfer(WITHDRAW_PATH, player_id, -amount, comment)  # The API requires a negative amount
+
+    async def aclose(self):
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            self._keepalive_task = None
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+            self._logged_in = False
+
+
+class AgentPool:
+    """The configured agents; routes each player's calls to the agent that owns it (accounts.parent_id)."""
+
+    def __init__(self, agents):
+        self.agents = {agent.parent_id: agent for agent in agents}
+        self._order = list(agents)
+        self._next_registration = 0
+
+    @classmethod
+    def from_env(cls):
+        if not AGENT_ACCOUNTS:
+            return cls([AgentClient()])
+        return cls([AgentClient(a["username"], a["password"], parent_id=a["parent_id"])
+                    for a in json.loads(AGENT_ACCOUNTS)])
+
+    def for_player(self, player_id, parent_id):
+        """The agent with this parent ID; raises AgentNotConfigured instead of guessing another one."""
+        agent = self.agents.get(str(parent_id))
+        if agent is None:
+            raise AgentNotConfigured(f"No agent configured for parent ID {parent_id} (player {player_id})")
+        return agent
+
+    def for_registration(self):
+        """Next agent in turn whose circuit breaker is closed (or simply the next one if none is)."""
+        count = len(self._order)
+        for i in range(count):
+            agent = self._order[(self._next_registration + i) % count]
+            if agent.healthy():
+                self._next_registration = (self._next_registration + i + 1) % count
+                return agent
+        agent = self._order[self._next_registration]
+        self._next_registration = (self._next_registration + 1) % count
+        return agent
+
+    async def get_balance(self, player_id, parent_id):
+        return await self.for_player(player_id, parent_id).get_balance(player_id)
+
+    async def deposit(self, player_id, parent_id, amount, comment=None):
+        return await self.for_player(player_id, parent_id).deposit(player_id, amount, comment)
+
+    async def withdraw(self, player_id, parent_id, amount, comment=None):
+        return await self.for_player(player_id, parent_id).withdraw(player_id, amount, comment)
+
+    async def login(self):
+        """Sign every agent in; True if all succeeded."""
+        return all(await asyncio.gather(*(agent.login() for agent in self._order)))
+
+    def start_keepalive(self):
+        for agent in self._order:
+            agent.start_keepalive()
+
+    def stats(self):
+        return {agent.username: agent.stats() for agent in self._order}
+
+    async def aclose(self):
+        for agent in self._order:
+            await agent.aclose()
+
+
+agent_pool = AgentPool.from_env()
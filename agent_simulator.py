@@ -0,0 +1,372 @@
+"""Local stand-in for the WayXbet agent API, for load tests and benchmarks.
+
+Implements the endpoints agent_api.py calls, with the same JSON shapes:
+signIn, registerPlayer, getPlayersStatisticsPro, getPlayerBalanceById,
+depositToPlayer and withdrawFromPlayer. Sessions are cookies that expire
+after AGENT_SIM_SESSION_TTL seconds (401 afterwards, like the real API).
+
+Behaviour is configured through the environment:
+- AGENT_SIM_LATENCY: "<dist>:<ms>[:<spread>]" with dist one of fixed,
+  uniform (ms +/- spread), exponential (mean ms) or lognormal (median ms,
+  sigma spread); default "lognormal:80:0.5"
+- AGENT_SIM_ERROR_RATE: fraction of calls answered with HTTP 500
+- AGENT_SIM_HANG_RATE: fraction of calls that hang for AGENT_SIM_HANG_SECONDS
+- AGENT_SIM_REJECT_RATE: fraction of calls answered with status false
+- AGENT_SIM_PLAYERS: players created under FIXED_PARENT_ID at startup
+
+    python agent_simulator.py [--port 8081]
+    AGENT_API_BASE_URL=http://127.0.0.1:8081 python bot.py
+
+`python agent_simulator.py --benchmark [calls]` starts the simulator in
+process and drives every agent_api path through it, printing latencies.
+`python agent_simulator.py --governor-check [calls]` fires a mixed burst of
+reads and deposits and checks the TrafficGovernor budgets (exit 1 if not).
+GET /_sim/stats and POST /_sim/expire-sessions help while load testing.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import secrets
+import itertools
+from collections import Counter
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+import uvicorn
+
+from agent_api import (
+    AGENT_USERNAME, AGENT_PASSWORD, AGENT_ACCOUNTS, CURRENCY_CODE, FIXED_PARENT_ID,
+    LOGIN_PATH, REGISTER_PLAYER_PATH, PLAYER_STATISTICS_PATH, PLAYER_BALANCE_PATH,
+    DEPOSIT_PATH, WITHDRAW_PATH,
+)
+
+
+AGENT_SIM_LATENCY = os.getenv("AGENT_SIM_LATENCY", "lognormal:80:0.5")
+AGENT_SIM_ERROR_RATE = float(os.getenv("AGENT_SIM_ERROR_RATE", "0"))
+AGENT_SIM_HANG_RATE = float(os.getenv("AGENT_SIM_HANG_RATE", "0"))
+AGENT_SIM_HANG_SECONDS = float(os.getenv("AGENT_SIM_HANG_SECONDS", "60"))
+AGENT_SIM_REJECT_RATE = float(os.getenv("AGENT_SIM_REJECT_RATE", "0"))
+AGENT_SIM_SESSION_TTL = float(os.getenv("AGENT_SIM_SESSION_TTL", "1800"))
+AGENT_SIM_PLAYERS = int(os.getenv("AGENT_SIM_PLAYERS", "1000"))
+AGENT_SIM_PORT = int(os.getenv("AGENT_SIM_PORT", "8081"))
+
+SESSION_COOKIE = "agent_session"
+
+# Accepted sign-ins: the configured agent credentials (anything goes if none are set).
+AGENT_CREDENTIALS = {(a["username"], a["password"]) for a in json.loads(AGENT_ACCOUNTS or "[]")}
+if AGENT_USERNAME:
+    AGENT_CREDENTIALS.add((AGENT_USERNAME, AGENT_PASSWORD))
+
+logger = logging.getLogger(__name__)
+
+
+def parse_latency(spec):
+    """Turn an AGENT_SIM_LATENCY spec into a function returning a delay in seconds."""
+    dist, _, rest = spec.partition(":")
+    values = [float(v) for v in rest.split(":") if v] or [0.0]
+    ms, spread = values[0], values[1] if len(values) > 1 else 0.0
+    if dist == "fixed":
+        return lambda: ms / 1000
+    if dist == "uniform":
+        return lambda: max(0.0, random.uniform(ms - spread, ms + spread)) / 1000
+    if dist == "exponential":
+        return lambda: random.expovariate(1 / ms) / 1000 if ms else 0.0
+    if dist == "lognormal":
+        return lambda: random.lognormvariate(0, spread) * ms / 1000
+    raise ValueError(f"Unknown latency distribution: {dist}")
+
+
+def _ok(result):
+    return {"status": True, "result": result, "notification": []}
+
+
+def _rejected(message):
+    return {"status": False, "result": None, "notification": [{"content": message, "type": "error"}]}
+
+
+class AgentSimulator:
+    """In-memory players, balances and agent sessions."""
+
+    def __init__(self, players=AGENT_SIM_PLAYERS, parent_id=FIXED_PARENT_ID, latency=AGENT_SIM_LATENCY,
+                 error_rate=AGENT_SIM_ERROR_RATE, hang_rate=AGENT_SIM_HANG_RATE,
+                 reject_rate=AGENT_SIM_REJECT_RATE, session_ttl=AGENT_SIM_SESSION_TTL):
+        self.parent_id = str(parent_id)
+        self.delay = parse_latency(latency)
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.reject_rate = reject_rate
+        self.session_ttl = session_ttl
+        self.players = {}  # player_id -> dict(username, password, email, parentId, balance)
+        self.by_username = {}
+        self.sessions = {}  # token -> expires_at
+        self._ids = itertools.count(10_000_000)
+        self.calls = Counter()
+        for i in range(players):
+            self._create(f"simplayer{i}", "password", f"simplayer{i}@example.com", self.parent_id,
+                         balance=random.randint(0, 500) * 1000)
+
+    def _create(self, username, password, email, parent_id, balance=0):
+        player_id = str(next(self._ids))
+        self.players[player_id] = {"username": username, "password": password, "email": email,
+                                   "parentId": str(parent_id), "balance": balance}
+        self.by_username[username] = player_id
+        return player_id
+
+    def expire_sessions(self):
+        self.sessions.clear()
+
+    def _authorized(self, request):
+        expires_at = self.sessions.get(request.cookies.get(SESSION_COOKIE))
+        return expires_at is not None and expires_at > time.monotonic()
+
+    async def handle(self, path, request):
+        """Apply latency and injected faults, then dispatch; returns a JSONResponse."""
+        self.calls[path] += 1
+        await asyncio.sleep(self.delay())
+        roll = random.random()
+        if roll < self.hang_rate:
+            self.calls["hung"] += 1
+            await asyncio.sleep(AGENT_SIM_HANG_SECONDS)
+        elif roll < self.hang_rate + self.error_rate:
+            self.calls["errors"] += 1
+            return JSONResponse({"message": "Internal Server Error"}, status_code=500)
+
+        try:
+            payload = await request.json()
+        except ValueError:
+            return JSONResponse(_rejected("Invalid request body"), status_code=400)
+
+        if path == LOGIN_PATH:
+            return self._sign_in(payload)
+        if not self._authorized(request):
+            self.calls["unauthorized"] += 1
+            return JSONResponse(_rejected("Unauthorized"), status_code=401)
+        if roll >= 1 - self.reject_rate:
+            self.calls["rejected"] += 1
+            return JSONResponse(_rejected("Operation temporarily unavailable"))
+
+        handler = {
+            REGISTER_PLAYER_PATH: self._register_player,
+            PLAYER_STATISTICS_PATH: self._players_statistics,
+            PLAYER_BALANCE_PATH: self._player_balance,
+            DEPOSIT_PATH: self._deposit,
+            WITHDRAW_PATH: self._withdraw,
+        }[path]
+        return JSONResponse(handler(payload))
+
+    def _sign_in(self, payload):
+        if AGENT_CREDENTIALS and (payload.get("username"), payload.get("password")) not in AGENT_CREDENTIALS:
+            return JSONResponse(_rejected("Wrong username or password"))
+        token = secrets.token_hex(16)
+        self.sessions[token] = time.monotonic() + self.session_ttl
+        response = JSONResponse(_ok({"message": "dashboard"}))
+        response.set_cookie(SESSION_COOKIE, token, httponly=True)
+        return response
+
+    def _register_player(self, payload):
+        player = payload.get("player") or {}
+        username = player.get("login")
+        if not username or not player.get("password"):
+            return _rejected("Login and password are required")
+        if username in self.by_username:
+            return _rejected("Login already exists")
+        player_id = self._create(username, player["password"], player.get("email"),
+                                 player.get("parentId", self.parent_id))
+        return _ok({"playerId": player_id, "login": username})
+
+    def _players_statistics(self, payload):
+        parent_id = (payload.get("filter") or {}).get("parentId")
+        search = (payload.get("searchBy") or {}).get("players")
+        rows = [
+            (player_id, p) for player_id, p in self.players.items()
+            if (parent_id is None or p["parentId"] == str(parent_id)) and (not search or search in p["username"])
+        ]
+        start, limit = int(payload.get("start", 0)), int(payload.get("limit", 10))
+        records = [
+            {"playerId": player_id, "username": p["username"], "balance": p["balance"],
+             "currencyCode": CURRENCY_CODE, "parentId": p["parentId"]}
+            for player_id, p in rows[start:start + limit]
+        ]
+        return _ok({"records": records, "totalRecordsCount": len(rows)})
+
+    def _player_balance(self, payload):
+        player = self.players.get(str(payload.get("playerId")))
+        if player is None:
+            return _rejected("Player not found")
+        return _ok([{"balance": player["balance"], "currencyCode": CURRENCY_CODE}])
+
+    def _move(self, payload, sign):
+        player = self.players.get(str(payload.get("playerId")))
+        amount = payload.get("amount")
+        if player is None:
+            return _rejected("Player not found")
+        if not isinstance(amount, (int, float)) or amount * sign <= 0:
+            return _rejected("Invalid amount")
+        if player["balance"] + amount < 0:
+            return _rejected("Insufficient balance")
+        player["balance"] += amount
+        return _ok({"playerId": payload["playerId"], "amount": amount, "balance": player["balance"]})
+
+    def _deposit(self, payload):
+        return self._move(payload, 1)
+
+    def _withdraw(self, payload):
+        return self._move(payload, -1)  # The API expects a negative amount
+
+    def stats(self):
+        return {"players": len(self.players), "sessions": len(self.sessions), "calls": dict(self.calls)}
+
+
+def create_app(simulator=None):
+    """FastAPI app serving `simulator` (a default AgentSimulator if omitted)."""
+    simulator = simulator or AgentSimulator()
+    sim_app = FastAPI()
+
+    for path in (LOGIN_PATH, REGISTER_PLAYER_PATH, PLAYER_STATISTICS_PATH, PLAYER_BALANCE_PATH,
+                 DEPOSIT_PATH, WITHDRAW_PATH):
+        async def endpoint(request: Request, path=path):
+            return await simulator.handle(path, request)
+        sim_app.add_api_route(path, endpoint, methods=["POST"])
+
+    @sim_app.get("/_sim/stats")
+    async def sim_stats():
+        return simulator.stats()
+
+    @sim_app.post("/_sim/expire-sessions")
+    async def sim_expire_sessions():
+        simulator.expire_sessions()
+        return {"success": True}
+
+    sim_app.state.simulator = simulator
+    return sim_app
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+    return f"p50 {pick(0.5):7.1f}ms  p95 {pick(0.95):7.1f}ms  p99 {pick(0.99):7.1f}ms"
+
+
+async def _serve(simulator, port):
+    server = uvicorn.Server(uvicorn.Config(create_app(simulator), port=port, log_level="warning"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    return server, serving
+
+
+async def _benchmark(calls, port):
+    from agent_api import AgentClient, AgentAPIError
+
+    simulator = AgentSimulator()
+    server, serving = await _serve(simulator, port)
+    client = AgentClient(base_url=f"http://127.0.0.1:{port}")
+    player_ids = list(simulator.players)
+    paths = {
+        "find_player": lambda i: client.find_player(f"simplayer{i % len(player_ids)}"),
+        "list_players": lambda i: client.list_players((i * 100) % len(player_ids), 100),
+        "get_balance": lambda i: client.get_balance(player_ids[i % len(player_ids)]),
+        "register_player": lambda i: client.register_player(f"bench{i}_{secrets.token_hex(3)}", "password"),
+        "deposit": lambda i: client.deposit(player_ids[i % len(player_ids)], 1000),
+        "withdraw": lambda i: client.withdraw(player_ids[i % len(player_ids)], 1000),
+    }
+    try:
+        await client.login()
+        for name, call in paths.items():
+            latencies, failures = [], 0
+
+            async def timed(i):
+                nonlocal failures
+                started = time.perf_counter()
+                try:
+                    await call(i)
+                except AgentAPIError:
+                    failures += 1
+                latencies.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(timed(i) for i in range(calls)))
+            elapsed = time.perf_counter() - started
+            print(f"{name:16} {calls / elapsed:8.0f} calls/s  {_percentiles(latencies)}  failures {failures}")
+        print(f"client: {client.stats()}")
+        print(f"simulator: {simulator.stats()}")
+    finally:
+        await client.aclose()
+        server.should_exit = True
+        await serving
+
+
+async def _governor_check(calls, port):
+    from agent_api import AgentClient, AgentAPIError
+    from resilience import (AGENT_READ_RATE, AGENT_READ_BURST, AGENT_WRITE_RATE, AGENT_WRITE_BURST,
+                            AGENT_MAX_IN_FLIGHT)
+
+    simulator = AgentSimulator(latency="fixed:50")
+    server, serving = await _serve(simulator, port)
+    client = AgentClient(base_url=f"http://127.0.0.1:{port}")
+    player_ids = list(simulator.players)
+    peak = 0
+
+    async def watch_in_flight():
+        nonlocal peak
+        while True:
+            governor = client.stats()["governor"]
+            peak = max(peak, governor["shared_in_flight"])
+            await asyncio.sleep(0.005)
+
+    async def quietly(call):
+        try:
+            await call
+        except AgentAPIError:
+            pass
+
+    try:
+        await client.login()
+        watcher = asyncio.create_task(watch_in_flight())
+        writes = max(1, calls // 4)
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(quietly(client.get_balance(player_ids[i % len(player_ids)])) for i in range(calls)),
+            *(quietly(client.deposit(player_ids[i % len(player_ids)], 1000)) for i in range(writes)),
+        )
+        elapsed = time.perf_counter() - started
+        watcher.cancel()
+    finally:
+        await client.aclose()
+        server.should_exit = True
+        await serving
+
+    governor = client.stats()["governor"]
+    reads_sent, writes_sent = simulator.calls[PLAYER_BALANCE_PATH], simulator.calls[DEPOSIT_PATH]
+    checks = [
+        ("peak in flight <= max", peak <= AGENT_MAX_IN_FLIGHT, f"{peak} <= {AGENT_MAX_IN_FLIGHT}"),
+        ("read rate within budget", not AGENT_READ_RATE or reads_sent <= AGENT_READ_BURST + AGENT_READ_RATE * elapsed + 1,
+         f"{reads_sent} reads in {elapsed:.2f}s"),
+        ("write rate within budget", not AGENT_WRITE_RATE or writes_sent <= AGENT_WRITE_BURST + AGENT_WRITE_RATE * elapsed + 1,
+         f"{writes_sent} writes in {elapsed:.2f}s"),
+    ]
+    for name, ok, detail in checks:
+        print(f"{'PASS' if ok else 'FAIL'}  {name}: {detail}")
+    for lane in ("read", "write"):
+        print(f"{lane:5} queue wait avg {governor[lane]['wait_avg'] * 1000:.1f}ms "
+              f"max {governor[lane]['wait_max'] * 1000:.1f}ms rejected {governor[lane]['rejected']}")
+    return all(ok for _, ok, _ in checks)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    port = int(sys.argv[sys.argv.index("--port") + 1]) if "--port" in sys.argv else AGENT_SIM_PORT
+    if "--benchmark" in sys.argv:
+        args = sys.argv[sys.argv.index("--benchmark") + 1:]
+        calls = int(args[0]) if args and args[0].isdigit() else 200
+        asyncio.run(_benchmark(calls, port))
+    elif "--governor-check" in sys.argv:
+        args = sys.argv[sys.argv.index("--governor-check") + 1:]
+        calls = int(args[0]) if args and args[0].isdigit() else 200
+        sys.exit(0 if asyncio.run(_governor_check(calls, port)) else 1)
+    else:
+        uvicorn.run(create_app(), host="127.0.0.1", port=port)
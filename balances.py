@@ -0,0 +1,285 @@
+"""Per-player website balance cache with stale-while-revalidate.
+
+A balance younger than BALANCE_FRESH_TTL is served as is. Up to
+BALANCE_STALE_TTL it is still served, while one background refresh fetches
+a new value. Older (or missing) entries are fetched before returning.
+Concurrent lookups for the same player share one agent API call.
+wallets.website_balance is only written when the value actually changed.
+
+sync_all_balances() pages through every player of every configured agent with
+getPlayersStatisticsPro and writes changed balances in multi-row batches;
+start_balance_sync() runs it every BALANCE_SYNC_INTERVAL seconds. Every worker
+starts the schedule, but only the one holding the MySQL lock BALANCE_SYNC_LOCK
+syncs; the others check each interval whether it is free again (its holder
+died), so the agent API sees one sync per interval however many workers run.
+"""
+import os
+import time
+import asyncio
+import logging
+
+from agent_api import agent_pool, PlayerBalance
+from database import execute, run_db, connect_db
+
+
+BALANCE_FRESH_TTL = float(os.getenv("BALANCE_FRESH_TTL", "30"))
+BALANCE_STALE_TTL = float(os.getenv("BALANCE_STALE_TTL", "300"))
+
+# Bulk refresh: 0 disables the schedule.
+BALANCE_SYNC_INTERVAL = float(os.getenv("BALANCE_SYNC_INTERVAL", "300"))
+BALANCE_SYNC_PAGE_SIZE = int(os.getenv("BALANCE_SYNC_PAGE_SIZE", "100"))
+BALANCE_SYNC_CONCURRENCY = int(os.getenv("BALANCE_SYNC_CONCURRENCY", "4"))
+BALANCE_SYNC_LOCK = "telegram_bot_balance_sync"
+
+logger = logging.getLogger(__name__)
+
+
+class BalanceCache:
+    """Website balances keyed by player ID, refreshed through the agent API."""
+
+    def __init__(self, fresh_ttl=BALANCE_FRESH_TTL, stale_ttl=BALANCE_STALE_TTL):
+        self.fresh_ttl = fresh_ttl
+        self.stale_ttl = stale_ttl
+        self._entries = {}  # player_id -> (PlayerBalance, fetched_at)
+        self._stored = {}  # player_id -> balance last written to wallets.website_balance
+        self._refreshing = {}  # player_id -> asyncio.Task
+        self._generations = {}  # player_id -> bumped by invalidate(); older refreshes are discarded
+        self._stats = {"fresh_hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0,
+                       "refresh_failures": 0, "db_writes": 0, "discarded": 0}
+
+    async def get(self, user_id, player_id, parent_id):
+        """Return the player's PlayerBalance; raises AgentAPIError if it has to be fetched and can't be.
+
+        parent_id (accounts.parent_id) picks the agent a fetch goes to.
+        """
+        player_id = str(player_id)
+        entry = self._entries.get(player_id)
+        if entry is not None:
+            balance, fetched_at = entry
+            age = time.monotonic() - fetched_at
+            if age < self.fresh_ttl:
+                self._stats["fresh_hits"] += 1
+                return balance
+            if age < self.stale_ttl:
+                self._stats["stale_hits"] += 1
+                self._refresh_in_background(user_id, player_id, parent_id)
+                return balance
+
+        self._stats["misses"] += 1
+        return await self._refresh_task(user_id, player_id, parent_id)
+
+    def put(self, player_id, balance, stored=False):
+        """Record a balance obtained elsewhere (e.g. the bulk refresh job)."""
+        player_id = str(player_id)
+        self._entries[player_id] = (balance, time.monotonic())
+        if stored:
+            self._stored[player_id] = balance.balance
+
+    def invalidate(self, player_id):
+        """Forget the player's balance; call after any deposit or withdrawal attempt."""
+        player_id = str(player_id)
+        self._entries.pop(player_id, None)
+        self._stored.pop(player_id, None)  # wallets.website_balance may have been adjusted too
+        # ✅ A refresh already in flight may have read the old balance: it must not be cached or
+        # stored, and later lookups must not join it
+        self._generations[player_id] = self._generations.get(player_id, 0) + 1
+        self._refreshing.pop(player_id, None)
+
+    def _refresh_task(self, user_id, player_id, parent_id):
+        task = self._refreshing.get(player_id)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._refresh(user_id, player_id, parent_id))
+            self._refreshing[player_id] = task
+            task.add_done_callback(lambda done: self._forget_task(player_id, done))
+        return asyncio.shield(task)
+
+    def _forget_task(self, player_id, task):
+        if self._refreshing.get(player_id) is task:  # Not a newer refresh started after invalidate()
+            del self._refreshing[player_id]
+
+    def _refresh_in_background(self, user_id, player_id, parent_id):
+        task = self._refresh_task(user_id, player_id, parent_id)
+        task.add_done_callback(self._log_background_failure)
+
+    def _log_background_failure(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("⚠️ Background balance refresh failed: %s", task.exception())
+
+    async def _refresh(self, user_id, player_id, parent_id):
+        generation = self._generations.get(player_id, 0)
+        try:
+            balance = await agent_pool.get_balance(player_id, parent_id)
+        except Exception:
+            self._stats["refresh_failures"] += 1
+            raise
+        self._stats["refreshes"] += 1
+        if self._generations.get(player_id, 0) != generation:
+            self._stats["discarded"] += 1
+            return balance  # Read before a transfer settled: answer the caller, but don't keep it
+        self._entries[player_id] = (balance, time.monotonic())
+        await self._store(user_id, player_id, balance.balance, generation)
+        return balance
+
+    async def _store(self, user_id, player_id, value, generation):
+        if self._stored.get(player_id) == value:
+            return
+        try:
+            await execute("UPDATE wallets SET website_balance = %s WHERE user_id = %s AND website_balance <> %s",
+                          (value, user_id, value))
+        except Exception as err:
+            logger.error("❌ MySQL Error (Updating balance): %s", err)
+            return
+        if self._generations.get(player_id, 0) == generation:
+            self._stored[player_id] = value
+        self._stats["db_writes"] += 1
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["size"] = len(self._entries)
+        stats["refreshing"] = len(self._refreshing)
+        return stats
+
+
+balance_cache = BalanceCache()
+
+
+def _bulk_update_query(rows):
+    # Derived table of (player_id, balance); only rows whose balance changed are written.
+    values = " UNION ALL ".join(["SELECT %s AS player_id, %s AS balance"] * len(rows))
+    return f"""
+        UPDATE wallets w
+        JOIN accounts a ON a.user_id = w.user_id
+        JOIN ({values}) v ON v.player_id = a.player_id
+        SET w.website_balance = v.balance
+        WHERE w.website_balance <> v.balance
+    """
+
+
+async def _sync_page(agent, start, limit):
+    players = await agent.list_players(start, limit)
+    rows = [(p.player_id, p.balance) for p in players if p.balance is not None]
+    updated = 0
+    if rows:
+        updated = await execute(_bulk_update_query(rows), [value for row in rows for value in row])
+        for p in players:
+            if p.balance is not None:
+                balance_cache.put(p.player_id, PlayerBalance(balance=p.balance, currency=p.currency), stored=True)
+    return len(players), updated
+
+
+async def _sync_agent(agent, page_size, concurrency):
+    players = updated = pages = 0
+    next_start = 0
+    done = False
+
+    while not done:
+        # ✅ At most `concurrency` pages in flight; a short page means we reached the end
+        starts = [next_start + i * page_size for i in range(concurrency)]
+        next_start += concurrency * page_size
+        results = await asyncio.gather(*(_sync_page(agent, start, page_size) for start in starts))
+        for count, changed in results:
+            pages += 1
+            players += count
+            updated += changed
+            if count < page_size:
+                done = True
+    return players, updated, pages
+
+
+async def sync_all_balances(page_size=BALANCE_SYNC_PAGE_SIZE, concurrency=BALANCE_SYNC_CONCURRENCY):
+    """Refresh every website balance of every agent; returns a throughput report."""
+    started = time.monotonic()
+    players = updated = pages = 0
+    failed = []
+    for agent in agent_pool.agents.values():
+        try:
+            agent_players, agent_updated, agent_pages = await _sync_agent(agent, page_size, concurrency)
+        except Exception as e:
+            logger.error("❌ Website balance sync failed for agent %s: %s", agent.username, e)
+            failed.append(agent.parent_id)
+            continue
+        players += agent_players
+        updated += agent_updated
+        pages += agent_pages
+
+    duration = time.monotonic() - started
+    report = {
+        "parent_ids": list(agent_pool.agents),
+        "failed_parent_ids": failed,
+        "players": players,
+        "rows_updated": updated,
+        "pages": pages,
+        "duration": round(duration, 2),
+        "players_per_second": round(players / duration, 1) if duration else None,
+    }
+    logger.info("✅ Website balances synced: %s", report)
+    return report
+
+
+_lock_conn = None  # Connection holding BALANCE_SYNC_LOCK, while this worker is the one syncing
+
+
+def _query_value(conn, sql):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, (BALANCE_SYNC_LOCK,))
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+
+
+def _give_back(conn):
+    """Return a connection that took BALANCE_SYNC_LOCK to the pool, without the lock."""
+    try:
+        _query_value(conn, "SELECT RELEASE_LOCK(%s)")
+    except Exception as e:
+        logger.warning("⚠️ Could not release the balance sync lock, closing its connection: %s", e)
+        conn.discard()  # ✅ Ending the session is the only sure way to free the lock
+        return
+    conn.close()
+
+
+def _hold_sync_lock():
+    """True if this worker holds BALANCE_SYNC_LOCK, taking it when it is free."""
+    global _lock_conn
+    if _lock_conn is not None:
+        try:
+            # Also keeps the otherwise idle connection alive; a dropped connection loses the lock
+            if _query_value(_lock_conn, "SELECT IS_USED_LOCK(%s) = CONNECTION_ID()") == 1:
+                return True
+        except Exception as e:
+            logger.warning("⚠️ Lost the balance sync lock: %s", e)
+        _give_back(_lock_conn)  # A failed probe doesn't mean the session (and its lock) is gone
+        _lock_conn = None
+
+    conn = connect_db()
+    try:
+        if _query_value(conn, "SELECT GET_LOCK(%s, 0)") == 1:
+            _lock_conn = conn
+            logger.info("✅ This worker runs the website balance sync")
+            return True
+    except Exception:
+        _give_back(conn)  # GET_LOCK may have succeeded before the error
+        raise
+    conn.close()
+    return False
+
+
+async def _sync_forever():
+    while True:
+        try:
+            if await run_db(_hold_sync_lock):
+                await sync_all_balances()
+        except Exception as e:
+            logger.error("❌ Website balance sync failed: %s", e)
+        await asyncio.sleep(BALANCE_SYNC_INTERVAL)
+
+
+_sync_task = None
+
+
+def start_balance_sync():
+    """Run sync_all_balances() now and then every BALANCE_SYNC_INTERVAL seconds, if this worker holds the lock."""
+    global _sync_task
+    if BALANCE_SYNC_INTERVAL > 0 and _sync_task is None:
+        _sync_task = asyncio.get_running_loop().create_task(_sync_forever())
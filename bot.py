@@ -1,17 +1,35 @@
 import os
+import time
+import hashlib
 import requests
-import bcrypt
 import random
 import logging
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
-from database import init_db
+from database import init_db, fetch_one, fetch_all, execute, transaction
+import rollups
+import transfers
+import wallets
+from agent_api import agent_pool, AgentAPIError, AgentServiceBusy
+from balances import balance_cache, start_balance_sync
+from deposits import submit_deposit, DEPOSIT_NEW
+from game import get_game_settings, game_settings_cache, record_win
+from provisioning import provisioning_pool, ProvisioningJob, ERROR_BUSY, ERROR_DATABASE
+from update_queue import UpdateQueue, REJECTED
+from persistence import BotPersistence
+from ingress import WebhookIngress, handled_update_types, ACCEPTED, FORBIDDEN
+from repository import (
+    get_user_snapshot, load_user_snapshot, load_account_identity,
+    get_account_identity, warm_account_cache,
+)
 from dotenv import load_dotenv
+from logs import configure_logging, log_event
 from telegram.error import BadRequest
 import mysql.connector
 import re
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 import asyncio
 import uvicorn
 
@@ -19,99 +37,124 @@ import uvicorn
 
 # Load environment variables
 load_dotenv()
-
-# Initialize the database
-def connect_db():
-    return mysql.connector.connect(
-        host= DATABASE_HOST,
-        user=DATABASE_USER,
-        password=DATABASE_PASSWORD,
-        database=DATABASE_NAME
-    )
-
-# Temporary storage for user account creation process
-user_data = {}
+configure_logging()  # ✅ One queued, redacting log pipeline for the whole process
+logger = logging.getLogger(__name__)
 
 # Secure credentials & API endpoints
-AGENT_USERNAME = os.getenv("AGENT_USERNAME")
-AGENT_PASSWORD = os.getenv("AGENT_PASSWORD")
 PAYEER_ACCOUNT =os.getenv("PAYEER_ACCOUNT")
 SYREATEL_ACCOUNT=os.getenv("SYREATEL_ACCOUNT")
 BEMO_ACCOUNT=os.getenv("BEMO_ACCOUNT")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-DATABASE_PASSWORD= os.getenv("DATABASE_PASSWORD")
-DATABASE_USER=os.getenv("DATABASE_USER")
-DATABASE_NAME=os.getenv("DATABASE_NAME")
-DATABASE_HOST=os.getenv("DATABASE_HOST")
-LOGIN_URL = "https://agents.wayxbet.com/global/api/User/signIn"
-REGISTER_USER_URL = "https://agents.wayxbet.com/global/api/Player/registerPlayer"
-FIXED_PARENT_ID = "2301209"
-FETCH_PLAYER_DETAILS="https://agents.wayxbet.com/global/api/Statistics/getPlayersStatisticsPro"
-FETCH_PLAYER_BALANCE="https://agents.wayxbet.com/global/api/Player/getPlayerBalanceById"
-DEPOSIT_URL = "https://agents.wayxbet.com/global/api/Player/depositToPlayer"
-WITHDRAW_WEBSITE_URL = "https://agents.wayxbet.com/global/api/Player/withdrawFromPlayer"
 exchange_rate = 10000
 WEBHOOK_URL = "https://2bc4-169-150-196-153.ngrok-free.app/webhook" 
+# Sent by Telegram with every webhook request; derived from the bot token unless set
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
+WEBSITE_URL = os.getenv("WEBSITE_URL", "https://m.wayxbet.com/en/")
+
+# Fraction of webhook updates logged (LOG_SAMPLE_RATES can override it)
+UPDATE_LOG_SAMPLE_RATE = float(os.getenv("UPDATE_LOG_SAMPLE_RATE", "0.01"))
+
+# A stored "creating" account step older than this no longer has a job behind it
+ACCOUNT_CREATION_TIMEOUT = 300
+
+# Shown when an account creation stopped after the website player may have been created
+ACCOUNT_RESUME_MESSAGE = "⚠️ لم يكتمل إنشاء حسابك بعد. أرسل أي رسالة لإكماله (لا حاجة لإعادة إدخال كلمة المرور)."
+
+# Shown when the agent API circuit breaker is open
+SERVICE_BUSY_MESSAGE = "الخدمة مشغولة حاليًا، يرجى المحاولة بعد قليل."
 
 
 
 app = FastAPI()
-telegram_app = ApplicationBuilder().token(BOT_TOKEN).build()
+# ✅ user_data lives in a shared store, so any worker or host can serve a user's next update
+telegram_app = ApplicationBuilder().token(BOT_TOKEN).persistence(BotPersistence.from_env()).build()
+
 
-# ✅ Set up logging for debugging
-logging.basicConfig(level=logging.INFO) 
+async def process_update(update):
+    """Run the handlers for an update, then store the user_data they changed."""
+    await telegram_app.process_update(update)
+    await telegram_app.update_persistence()  # ✅ Written before the user's next update can reach another worker
+
+
+update_queue = UpdateQueue(process_update)  # ✅ Handlers run here, not in the webhook request
+webhook_ingress = WebhookIngress(WEBHOOK_SECRET)  # ✅ Update types are narrowed on startup, once handlers exist
 
 async def start_bot():
     """Initialize and start the Telegram bot."""
         
     await telegram_app.initialize()
     await telegram_app.start()
-    print("✅ Telegram bot initialized!")
+    logger.info("✅ Telegram bot initialized!")
+    update_queue.start()  # ✅ Start draining webhook updates once handlers can run
+    await transfers.outbox.start(notify_transfer)  # ✅ Resume queued website transfers once we can notify users
 
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
-    """Receive updates from Telegram and process them."""
+    """Receive updates from Telegram and queue them; answers before any handler runs."""
+    # ✅ Secret, size, JSON and update type are checked before any Update object is built
+    outcome, update_data = await webhook_ingress.read(request)
+    if outcome == FORBIDDEN:
+        return JSONResponse({"status": "forbidden"}, status_code=403)
+    if outcome != ACCEPTED:
+        # Still 200: Telegram would otherwise keep redelivering an update we can never use
+        return {"status": outcome}
+
     try:
-        update_data = await request.json()
-        if not update_data:
-            raise ValueError("Received empty JSON from Telegram")
-        
-        logging.info(f"📩 Received update: {update_data}")
         update = Update.de_json(update_data, telegram_app.bot)
-        await telegram_app.process_update(update)
-
-        return {"status": "ok"}
-
     except Exception as e:
-        logging.error(f"❌ Error processing webhook: {e}")
+        logger.error("❌ Error processing webhook: %s", e)
         return {"status": "error", "message": str(e)}
 
-async def set_webhook():
+    # ✅ Ids only, and sampled: no full payload dump on every update
+    log_event(logger, logging.INFO, "update_received", sample=UPDATE_LOG_SAMPLE_RATE, update_id=update.update_id,
+              kind="callback" if update.callback_query else "message" if update.message else "other")
+
+    # ✅ Queue full: shed low-priority updates, ask Telegram to redeliver the rest later
+    if update_queue.enqueue(update) == REJECTED:
+        return JSONResponse({"status": "busy"}, status_code=503)
+    return {"status": "ok"}
+
+async def set_webhook(allowed_updates=None):
     """Set Telegram webhook to FastAPI server."""
+    webhook = {"url": WEBHOOK_URL, "secret_token": WEBHOOK_SECRET}
+    if allowed_updates is not None:
+        webhook["allowed_updates"] = allowed_updates  # ✅ Telegram stops sending types nothing handles
     response = requests.post(
         f"https://api.telegram.org/bot{BOT_TOKEN}/setWebhook",
-        json={"url": WEBHOOK_URL},
+        json=webhook,
     )
     if response.status_code == 200:
-        print("✅ Webhook set successfully!")
+        logger.info("✅ Webhook set successfully!")
     else:
-        print(f"❌ Failed to set webhook: {response.text}")
+        logger.error("❌ Failed to set webhook: %s", response.text)
 
 
 @app.on_event("startup")
 async def on_startup():
     """Run on FastAPI startup: Set webhook & start the bot."""
-    await set_webhook()
+    init_db()  # ✅ Warm the shared MySQL connection pool
+    await warm_account_cache()  # ✅ Preload user_id -> player_id/username
+    await agent_pool.login()  # ✅ Sign every agent in before the first user needs it
+    agent_pool.start_keepalive()  # ✅ Keep the agent sessions warm so no user waits on a login
+    start_balance_sync()  # ✅ Periodic bulk refresh of website balances
+    provisioning_pool.start()  # ✅ Workers that create accounts off the chat handler
+    update_types = handled_update_types(telegram_app)
+    webhook_ingress.accept_only(update_types)  # ✅ Drop what no handler consumes before building an Update
+    await set_webhook(update_types)
     asyncio.create_task(start_bot())  # ✅ Initialize the bot
-    
 
-logging.basicConfig(level=logging.DEBUG)  # ✅ Enable debug logging
-from fastapi import FastAPI, Request
-import logging
-import re
-from datetime import datetime
-import sys
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    """Run on FastAPI shutdown: finish queued updates and sign-ups, store conversation state and close agent API connections."""
+    await update_queue.stop()
+    await provisioning_pool.stop()
+    await transfers.outbox.stop()
+    if telegram_app.running:
+        await telegram_app.stop()  # ✅ Final user_data write
+    await telegram_app.shutdown()
+    await agent_pool.aclose()
+    
 
 
 @app.post("/sms")
@@ -122,14 +165,13 @@ async def receive_sms(request: Request):
         raw_body = await request.body()
         headers = request.headers
 
-        print(f"📩 Raw request body: {raw_body.decode('utf-8')}")
-        print(f"📩 Headers: {headers}")  # ✅ Check Content-Type
+        logger.debug("📩 SMS request: %s bytes, Content-Type %s", len(raw_body), headers.get("content-type"))
         
         # ✅ Safely parse JSON
         try:
             sms_data = await request.json()
         except Exception as json_error:
-            sys.stderr.write(f"❌ JSON Parsing Error: {json_error}\n")
+            logger.error("❌ JSON Parsing Error: %s", json_error)
             return {"status": "error", "message": "Invalid JSON format"}
 
         # ✅ Extract SMS text and timestamp
@@ -142,7 +184,7 @@ async def receive_sms(request: Request):
         except ValueError:
             formatted_time = "Unknown"
 
-        print(f"📩 Received SMS: {raw_text} at {formatted_time}")
+        log_event(logger, logging.INFO, "sms_received", time=formatted_time, length=len(raw_text))
 
         # ✅ Process the cleaned SMS content
         result = await process_sms(raw_text, update=None, context=None)
@@ -152,199 +194,42 @@ async def receive_sms(request: Request):
         return {"status": "ok", "message": result}
 
     except Exception as e:
-        sys.stderr.write(f"❌ Error processing SMS: {e}\n")  # ✅ Force print errors
-        logging.error(f"❌ Error processing SMS: {e}")
+        logger.exception("❌ Error processing SMS: %s", e)
         return {"status": "error", "message": str(e)}
 
     
 
 
-
-# Global session for agent authentication
-agent_session = None
-
-def generate_fake_email(username):
-    """Generate a fake email based on the username."""
-    return f"{username}{random.randint(1000, 9999)}@fakeemail.com"
-
-def hash_password(password):
-    """Securely hash passwords."""
-    salt = bcrypt.gensalt()
-    return bcrypt.hashpw(password.encode(), salt).decode()
-
-
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
-
-def login_as_agent():
-    """Log in as an agent and store the session globally."""
-    global agent_session
-    session = requests.Session()
-     # Set proxy (Replace with actual Syrian proxy)
-   
-    
-    try:
-        response = session.post(LOGIN_URL, json={"username": AGENT_USERNAME, "password": AGENT_PASSWORD}, headers={
-            "Content-Type": "application/json",
-            "User-Agent": "Mozilla/5.0",
-            "Origin": "https://agents.wayxbet.com",
-            "Referer": "https://agents.wayxbet.com"
-        })
-
-        response.raise_for_status()  # Raise an error for bad responses
-
-        if response.status_code == 200 and response.json().get("result", {}).get("message") == "dashboard":
-            logging.info("✅ Agent login successful!")
-            agent_session = session
-            return True
-        else:
-            logging.error(f"❌ Agent login failed: {response.text}")
-
-    except requests.exceptions.RequestException as e:
-        logging.error(f"❌ Login request failed: {str(e)}")
-    
-    return False
-
-def fetch_player_details(username):
-    """Fetch player details using the search API after account creation."""
-    global agent_session
-    if not agent_session and not login_as_agent():
-        return None
-
-    payload = {
-        "start": 0,
-        "limit": 10,
-        "filter": {},
-        "searchBy": {"players": username}
-    }
-
-    response = agent_session.post(FETCH_PLAYER_DETAILS, json=payload)
-
-    if response.status_code == 200:
-        data = response.json()
-        if data.get("status") and data["result"]["records"]:
-            player_data = data["result"]["records"][0]  # Get the first matching record
-            return {
-                "playerId": player_data["playerId"],
-                "username": player_data["username"]
-            }
-
-    return None 
-
-def fetch_player_balance(user_id):
+async def fetch_player_balance(user_id, player_id=None, parent_id=None):
     """Fetch player balance using player_id and update the database."""
-    global agent_session
-
-    # Ensure the agent session is active
-    if not agent_session and not login_as_agent():
-        return {"error": "Failed to log in as agent"}
-
-    conn = None
-    cursor = None
 
-    try:
-        conn = connect_db()
-        cursor = conn.cursor()
-
-        # Fetch player_id from the database
-        cursor.execute("SELECT player_id FROM accounts WHERE user_id = %s", (user_id,))
-        result = cursor.fetchone()
+    # Callers that already hold a UserSnapshot pass player_id/parent_id and skip the lookup
+    if player_id is None or parent_id is None:
+        try:
+            account = await get_account_identity(user_id)
+        except mysql.connector.Error as err:
+            logger.error("❌ MySQL Error: %s", err)
+            return {"error": "Database error occurred"}
 
-        if not result:
+        if not account:
             return {"error": "User ID not found in accounts table"}
 
-        player_id = result[0]  # Extract player_id
-
-    except mysql.connector.Error as err:
-        print(f"❌ MySQL Error: {err}")
-        return {"error": "Database error occurred"}
-
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
-    # API Call to Fetch Player Balance
-    payload = {"playerId": str(player_id)}
+        player_id, parent_id = account.player_id, account.parent_id  # ✅ parent_id picks the agent to ask
 
+    # ✅ Cached balance (refreshed in the background when stale); the cache
+    # also writes wallets.website_balance, but only when the value changed
     try:
-        response = agent_session.post(FETCH_PLAYER_BALANCE, json=payload)
-        response.raise_for_status()  # Raise an exception for HTTP errors
-        data = response.json()  # Parse JSON response
-
-        if data.get("status") and "result" in data:
-            balance_info = data["result"]
-
-            # Handle if balance_info is a list instead of a dictionary
-            if isinstance(balance_info, list) and balance_info:
-                balance_info = balance_info[0]  # Extract first item if it's a list
-
-            website_balance = balance_info.get("balance", 0)
-            currency = balance_info.get("currencyCode", "Unknown")
-
-            # Update the database with the new website balance
-            try:
-                conn = connect_db()
-                cursor = conn.cursor()
-                cursor.execute("UPDATE wallets SET website_balance = %s WHERE user_id = %s", 
-                               (website_balance, user_id))
-                conn.commit()
-
-            except mysql.connector.Error as err:
-                print(f"❌ MySQL Error (Updating balance): {err}")
-
-            finally:
-                if cursor:
-                    cursor.close()
-                if conn:
-                    conn.close()
-
-            return {
-                "balance": website_balance,
-                "currency": currency
-            }
-
-        else:
-            return {"error": "Invalid response structure or player not found"}
-
-    except requests.exceptions.RequestException as e:
+        balance = await balance_cache.get(user_id, player_id, parent_id)
+    except AgentServiceBusy:
+        return {"error": SERVICE_BUSY_MESSAGE}
+    except AgentAPIError as e:
         return {"error": str(e)}
 
-
-
-#------------------------------------create user on the website funcion ------------------------
-
-
-def create_user_on_website(username, password):
-    """Create a user account on the website and return account details."""
-    global agent_session
-    if not agent_session and not login_as_agent():
-        return None
-    
-    payload = {
-        "player": {
-            "email": generate_fake_email(username),
-            "password": password,
-            "parentId": FIXED_PARENT_ID,
-            "login": username
-        }
+    return {
+        "balance": balance.balance,
+        "currency": balance.currency
     }
-    response = agent_session.post(REGISTER_USER_URL, json=payload)
-    
-    if response.status_code == 200:
-        data = response.json()
-        if data.get("status"):  # Check if account creation was successful
-            player_details = fetch_player_details(username)  # Fetch player details
-            
-            if player_details:
-                return {
-                    "username": player_details["username"],
-                    "password": password,
-                    "playerId": player_details["playerId"]
-                    
-                }
 
-    return None  # Return None if creation or fetching fails
 
 
 #--------------------------start command ------------------------------------------
@@ -362,24 +247,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_exists = None  # Initialize variable
     welcome_sticker_id = "CAACAgIAAxkBAeLeCmfdgKwm3XwP2yxX-l0gOsdn2xSbAAIxNAAC6BugStKvp8RmJqK8NgQ"  # Replace with your sticker ID
     try:
-        conn = connect_db()
-        cursor = conn.cursor()
-        
         # Check if the user exists in the database
-        cursor.execute("SELECT user_id FROM accounts WHERE user_id = %s", (user_id,))
-        user_exists = cursor.fetchone()
+        user_exists = await get_account_identity(user_id)
 
     except mysql.connector.Error as err:
-        print(f"❌ MySQL Error: {err}")
+        logger.error("❌ MySQL Error: %s", err)
         await update.message.reply_text("⚠️ حدث خطأ أثناء الاتصال بقاعدة البيانات. يرجى المحاولة لاحقًا!")
         return  # Stop execution in case of an error
 
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
     terms_text = ""
     if not user_exists:
         # If the user is new, send the Terms and Conditions first
@@ -463,50 +338,27 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         context.user_data["state"] = "expecting_Create_accout_input"
 
         try:
-            conn = connect_db()
-            cursor = conn.cursor()
-            cursor.execute("SELECT username, player_id FROM accounts WHERE user_id = %s", (user_id,))
-            account = cursor.fetchone()  # Fetch before closing cursor
-            
-            
-             # Fetch bot balance from wallets
-            cursor.execute("SELECT bot_balance FROM wallets WHERE user_id = %s", (user_id,))
-            bot_result = cursor.fetchone()
+            # ✅ Account and wallet in one query
+            account = await get_user_snapshot(user_id)
 
-            bot_balance = bot_result[0] if bot_result else 0  # Handle None case safely
-            
-            
         except mysql.connector.Error as err:
-            print(f"❌ MySQL Error: {err}")
+            logger.error("❌ MySQL Error: %s", err)
             await query.edit_message_text("❌ حدث خطأ في قاعدة البيانات. حاول مرة أخرى لاحقًا.")
             return
-        
-        finally:
-            cursor.close()
-            conn.close()
-            
-           
-         # Fetch website balance from API
-         
-
-         
-         
-            print("done")
-        
 
         if account:
-            username, player_id = account
+            username, player_id, bot_balance = account.username, account.player_id, account.bot_balance
             keyboard = [
-                [InlineKeyboardButton("🌐 WayXbet الانتقال الى موقع ", url="https://m.wayxbet.com/en/")],
+                [InlineKeyboardButton("🌐 WayXbet الانتقال الى موقع ", url=WEBSITE_URL)],
                 [InlineKeyboardButton("💰 شحن الحساب", callback_data='charge_website_account'), 
                  InlineKeyboardButton("💸 سحب رصيد الحساب", callback_data='withdraw_website')],
                 [InlineKeyboardButton("🔙 رجوع", callback_data='back')]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            balance_details = fetch_player_balance(user_id)
+            balance_details = await fetch_player_balance(user_id, player_id, account.parent_id)
             if "error" in balance_details:
                 balance_text = f"⚠️ Error: {balance_details['error']}"
-                
+
             else:
              balance_text = (
                 f"💰 الرصيد:\n"
@@ -520,8 +372,12 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                       f"{balance_text}")
             await query.edit_message_text(message, reply_markup=reply_markup)
             
+        elif (context.user_data.get("create_account") or {}).get("resume"):
+            # ✅ A website player may already exist for this user: finish it, don't register a new one
+            context.user_data["create_account"]["step"] = "resume"
+            await query.edit_message_text(ACCOUNT_RESUME_MESSAGE)
         else:
-            user_data[user_id] = {"step": "username"}  # Store state properly
+            context.user_data["create_account"] = {"step": "username"}  # Store state properly
             await query.edit_message_text("أدخل اسم المستخدم الخاص بك  ")
 
 #--------------------------------💳 محفظة البوت وشحنها Button commands--------------------------------------------
@@ -529,31 +385,18 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         context.user_data["state"] = "expecting_no_input"
 
         try:
-            conn = connect_db()
-            cursor = conn.cursor()
-            
-            # Fetch user player_id
-            cursor.execute("SELECT player_id FROM accounts WHERE user_id = %s", (user_id,))
-            player_data = cursor.fetchone()
-
-            # Fetch bot balance
-            cursor.execute("SELECT bot_balance FROM wallets WHERE user_id = %s", (user_id,))
-            bot_result = cursor.fetchone()
-
-            bot_balance = bot_result[0] if bot_result else 0  # Handle None case
+            # Fetch user player_id and bot balance together
+            player_data = await get_user_snapshot(user_id)
 
         except mysql.connector.Error as err:
-            print(f"❌ MySQL Error: {err}")
+            logger.error("❌ MySQL Error: %s", err)
             await query.edit_message_text("❌ حدث خطأ أثناء استرداد البيانات.")
             return
 
-        finally:
-            cursor.close()
-            conn.close()
-
         if player_data:
+            bot_balance = player_data.bot_balance
             # Fetch website balance from external API
-            balance_details = fetch_player_balance(user_id)
+            balance_details = await fetch_player_balance(user_id, player_data.player_id, player_data.parent_id)
 
             if "error" in balance_details:
                 balance_text = f"⚠️ Error: {balance_details['error']}"
@@ -588,18 +431,8 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
     elif query.data == 'slot_machine':
-        # ✅ Connect to the database
-        conn = connect_db()
-        cursor = conn.cursor()
-        cursor.execute("select player_id from accounts where user_id = %s" ,(user_id,))
-        player_id = cursor.fetchone()
-        if player_id:
-        
-            await start_slot_machine(update, context)
-        else:
-            await query.edit_message_text("❌ لم يتم العثور على حساب. يرجى إنشاء حساب أولا.")
-            return
-        conn.close()
+        # ✅ start_slot_machine checks for the account in the same query as the wallet
+        await start_slot_machine(update, context)
 
     
     
@@ -651,7 +484,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             reply_markup=reply_markup,
             parse_mode="Markdown"
         )
-     print("User is now expected to send transaction ID")  # Debugging
+     logger.debug("User is now expected to send transaction ID")
 
 
 
@@ -682,7 +515,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             reply_markup=reply_markup,
             parse_mode="Markdown"
         )
-        context.user_data["history"].append((photo, keyboard))
+        context.user_data["history"].append((payment_text, keyboard))  # ✅ The text, not the closed file: history is stored
         
         
         
@@ -730,31 +563,18 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         context.user_data["state"] = "expecting_no_input"
 
         try:
-         conn = connect_db()
-         cursor = conn.cursor()
-
-         # Fetch player_id from accounts
-         cursor.execute("SELECT player_id FROM accounts WHERE user_id = %s", (user_id,))
-         player_data = cursor.fetchone()
-
-         # Fetch bot balance from wallets
-         cursor.execute("SELECT bot_balance FROM wallets WHERE user_id = %s", (user_id,))
-         bot_result = cursor.fetchone()
-
-         bot_balance = bot_result[0] if bot_result else 0  # Handle None case safely
+         # Fetch player_id and bot balance in one query
+         player_data = await get_user_snapshot(user_id)
 
         except mysql.connector.Error as err:
-         print(f"❌ MySQL Error: {err}")
+         logger.error("❌ MySQL Error: %s", err)
          await query.edit_message_text("❌ حدث خطأ أثناء جلب البيانات من قاعدة البيانات.")
          return  # Exit to prevent further execution
 
-        finally:
-         cursor.close()
-         conn.close()
-
         if player_data:
+         bot_balance = player_data.bot_balance
          # Fetch website balance from API
-         balance_details = fetch_player_balance(user_id)
+         balance_details = await fetch_player_balance(user_id, player_data.player_id, player_data.parent_id)
 
          if "error" in balance_details:
             balance_text = f"⚠️ Error: {balance_details['error']}"
@@ -764,7 +584,6 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 f"💵 رصيدك على الموقع: `{balance_details.get('balance', 0)}` {balance_details.get('currency', 'SYP')}\n"
                 f"🤖 رصيد البوت: `{bot_balance}` {balance_details.get('currency', 'SYP')}\n"
             )
-            print("done")
         else:
          balance_text = "❌ لم يتم العثور على حساب. يرجى إنشاء حساب أولا."
 
@@ -1111,6 +930,12 @@ async def handle_user_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
 
 #--------------------------------account createion handler --------------------------------------------
+
+
+async def save_user_data(context, user_id):
+    """Store user_data changed outside an update (e.g. by a background worker)."""
+    context.application.mark_data_for_update_persistence(user_ids=user_id)
+    await context.application.update_persistence()
   
 
 async def handel_create_account(update: Update, context: ContextTypes.DEFAULT_TYPE, user_input: str):
@@ -1128,86 +953,124 @@ async def handel_create_account(update: Update, context: ContextTypes.DEFAULT_TY
 
     text = update.message.text.strip()
 
+    creating = context.user_data.get("create_account") or {}
+
     # ✅ Step 1: Check if the user is at the username input stage
-    if user_id in user_data and user_data[user_id]["step"] == "username":
+    if creating.get("step") == "username":
         try:
-            conn = connect_db()
-            cursor = conn.cursor()
-
             # ✅ Check if username exists in MySQL
-            cursor.execute("SELECT username FROM accounts WHERE username = %s", (text,))
-            existing_user = cursor.fetchone()
+            existing_user = await fetch_one("SELECT username FROM accounts WHERE username = %s", (text,))
 
             if existing_user:
                 await send_message("❌ اسم المستخدم موجود بالفعل. اختر اسمًا مختلفًا.")
             else:
-                user_data[user_id] = {"step": "password", "username": text}
+                context.user_data["create_account"] = {"step": "password", "username": text}
                 await send_message("🔑 أدخل كلمة المرور الخاصة بك.")
-            
+
         except mysql.connector.Error as err:
-            print(f"❌ MySQL Error: {err}")
+            logger.error("❌ MySQL Error: %s", err)
             await send_message("⚠️ خطأ في الاتصال بقاعدة البيانات.")
-        
-        finally:
-            cursor.close()
-            conn.close()
 
-    # ✅ Step 2: Handle password input and insert into MySQL
-    elif user_id in user_data and user_data[user_id]["step"] == "password":
-        username = user_data[user_id]["username"]
-        password = text
-        hashed_password = hash_password(password)  # Hash password for security
+    # ✅ Step 2: Handle password input: create the account in the background
+    elif creating.get("step") == "password":
+        username = creating["username"]
+        status_message = await send_message("⏳ جارٍ إنشاء حسابك... يرجى الانتظار.")
+        await submit_account_job(context, user_id, username, text, None, status_message)
+
+    # ✅ A previous attempt may have left a website player behind: save that one
+    elif creating.get("step") == "resume":
+        status_message = await send_message("⏳ جارٍ إنشاء حسابك... يرجى الانتظار.")
+        await submit_account_job(context, user_id, creating["username"], None, creating["resume"], status_message)
+
+    # ✅ Step 3: A job is already running for this user
+    elif creating.get("step") == "creating":
+        if time.time() - creating.get("since", 0) > ACCOUNT_CREATION_TIMEOUT:
+            # The stored step outlived its job (e.g. a restart): let the user try again
+            if creating.get("resume"):
+                context.user_data["create_account"] = {**creating, "step": "resume"}
+                await send_message(ACCOUNT_RESUME_MESSAGE)
+            else:
+                context.user_data["create_account"] = {"step": "password", "username": creating["username"]}
+                await send_message("🔑 أدخل كلمة المرور الخاصة بك.")
+        else:
+            await send_message("⏳ جارٍ إنشاء حسابك... يرجى الانتظار.")
+
+
+async def submit_account_job(context, user_id, username, password, resume, status_message):
+    """Queue a provisioning job; password is None when resuming a previous attempt."""
+
+    async def notify(result):
+        # ✅ Runs on a provisioning worker once the website and MySQL are done
+        if result.error is None:
+            context.user_data["state"] = None
+            context.user_data.pop("create_account", None)  # Remove user from temporary state tracking
+            await save_user_data(context, user_id)
+            shown_password = password if password is not None else "كلمة المرور التي أدخلتها سابقًا"
+            await status_message.edit_text(
+                f"✅ تم إنشاء الحساب بنجاح!\n"
+                f"👤 Username: `{username}`\n"
+                f"🔑 Password: `{shown_password}`\n"
+                f"🆔 Player ID: `{result.player_id}`\n\n"
+                "⚠️ يُرجى تغيير كلمة مرور حسابك من خلال الموقع لحمايته!"
+            )
+            return
 
-        try:
-            conn = connect_db()
-            cursor = conn.cursor()
+        if result.resume:
+            # ✅ The website player may exist: the next attempt saves it instead of registering again
+            context.user_data["create_account"] = {"step": "resume", "username": username, "resume": result.resume}
+            await save_user_data(context, user_id)
+            await status_message.edit_text(SERVICE_BUSY_MESSAGE if result.error == ERROR_BUSY
+                                           else ACCOUNT_RESUME_MESSAGE)
+            return
 
-            # ✅ Create account on external website (if needed)
-            account_details = create_user_on_website(username, password)
+        context.user_data["create_account"] = {"step": "password", "username": username}  # ✅ Let the user try again
+        await save_user_data(context, user_id)
+        if result.error == ERROR_BUSY:
+            await status_message.edit_text(SERVICE_BUSY_MESSAGE)
+        elif result.error == ERROR_DATABASE:
+            await status_message.edit_text("⚠️ حدث خطأ أثناء إنشاء الحساب. الرجاء المحاولة لاحقًا.")
+        else:
+            await status_message.edit_text("❌ فشل في إنشاء الحساب.")
 
-            if account_details:
-                player_id = account_details.get("playerId")
+    # ✅ Ignore repeated input meanwhile
+    previous = context.user_data.get("create_account")
+    context.user_data["create_account"] = {"step": "creating", "username": username, "since": time.time(),
+                                           "resume": resume}
+    if not provisioning_pool.submit(ProvisioningJob(user_id, username, password, notify, resume)):
+        context.user_data["create_account"] = previous
+        await status_message.edit_text(SERVICE_BUSY_MESSAGE)
 
-                # ✅ Insert user data into MySQL
-                cursor.execute(
-                    "INSERT INTO accounts (player_id, username, password, user_id) VALUES (%s, %s, %s, %s)", 
-                    (player_id, username, hashed_password, user_id)
-                )
 
-                # ✅ Insert default wallet balance for the new user
-                cursor.execute(
-                    "INSERT INTO wallets (user_id) VALUES (%s)", 
-                    (user_id,)
-                )
+        
+#================================payment functions===============================================
 
-                conn.commit()  # ✅ Commit the transaction
 
-                await send_message(
-                    f"✅ تم إنشاء الحساب بنجاح!\n"
-                    f"👤 Username: `{username}`\n"
-                    f"🔑 Password: `{password}`\n"
-                    f"🆔 Player ID: `{player_id}`\n\n"
-                    "⚠️ يُرجى تغيير كلمة مرور حسابك من خلال الموقع لحمايته!"
-                )
+async def intake_deposit_transaction_id(update: Update, send_message, user_id, transaction_id, payment_method):
+    """Register a deposit transaction ID; replies and returns False if it can't be used."""
+    processing_sticker_id = "CAACAgIAAxkBAeLe02fdg4hbX96ODk5SRx08-jtV08apAALDPQACzBMpSoUPzZoaigNGNgQ"
+    erorr_sticker_id ="CAACAgIAAxkBAeLfqGfdhv5zCSIhUgJGjM6LbmkaIB9wAAJxOwACtUNZSjpcwC49bZ4dNgQ"
 
-                # ✅ Reset user state after successful registration
-                context.user_data["state"] = None
-                user_data.pop(user_id, None)  # Remove user from temporary state tracking
-            
-            else:
-                await send_message("❌ فشل في إنشاء الحساب.")
+    # ✅ Claim the ID and look up the player in one statement (race-free on the unique key)
+    outcome = await submit_deposit(transaction_id, user_id, payment_method)
 
-        except mysql.connector.Error as err:
-            print(f"❌ MySQL Error: {err}")
-            await send_message("⚠️ حدث خطأ أثناء إنشاء الحساب. الرجاء المحاولة لاحقًا.")
+    if outcome == DEPOSIT_NEW:
+        return True
 
-        finally:
-            cursor.close()
-            conn.close()
+    if outcome is None:
+        await update.message.reply_sticker(sticker=erorr_sticker_id)
+        await send_message("❌ لم يتم العثور على حسابك. يرجى إنشاء حساب أولاً.", parse_mode="Markdown")
+    elif outcome == "pending":
+        await update.message.reply_sticker(sticker=processing_sticker_id)
+        await send_message("⚠️ هذه العملية قيد المعالجة..\n\n"
+                           "⏳ يرجى الانتظار حتى اكتمالها 🫡", 
+                           parse_mode="Markdown")
+    else:
+        await update.message.reply_sticker(sticker=erorr_sticker_id)
+        await send_message("❌ رقم العملية الذي أدخلته موجود بالفعل!\n\n"
+                           "🔹 يرجى التحقق من رقم العملية والمحاولة مجددًا.", 
+                           parse_mode="Markdown")
+    return False
 
-        
-        
-#================================payment functions===============================================
 
 
 
@@ -1216,7 +1079,7 @@ async def handel_create_account(update: Update, context: ContextTypes.DEFAULT_TY
 async def handle_charge_syriatel_transaction_id(update: Update, context: ContextTypes.DEFAULT_TYPE, user_input: str ):
    
     """Handles the Syriatel Cash transaction ID input from the user."""
-    print("✅ Bot is expecting a syreatel cash transaction ID, processing...")  # Debugging
+    logger.debug("✅ Bot is expecting a syreatel cash transaction ID, processing...")
     
     # ✅ Detect whether the update is a message or callback query
     if update.message:
@@ -1250,50 +1113,11 @@ async def handle_charge_syriatel_transaction_id(update: Update, context: Context
         )
         return
 
-     # ✅ Connect to the database
-    conn = connect_db()
-    cursor = conn.cursor()
-
     try:
-        
-        # ✅ Check if the transaction ID already exists
-        cursor.execute("SELECT status FROM transactions WHERE external_transaction_id = %s", (syriatel_cash_transaction_id,))
-        existing_transaction = cursor.fetchone()
-
-        if existing_transaction:
-          transaction_status = existing_transaction[0]  # Extract the status
-
-          if transaction_status == "pending":
-            await update.message.reply_sticker(sticker=processing_sticker_id)
-            await send_message("⚠️ هذه العملية قيد المعالجة..\n\n"
-                           "⏳ يرجى الانتظار حتى اكتمالها 🫡", 
-                           parse_mode="Markdown")
-          else:
-            await update.message.reply_sticker(sticker=erorr_sticker_id)
-            await send_message("❌ رقم العملية الذي أدخلته موجود بالفعل!\n\n"
-                           "🔹 يرجى التحقق من رقم العملية والمحاولة مجددًا.", 
-                           parse_mode="Markdown")
-          return  # Stop further execution
-        
-        # ✅ Fetch player ID from accounts table
-        cursor.execute("SELECT player_id FROM accounts WHERE user_id = %s", (user_id,))
-        result = cursor.fetchone()
-
-        if not result:
-            await send_message("❌ لم يتم العثور على حسابك. يرجى إنشاء حساب أولاً.", parse_mode="Markdown")
+        # ✅ Register the transaction ID (or report why it can't be used)
+        if not await intake_deposit_transaction_id(update, send_message, user_id, syriatel_cash_transaction_id, "Syriatel"):
             return
 
-        player_id = result[0]  # Extract player_id safely
-
-        # ✅ Insert transaction into database
-        cursor.execute(
-            "INSERT INTO transactions (external_transaction_id, user_id, player_id, transaction_type, payment_method, status) "
-            "VALUES (%s, %s, %s, 'deposit', 'Syriatel', 'pending')",
-            (syriatel_cash_transaction_id, user_id, player_id)
-        )
-
-        conn.commit()  # ✅ Save changes
-
          # ✅ Store transaction ID in user context
         context.user_data["pending_transaction_id"] = syriatel_cash_transaction_id
         context.user_data["state"] = "awaiting_deposit_amount"
@@ -1310,13 +1134,9 @@ async def handle_charge_syriatel_transaction_id(update: Update, context: Context
         
         
     except Exception as e:
-        print(f"❌ Database Error: {e}")  # Log error
+        logger.error("❌ Database Error: %s", e)
         await send_message("❌ حدث خطأ أثناء تسجيل الطلب. يرجى المحاولة لاحقاً.", parse_mode="Markdown")
 
-    finally:
-        cursor.close()
-        conn.close()  # ✅ Always close the database connection
-
     
     
 # ------>> here call the function that check if the transaction is validated(def check_syreatel_cash_transaction_validation) 
@@ -1345,7 +1165,7 @@ async def handle_charge_payeer_transaction_id(update: Update, context: ContextTy
     erorr_sticker_id ="CAACAgIAAxkBAeLfqGfdhv5zCSIhUgJGjM6LbmkaIB9wAAJxOwACtUNZSjpcwC49bZ4dNgQ"
     warning_sticker_id ="CAACAgIAAxkBAeLea2fdghlNXrLzSIKqJ_kW8t43fAE1AALzQQACb7NoSV-j4NDXxKN2NgQ"
     success_sticker_id="CAACAgIAAxkBAeLfjWfdhmXMrgLfaZJoEAWhTenCC6DrAALnNQACtoxBS2JmFwWrYLwGNgQ"
-    print("📩 Received message:", charge_payeer_transaction_id)  # Debugging
+    logger.debug("📩 Received message: %s", charge_payeer_transaction_id)
 
     # Ensure bot is expecting a transaction ID
     if context.user_data.get("state") != "expecting_payeer_transaction_id":
@@ -1353,7 +1173,7 @@ async def handle_charge_payeer_transaction_id(update: Update, context: ContextTy
         await send_message("⚠️ إدخال غير متوقع! الرجاء اختيار طريقة الدفع أولاً.")
         return
     
-    print("✅ Bot is expecting a transaction ID, processing...")  # Debugging
+    logger.debug("✅ Bot is expecting a transaction ID, processing...")
 
     # Validate the transaction ID (must be 10 digits)
     if not charge_payeer_transaction_id.isdigit() or len(charge_payeer_transaction_id) != 10:
@@ -1362,50 +1182,11 @@ async def handle_charge_payeer_transaction_id(update: Update, context: ContextTy
         return
     
 
-     # ✅ Connect to the database
-    conn = connect_db()
-    cursor = conn.cursor()
-
     try:
-        
-        # ✅ Check if the transaction ID already exists
-        cursor.execute("SELECT status FROM transactions WHERE external_transaction_id = %s", (charge_payeer_transaction_id,))
-        existing_transaction = cursor.fetchone()
-
-        if existing_transaction:
-          transaction_status = existing_transaction[0]  # Extract the status
-
-          if transaction_status == "pending":
-            await update.message.reply_sticker(sticker=processing_sticker_id)
-            await send_message("⚠️ هذه العملية قيد المعالجة..\n\n"
-                           "⏳ يرجى الانتظار حتى اكتمالها 🫡", 
-                           parse_mode="Markdown")
-          else:
-            await update.message.reply_sticker(sticker=erorr_sticker_id)
-            await send_message("❌ رقم العملية الذي أدخلته موجود بالفعل!\n\n"
-                           "🔹 يرجى التحقق من رقم العملية والمحاولة مجددًا.", 
-                           parse_mode="Markdown")
-          return  # Stop further execution
-        
-        # ✅ Fetch player ID from accounts table
-        cursor.execute("SELECT player_id FROM accounts WHERE user_id = %s", (user_id,))
-        result = cursor.fetchone()
-
-        if not result:
-            await send_message("❌ لم يتم العثور على حسابك. يرجى إنشاء حساب أولاً.", parse_mode="Markdown")
+        # ✅ Register the transaction ID (or report why it can't be used)
+        if not await intake_deposit_transaction_id(update, send_message, user_id, charge_payeer_transaction_id, "Payeer"):
             return
 
-        player_id = result[0]  # Extract player_id safely
-
-        # ✅ Insert transaction into database
-        cursor.execute(
-            "INSERT INTO transactions (external_transaction_id, user_id, player_id, transaction_type, payment_method, status) "
-            "VALUES (%s, %s, %s, 'deposit', 'Payeer', 'pending')",
-            (charge_payeer_transaction_id, user_id, player_id)
-        )
-
-        conn.commit()  # ✅ Save changes
-
          # ✅ Store transaction ID in user context
         context.user_data["pending_transaction_id"] = charge_payeer_transaction_id
         context.user_data["method"] = "Payeer"
@@ -1422,14 +1203,10 @@ async def handle_charge_payeer_transaction_id(update: Update, context: ContextTy
         await send_message(f"🔢 اهلأ دخّل المبلغ اللي حولته  USD  💰",parse_mode="Markdown")
 
     except Exception as e:
-        print(f"❌ Database Error: {e}")  # Log error
+        logger.error("❌ Database Error: %s", e)
         await update.message.reply_sticker(sticker=erorr_sticker_id)
         await send_message("❌ حدث خطأ أثناء تسجيل الطلب. يرجى المحاولة لاحقاً.", parse_mode="Markdown")
 
-    finally:
-        cursor.close()
-        conn.close()  # ✅ Always close the database connection
-
     
     
 
@@ -1445,7 +1222,7 @@ async def handle_charge_payeer_transaction_id(update: Update, context: ContextTy
 async def handle_charge_bemo_transaction_id(update: Update, context: ContextTypes.DEFAULT_TYPE, user_input: str):
     """Handles the Bemo Cash transaction ID input from the user and stores it in the database."""
 
-    print("✅ Bot is expecting a Bemo transaction ID, processing...")  # Debugging
+    logger.debug("✅ Bot is expecting a Bemo transaction ID, processing...")
 
     # ✅ Detect message source
     if update.message:
@@ -1482,53 +1259,11 @@ async def handle_charge_bemo_transaction_id(update: Update, context: ContextType
 
     
 
-    # ✅ Connect to the database
-    conn = connect_db()
-    cursor = conn.cursor()
-
     try:
-        
-        # ✅ Check if the transaction ID already exists and get its status
-        cursor.execute("SELECT status FROM transactions WHERE external_transaction_id = %s", (bemo_transaction_id,))
-        existing_transaction = cursor.fetchone()
-
-        if existing_transaction:
-          transaction_status = existing_transaction[0]  # Extract the status
-
-          if transaction_status == "pending":
-            await update.message.reply_sticker(sticker=processing_sticker_id)
-            await send_message("⚠️ هذه العملية قيد المعالجة..\n\n"
-                           "⏳ يرجى الانتظار حتى اكتمالها 🫡", 
-                           parse_mode="Markdown")
-          else:
-            await update.message.reply_sticker(sticker=erorr_sticker_id)
-            await send_message("❌ رقم العملية الذي أدخلته موجود بالفعل!\n\n"
-                           "🔹 يرجى التحقق من رقم العملية والمحاولة مجددًا.", 
-                           parse_mode="Markdown")
-          return  # Stop further execution
-
-        
-        
-        # ✅ Fetch player ID from accounts table
-        cursor.execute("SELECT player_id FROM accounts WHERE user_id = %s", (user_id,))
-        result = cursor.fetchone()
-
-        if not result:
-            await update.message.reply_sticker(sticker=erorr_sticker_id)
-            await send_message("❌ لم يتم العثور على حسابك. يرجى إنشاء حساب أولاً.", parse_mode="Markdown")
+        # ✅ Register the transaction ID (or report why it can't be used)
+        if not await intake_deposit_transaction_id(update, send_message, user_id, bemo_transaction_id, "Bemo"):
             return
 
-        player_id = result[0]  # Extract player_id safely
-
-        # ✅ Insert transaction into database
-        cursor.execute(
-            "INSERT INTO transactions (external_transaction_id, user_id, player_id, transaction_type, payment_method, status) "
-            "VALUES (%s, %s, %s, 'deposit', 'Bemo', 'pending')",
-            (bemo_transaction_id, user_id, player_id)
-        )
-
-        conn.commit()  # ✅ Save changes
-
          # ✅ Store transaction ID in user context
         context.user_data["pending_transaction_id"] = bemo_transaction_id
         context.user_data["state"] = "awaiting_deposit_amount"
@@ -1544,13 +1279,9 @@ async def handle_charge_bemo_transaction_id(update: Update, context: ContextType
         await send_message(f"🔢 هلأ دخّل المبلغ اللي حولته بالليرة السورية. 💰",parse_mode="Markdown")
 
     except Exception as e:
-        print(f"❌ Database Error: {e}")  # Log error
+        logger.error("❌ Database Error: %s", e)
         await send_message("❌ حدث خطأ أثناء تسجيل الطلب. يرجى المحاولة لاحقاً.", parse_mode="Markdown")
 
-    finally:
-        cursor.close()
-        conn.close()  # ✅ Always close the database connection
-
     
     
     
@@ -1601,19 +1332,15 @@ async def handle_deposit_amount(update: Update, context: ContextTypes.DEFAULT_TY
         return
 
     # ✅ Update transaction with amount
-    conn = connect_db()
-    cursor = conn.cursor()
-
     try:
         if method == "Payeer":
             deposit_amount = exchange_rate
-            cursor.execute("""
+            await execute("""
             UPDATE transactions 
             SET amount = %s
             WHERE external_transaction_id = %s AND user_id = %s
         """, (deposit_amount, transaction_id, user_id))
 
-            conn.commit()
             await update.message.reply_sticker(sticker=processing_sticker_id)
             await send_message(
             f"✅ تم تسجيل المبلغ بنجاح!\n\n"
@@ -1624,14 +1351,12 @@ async def handle_deposit_amount(update: Update, context: ContextTypes.DEFAULT_TY
             
             
         else:
-         cursor.execute("""
+         await execute("""
             UPDATE transactions 
             SET amount = %s
             WHERE external_transaction_id = %s AND user_id = %s
          """, (deposit_amount, transaction_id, user_id))
 
-         conn.commit()
-         
          await update.message.reply_sticker(sticker=processing_sticker_id)   
          await send_message(
             f"✅ تم تسجيل المبلغ بنجاح!\n\n"
@@ -1641,23 +1366,19 @@ async def handle_deposit_amount(update: Update, context: ContextTypes.DEFAULT_TY
          )
 
     except Exception as e:
-        print(f"❌ Database Error: {e}")  
+        logger.error("❌ Database Error: %s", e)
         await send_message("❌ حدث خطأ أثناء تسجيل المبلغ. يرجى المحاولة لاحقًا!", parse_mode="Markdown")
 
-    finally:
-        cursor.close()
-        conn.close()
-
     # ✅ Reset user state
     context.user_data["state"] = None
     context.user_data.pop("pending_transaction_id", None)
-    result = verify_transaction_from_user_input(transaction_id,user_id)
+    result = await verify_transaction_from_user_input(transaction_id,user_id)
     if "error" in result:
      await send_message(result["error"])
      
     else:
      keyboard = [
-                [InlineKeyboardButton("🌐 WayXbet الانتقال الى موقع ", url="https://m.wayxbet.com/en/")],
+                [InlineKeyboardButton("🌐 WayXbet الانتقال الى موقع ", url=WEBSITE_URL)],
                 [InlineKeyboardButton("💰 شحن الحساب", callback_data='charge_website_account'), 
                  InlineKeyboardButton("💸 سحب رصيد الحساب", callback_data='withdraw_website')],
                 [InlineKeyboardButton("🔙 رجوع", callback_data='back')]
@@ -1668,13 +1389,15 @@ async def handle_deposit_amount(update: Update, context: ContextTypes.DEFAULT_TY
                         f"Good Luck 🔥💫"
                         ,reply_markup=reply_markup, parse_mode="Markdown")
 
-#This function is triggered when an SMS is received via forwarding.
+# SMS payments that arrived before (or without) a matching transaction, kept for later verification.
+SMS_LOG_INSERT = "INSERT INTO sms_logs (transaction_id, amount, sender_phone) VALUES (%s, %s, %s)"
 
+#This function is triggered when an SMS is received via forwarding.
 
 async def process_sms(sms_text, update: Update = None, context: ContextTypes.DEFAULT_TYPE = None):
     """Extract transaction details from SMS and verify against pending transactions."""
     bot = Bot(token= BOT_TOKEN)
-    print("📩 Processing new SMS...")
+    logger.debug("📩 Processing new SMS...")
 
     # ✅ Detect message source (Reply in Bot Chat)
     user_id = None  # Default if triggered by an SMS
@@ -1690,7 +1413,7 @@ async def process_sms(sms_text, update: Update = None, context: ContextTypes.DEF
 
     # ✅ Step 1: Remove "From: ..." if it exists
     sms_text = re.sub(r"^From : .+\n", "", sms_text)
-    print(f"🔍 Cleaned SMS Text: {sms_text}")
+    logger.debug("🔍 Cleaned SMS Text: %s", sms_text)
 
     # ✅ Step 2: Check both patterns (Bemo & Syriatel Cash)
     pattern_bemo = r"استلام حوالة الكترونية (\d+)ل.س من (.+?)،رقم العملية (\d{9})"
@@ -1700,40 +1423,35 @@ async def process_sms(sms_text, update: Update = None, context: ContextTypes.DEF
     match_syriatel = re.search(pattern_syriatel, sms_text)
 
     if match_bemo:
-        print("✅ Matched Pattern: Bemo Bank")
+        logger.debug("✅ Matched Pattern: Bemo Bank")
         sms_amount = float(match_bemo.group(1))
         sender_name = match_bemo.group(2)
         sms_transaction_id = match_bemo.group(3)
     elif match_syriatel:
-        print("✅ Matched Pattern: Syriatel Cash")
+        logger.debug("✅ Matched Pattern: Syriatel Cash")
         sms_amount = float(match_syriatel.group(1))
         sender_name = "Syriatel Cash"
         sms_transaction_id = match_syriatel.group(2)
     else:
-        print("❌ SMS format does not match expected patterns")
+        logger.warning("⚠️ SMS format does not match expected patterns")
         if send_message:
             await send_message("❌ رسالة غير متوافقة مع النمط المطلوب.", parse_mode="Markdown")
         return {"error": "❌ رسالة غير متوافقة مع النمط المطلوب"}
 
-    print(f"✅ Extracted Data: Transaction ID={sms_transaction_id}, Amount={sms_amount}, Sender={sender_name}")
+    log_event(logger, logging.INFO, "sms_parsed", transaction_id=sms_transaction_id, amount=sms_amount, sender=sender_name)
 
     # ✅ Step 3: Connect to MySQL
     try:
-        conn = connect_db()
-        cursor = conn.cursor()
-        print("✅ Database connection established.")
-
         # ✅ Step 4: Check if the transaction exists in `transactions`
-        cursor.execute("SELECT user_id, amount, status FROM transactions WHERE external_transaction_id = %s", (sms_transaction_id,))
-        transaction = cursor.fetchone()
+        transaction_row = await fetch_one("SELECT user_id, amount, status FROM transactions WHERE external_transaction_id = %s", (sms_transaction_id,))
 
-        if transaction:
-            db_user_id, db_amount, status = transaction
-            print(f"✅ Transaction found: User ID={db_user_id}, Status={status}")
+        if transaction_row:
+            db_user_id, db_amount, status = transaction_row
+            logger.info("✅ Transaction found: User ID=%s, Status=%s", db_user_id, status)
 
             # ✅ Step 5: Verify transaction status
             if status != "pending":
-                print("⚠️ Transaction is already verified or completed.")
+                logger.warning("⚠️ Transaction is already verified or completed.")
                 if db_user_id:
                     await bot.send_message(
                         chat_id=db_user_id,
@@ -1743,34 +1461,42 @@ async def process_sms(sms_text, update: Update = None, context: ContextTypes.DEF
 
             # ✅ Step 6: Verify transaction amount
             if db_amount != sms_amount:
-                print("❌ Transaction amount does not match!")
+                logger.warning("⚠️ Transaction %s amount does not match!", sms_transaction_id)
                 if db_user_id:
                     await bot.send_message(
                         chat_id=db_user_id,
                         text=
                         f"❌ خطأ في المبلغ!.. تاكد من المبلغ وحاول مرة اخرى", parse_mode="Markdown")
-                    cursor.execute("DELETE FROM transactions where external_transaction_id =%s",(sms_transaction_id,))
-                    cursor.execute("INSERT INTO sms_logs (transaction_id, amount, sender_phone) VALUES (%s, %s, %s)", 
-                        (sms_transaction_id, sms_amount, sender_name))
 
-                    conn.commit()
+                    def keep_for_review(cursor):
+                        cursor.execute("DELETE FROM transactions where external_transaction_id =%s",(sms_transaction_id,))
+                        cursor.execute(SMS_LOG_INSERT, (sms_transaction_id, sms_amount, sender_name))
+
+                    await transaction(keep_for_review)  # ✅ The SMS is payment evidence: stored before we answer
                 return {"error": "❌ المبلغ غير مطابق!"}
 
             # ✅ Step 7: Approve transaction and update user balance
-            cursor.execute("""
-                UPDATE transactions 
-                SET status = 'approved', verification_source = 'SMS' 
-                WHERE external_transaction_id = %s
-            """, (sms_transaction_id,))
-
-            cursor.execute("UPDATE wallets SET bot_balance = bot_balance + %s WHERE user_id = %s", (sms_amount, db_user_id))
-            conn.commit()
+            def approve_transaction(cursor):
+                cursor.execute("""
+                    UPDATE transactions 
+                    SET status = 'approved', verification_source = 'SMS' 
+                    WHERE external_transaction_id = %s AND status = 'pending'
+                """, (sms_transaction_id,))
+                if cursor.rowcount != 1:
+                    return False  # ✅ Already approved by a concurrent SMS / user verification
+
+                rollups.add_approved_deposit(cursor, sms_transaction_id)
+                wallets.credit(cursor, db_user_id, bot_balance=sms_amount)
+                return True
+
+            if not await transaction(approve_transaction):
+                return {"error": "⚠️ هذه العملية تمت معالجتها بالفعل."}
 
-            print(f"✅ Transaction {sms_transaction_id} verified and balance updated!")
+            logger.info("✅ Transaction %s verified and balance updated!", sms_transaction_id)
 
             # ✅ Notify user inside the bot chat
             keyboard = [
-                [InlineKeyboardButton("🌐 WayXbet الانتقال الى موقع ", url="https://m.wayxbet.com/en/")],
+                [InlineKeyboardButton("🌐 WayXbet الانتقال الى موقع ", url=WEBSITE_URL)],
                 [InlineKeyboardButton("💰 شحن الحساب", callback_data='charge_website_account'), 
                 InlineKeyboardButton("💸 سحب رصيد الحساب", callback_data='withdraw_website')],
                 [InlineKeyboardButton("🔙 رجوع", callback_data='back')]
@@ -1792,44 +1518,36 @@ async def process_sms(sms_text, update: Update = None, context: ContextTypes.DEF
             return {"success": f"✅ تم تأكيد العملية وإضافة {sms_amount} ل.س إلى رصيدك!"}
 
         else:
-            print(f"⚠️ Transaction {sms_transaction_id} not found, saving to `sms_logs`...")
-            cursor.execute("INSERT INTO sms_logs (transaction_id, amount, sender_phone) VALUES (%s, %s, %s)", 
-                        (sms_transaction_id, sms_amount, sender_name))
-            conn.commit()
+            logger.warning("⚠️ Transaction %s not found, saving to `sms_logs`...", sms_transaction_id)
+            await execute(SMS_LOG_INSERT, (sms_transaction_id, sms_amount, sender_name))  # ✅ Committed before we answer
 
             return {"info": "⚠️ العملية غير موجودة، تم حفظها للمراجعة لاحقًا."}
 
     except Exception as e:
-        print(f"❌ Database Error: {e}")
+        logger.error("❌ Database Error: %s", e)
         return {"error": f"❌ خطأ في النظام: {str(e)}"}
 
-    finally:
-        cursor.close()
-        conn.close()
-        print("✅ Database connection closed.")
-
 
 
 
 
-def verify_transaction_from_user_input(transaction_id, user_id):
+async def verify_transaction_from_user_input(transaction_id, user_id):
     """Verify a transaction when the user enters the transaction ID manually."""
-    
-    conn = connect_db()
-    cursor = conn.cursor()
-    
-    
-    
+    return await transaction(_verify_transaction, transaction_id, user_id)
+
+
+def _verify_transaction(cursor, transaction_id, user_id):
+    """Runs on a DB worker thread inside one transaction (see verify_transaction_from_user_input)."""
+
     # ✅ Check if transaction already exists in `transactions`
     cursor.execute("SELECT amount, status FROM transactions WHERE external_transaction_id = %s AND user_id = %s", 
                    (transaction_id, user_id))
-    transaction = cursor.fetchone()
+    transaction_row = cursor.fetchone()
 
-    if transaction:
-        amount, status = transaction
+    if transaction_row:
+        amount, status = transaction_row
 
         if status != "pending":
-            conn.close()
             return {"error": "Transaction is already verified or completed"}
 
         # ✅ Check if SMS has already been received
@@ -1841,28 +1559,26 @@ def verify_transaction_from_user_input(transaction_id, user_id):
 
             if sms_amount != amount:
                 cursor.execute("DELETE FROM transactions WHERE external_transaction_id = %s",(transaction_id,))
-                conn.commit()  # ✅ Commit the deletion
-                conn.close()
                 return {"error": "المبلغ في الرسالة النصية لا يتطابق مع المبلغ المُدخل للمعاملة ❌⚠️ يرجى التحقق والمحاولة مرة أخرى 🔄✅"}
 
             # ✅ Approve the transaction & credit balance
             cursor.execute("""
                 UPDATE transactions 
                 SET status = 'approved', verification_source = 'SMS' 
-                WHERE external_transaction_id = %s
+                WHERE external_transaction_id = %s AND status = 'pending'
             """, (transaction_id,))
-            
-            cursor.execute("UPDATE wallets SET bot_balance = bot_balance + %s WHERE user_id = %s", (amount, user_id))
+            if cursor.rowcount != 1:
+                return {"error": "Transaction is already verified or completed"}
+
+            rollups.add_approved_deposit(cursor, transaction_id)
+            wallets.credit(cursor, user_id, bot_balance=amount)
 
             # ✅ Delete from `sms_logs` since it's now verified
             cursor.execute("DELETE FROM sms_logs WHERE transaction_id = %s", (transaction_id,))
-            conn.commit()
-            conn.close()
 
             return {"success": True, "message": f"Transaction {transaction_id} verified via SMS logs and balance updated!"}
 
         else:
-            conn.close()
             return {
                         "error": "🔄 العملية قيد المعالجة... يُرجى الانتظار حتى اكتمالها.\n"
                          "⏳ إذا لم تكتمل خلال 10 دقائق، حاول مرة أخرى.\n"
@@ -1890,18 +1606,8 @@ async def handle_website_charge_amount_From_Bot(update: Update, context: Context
     processing_sticker_id = "CAACAgIAAxkBAeLe02fdg4hbX96ODk5SRx08-jtV08apAALDPQACzBMpSoUPzZoaigNGNgQ"
     error_sticker_id ="CAACAgIAAxkBAeLfqGfdhv5zCSIhUgJGjM6LbmkaIB9wAAJxOwACtUNZSjpcwC49bZ4dNgQ"
     success_sticker_id="CAACAgIAAxkBAeLaJGfddT5-nwAB0D9SFNMeScLbCI3V1QACfz0AAi3JKUp2tyZPFVNcFzYE"
-    # ✅ Step 1: Prevent duplicate requests
-    if context.user_data.get("processing_transaction"):
-        await update.message.reply_sticker(sticker=processing_sticker_id)
-        await send_message("⏳ لديك معاملة جارية بالفعل. يرجى الانتظار حتى تكتمل.")
-        return
-
-    # ✅ Step 2: Lock the process
-    context.user_data["processing_transaction"] = True
-
-    conn = connect_db()
-    cursor = conn.cursor()
-
+    # ✅ Duplicate requests are refused by transfers (TransferInFlight), across every worker:
+    # update_queue only orders a chat's updates within one process
     try:
         # ✅ Validate amount
         if not amount_text.isdigit():
@@ -1917,14 +1623,13 @@ async def handle_website_charge_amount_From_Bot(update: Update, context: Context
             return
 
         # ✅ Fetch user's balances
-        cursor.execute("SELECT bot_balance, game_balance FROM wallets WHERE user_id = %s", (user_id,))
-        result = cursor.fetchone()
+        result = await get_user_snapshot(user_id)
 
         if not result:
             await send_message("❌ لم يتم العثور على حساب المحفظة الخاص بك!", parse_mode="Markdown")
             return
 
-        bot_balance, game_balance = result
+        bot_balance, game_balance = result.bot_balance, result.game_balance
 
         total_available_balance = bot_balance + game_balance
 
@@ -1933,69 +1638,36 @@ async def handle_website_charge_amount_From_Bot(update: Update, context: Context
             await send_message("⚠️ رصيدك غير كافٍ لهذا التحويل!", parse_mode="Markdown")
             return
 
-        # ✅ Step 3: Determine how to deduct balance
+        # ✅ Step 1: Determine how to deduct balance
         game_used = min(amount, game_balance)  # Use game_balance first
         bot_used = amount - game_used  # If more is needed, use bot_balance
 
-        # ✅ Step 4: Deposit to player's website account FIRST
-        await update.message.reply_sticker(sticker=processing_sticker_id)
-        await send_message("🔄 جارٍ تنفيذ عملية الشحن... يرجى الانتظار!", parse_mode="Markdown")
-
-        deposit_result = deposit_to_player(user_id, amount)
-
-        if deposit_result.get("success"):
-            # ✅ Step 5: Update balances in the database
-            new_game_balance = game_balance - game_used
-            new_bot_balance = bot_balance - bot_used
-
-            cursor.execute("UPDATE wallets SET game_balance = %s, bot_balance = %s WHERE user_id = %s", 
-                           (new_game_balance, new_bot_balance, user_id))
-            conn.commit()
-
-            # ✅ Fetch the user's current website balance
-            balance_details = fetch_player_balance(user_id)
-
-            if "error" in balance_details:
-                await send_message(f"❌ خطأ في جلب الرصيد: {balance_details['error']}", parse_mode="Markdown")
-                return
+        # ✅ Step 2: Reserve the funds and queue the deposit in one transaction; a worker sends it
+        chat_id, message_id = update.message.chat_id, update.message.message_id
+        try:
+            transfer_id = await transfers.submit_deposit(
+                f"deposit:{chat_id}:{message_id}", user_id, chat_id, result.player_id, result.parent_id,
+                amount, game_used, bot_used)
+        except transfers.InsufficientFunds:
+            # A parallel request spent the funds since the snapshot was read
+            await update.message.reply_sticker(sticker=error_sticker_id)
+            await send_message("⚠️ رصيدك غير كافٍ لهذا التحويل!", parse_mode="Markdown")
+            return
+        except transfers.TransferInFlight:
+            await update.message.reply_sticker(sticker=processing_sticker_id)
+            await send_message("⏳ لديك معاملة جارية بالفعل. يرجى الانتظار حتى تكتمل.")
+            return
 
-            new_website_balance = balance_details["balance"]
+        if transfer_id is None:
+            return  # ✅ Telegram redelivered this message; it is already queued
 
-            cursor.execute("UPDATE wallets SET website_balance = %s WHERE user_id = %s", 
-                           (new_website_balance, user_id))
-            conn.commit()
-             
-            if amount >= 100000:
-             cursor.execute("select game_points from wallets where user_id = %s",(user_id,))
-             game_points=cursor.fetchone()[0]
-             game_points += 10
-             cursor.execute("update wallets set game_points = %s where user_id = %s",(game_points,user_id))
-             conn.commit()
-
-            success_message = (
-                f"✅ تم تحويل المبلغ بنجاح إلى حسابك على الموقع!\n\n"
-                f"💰 المبلغ المحول: `{amount}` SYP\n"
-                f"🎰 رصيد أرباح اللعبة بعد الخصم: `{new_game_balance}` SYP\n"
-                f"🤖 رصيدك في المحفظة بعد الخصم: `{new_bot_balance}` SYP\n"
-                f"🌍 رصيدك في الموقع بعد التعبئة: `{new_website_balance}` SYP"
-            )
-            await update.message.reply_sticker(sticker=success_sticker_id)
-            await send_message(success_message, parse_mode="Markdown")
-
-        else:
-            # ✅ Replace deposit failure message with a custom response
-            error_message = f"❌ فشل في الإيداع في حساب الموقع!\n⚠️ السبب: {deposit_result['error']}"
-            await send_message(error_message, parse_mode="Markdown")
+        # ✅ Step 3: The outbox worker reports the result (see notify_transfer)
+        await update.message.reply_sticker(sticker=processing_sticker_id)
+        await send_message("🔄 جارٍ تنفيذ عملية الشحن... سيتم إعلامك فور اكتمالها!", parse_mode="Markdown")
 
     except Exception as e:
         await send_message(f"❌ حدث خطأ غير متوقع: `{str(e)}`", parse_mode="Markdown")
 
-    finally:
-        # ✅ Step 6: Unlock the process so the user can make another request
-        context.user_data["processing_transaction"] = False
-        cursor.close()
-        conn.close()
-
 #==================================== website_withdraw_amount handler ============================
 
 
@@ -2019,18 +1691,8 @@ async def handle_website_withdraw_amount_To_Bot(update: Update, context: Context
     warning_sticker_id ="CAACAgIAAxkBAeLea2fdghlNXrLzSIKqJ_kW8t43fAE1AALzQQACb7NoSV-j4NDXxKN2NgQ"
      
 
-    # ✅ Step 1: Prevent duplicate requests
-    if context.user_data.get("processing_transaction"):
-        await update.message.reply_sticker(sticker=processing_sticker_id)
-        await send_message("⏳ لديك معاملة جارية بالفعل. يرجى الانتظار حتى تكتمل.", parse_mode="Markdown")
-        return
-
-    # ✅ Step 2: Lock the process
-    context.user_data["processing_transaction"] = True
-
-    conn = connect_db()
-    cursor = conn.cursor()
-
+    # ✅ Duplicate requests are refused by transfers (TransferInFlight), across every worker:
+    # update_queue only orders a chat's updates within one process
     try:
         # ✅ Validate amount
         if not amount_text.isdigit():
@@ -2046,7 +1708,7 @@ async def handle_website_withdraw_amount_To_Bot(update: Update, context: Context
             return
 
         # ✅ Fetch the user's current website balance
-        balance_details = fetch_player_balance(user_id)
+        balance_details = await fetch_player_balance(user_id)
 
         if "error" in balance_details:
             await send_message(f"❌ خطأ في جلب الرصيد: {balance_details['error']}", parse_mode="Markdown")
@@ -2068,56 +1730,33 @@ async def handle_website_withdraw_amount_To_Bot(update: Update, context: Context
             )
             return
 
-        # ✅ Step 3: Process the withdrawal request
-        await update.message.reply_sticker(sticker=processing_sticker_id)
-        await send_message("🔄 جارٍ تنفيذ عملية السحب... يرجى الانتظار!", parse_mode="Markdown")
-        withdrawal_status = withdraw_from_website(user_id, withdrawal_amount)
-        
-        if withdrawal_status.get("success"):
-            print("after the withdrawal call ")
-            keyboard = [[InlineKeyboardButton("🔙 رجوع", callback_data='back')]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+        try:
+            account = await get_account_identity(user_id)
+        except mysql.connector.Error as err:
+            logger.error("❌ MySQL Error: %s", err)
+            await send_message("⚠️ خطأ في الاتصال بقاعدة البيانات.")
+            return
 
-            # ✅ Update the database: Deduct from website balance and add to bot wallet
-            cursor.execute(
-                "UPDATE wallets SET website_balance = website_balance - %s, bot_balance = bot_balance + %s WHERE user_id = %s",
-                (withdrawal_amount, withdrawal_amount, user_id),
-            )
-            conn.commit()
-            print("before the success message ")
-            # ✅ Notify user about successful withdrawal
-            await update.message.reply_sticker(sticker=success_sticker_id)
-            await send_message(
-                f"✅ تمت عملية السحب بنجاح!\n\n"
-                f"💰 المبلغ المسحوب: `{withdrawal_amount}` SYP\n"
-                f"💳 رصيد الموقع الجديد: `{website_balance - withdrawal_amount}` SYP\n"
-                f"🤖 رصيدك في البوت: `{withdrawal_amount}`SYP",
-                
-                parse_mode="Markdown",
-                reply_markup=reply_markup
-            )
+        # ✅ Step 1: Queue the withdrawal; a worker sends it and credits the bot wallet on success
+        chat_id, message_id = update.message.chat_id, update.message.message_id
+        try:
+            transfer_id = await transfers.submit_withdrawal(
+                f"withdraw:{chat_id}:{message_id}", user_id, chat_id, account.player_id, account.parent_id,
+                withdrawal_amount)
+        except transfers.TransferInFlight:
+            await update.message.reply_sticker(sticker=processing_sticker_id)
+            await send_message("⏳ لديك معاملة جارية بالفعل. يرجى الانتظار حتى تكتمل.")
+            return
 
-        else:
-            # ✅ Withdrawal failed
-            keyboard = [[InlineKeyboardButton("🔙 رجوع", callback_data='back')]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_sticker(sticker=error_sticker_id)
-            await send_message(
-                f"❌ فشلت عملية السحب!\n"
-                f"📌 السبب: {withdrawal_status.get('error', 'خطأ غير معروف')}",
-                parse_mode="Markdown",
-                reply_markup=reply_markup
-            )
+        if transfer_id is None:
+            return  # ✅ Telegram redelivered this message; it is already queued
+
+        await update.message.reply_sticker(sticker=processing_sticker_id)
+        await send_message("🔄 جارٍ تنفيذ عملية السحب... سيتم إعلامك فور اكتمالها!", parse_mode="Markdown")
 
     except Exception as e:
         await send_message(f"❌ حدث خطأ غير متوقع: `{str(e)}`", parse_mode="Markdown")
 
-    finally:
-        # ✅ Step 4: Unlock the process so the user can make another request
-        context.user_data["processing_transaction"] = False
-        cursor.close()
-        conn.close()
-
 
 #-------------------------------------handle_withdraw_amount_from_bot_to_user-------------------
 
@@ -2134,19 +1773,16 @@ async def handle_show_last_transactions(update: Update, context: ContextTypes.DE
     await query.answer()
     
     user_id = query.from_user.id
-    conn = connect_db()
-    cursor = conn.cursor()
     
     try:
         # ✅ Fetch the last 5 transactions for the user
-        cursor.execute("""
+        transactions = await fetch_all("""
             SELECT amount, transaction_type, payment_method, status, timestamp 
             FROM transactions 
             WHERE user_id = %s 
             ORDER BY timestamp DESC 
             LIMIT 5
         """, (user_id,))
-        transactions = cursor.fetchall()
 
         if not transactions:
             
@@ -2176,171 +1812,62 @@ async def handle_show_last_transactions(update: Update, context: ContextTypes.DE
     except Exception as e:
         await query.message.reply_text(f"❌ حدث خطأ غير متوقع: `{str(e)}`", parse_mode="Markdown")
 
-    finally:
-        cursor.close()
-        conn.close()
-
     
 
 #==================================== شحن الحساب function =======================================
 
 
-def deposit_to_player(user_id, amount):
-    """Deposits the specified amount to the user's website account before updating the database."""
-    
-    conn = connect_db()
-    cursor = conn.cursor()
-    
-    try:
-        # ✅ Ensure agent session is active
-        global agent_session
-        if not agent_session and not login_as_agent():
-            return {"error": "Agent login failed"}
-
-        # ✅ Fetch player ID from the database
-        cursor.execute("SELECT player_id FROM accounts WHERE user_id = %s", (user_id,))
-        result = cursor.fetchone()
-
-        if not result:
-            return {"error": "Player ID not found in database"}
-
-        player_id = result[0]  # Extract player ID
-        currency_code = "NSP"  # Ensure this is the correct currency
-
-        # ✅ Prepare the request payload
-        payload = {
-            "amount": amount,
-            "comment": None,
-            "playerId": str(player_id),
-            "currencyCode": currency_code,
-            "currency": currency_code,
-            "moneyStatus": 5
-        }
-
-        headers = {
-            "Content-Type": "application/json",
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-        }
-
-    except Exception as db_error:
-        return {"error": f"Database error: {str(db_error)}"}
-
-    finally:
-        cursor.close()
-        conn.close()
-
-    # ✅ Send deposit request
-    try:
-        response = agent_session.post(DEPOSIT_URL, json=payload, headers=headers)
-        response.raise_for_status()  # Raises an error if request fails
-        data = response.json()
-
-          # ✅ Handle success
-        if data.get("status") and isinstance(data.get("result"), dict):
-            return {"success": True, "message": "Deposit successful"}
-
-        # ✅ Handle failure (extract error message properly)
-        notifications = data.get("notification", [])
-        if notifications and isinstance(notifications, list) and len(notifications) > 0:
-            error_message = notifications[0].get("content", "Unknown error")
-        else:
-            error_message = "Unknown error (No notifications provided)"
-        
-        return {"error": error_message}
-
-    except requests.exceptions.RequestException as e:
-        return {"error": f"Request failed: {str(e)}"}
-
-
-#==================================== withdrawal from the website  functions =======================================
-
-def withdraw_from_website(user_id, amount):
-    """Withdraw funds from the website account to the bot wallet."""
-    
-    conn = connect_db()
-    cursor = conn.cursor()
-    
-    try:
-        # ✅ Ensure agent session is active
-        global agent_session
-        if not agent_session and not login_as_agent():
-            return {"error": "Failed to log in as agent"}
-
-        # ✅ Fetch player_id from the database
-        cursor.execute("SELECT player_id FROM accounts WHERE user_id = %s", (user_id,))
-        result = cursor.fetchone()
-
-        if not result:
-            return {"error": "User ID not found in accounts table"}
-
-        player_id = result[0]  # Extract player_id
-
-        # ✅ Fetch current website balance
-        cursor.execute("SELECT website_balance FROM wallets WHERE user_id = %s", (user_id,))
-        balance_result = cursor.fetchone()
-
-        if not balance_result:
-            return {"error": "Wallet not found"}
-        
-        website_balance = balance_result[0]
-
-        # ✅ Validate if user has enough balance
-        if amount > website_balance:
-            return {"error": "Insufficient balance"}
-
-        # ✅ Prepare withdrawal payload
-        payload = {
-            "amount": -amount,  # The API requires a negative amount
-            "comment": None,
-            "playerId": str(player_id),
-            "currencyCode": "NSP",
-            "currency": "NSP",
-            "moneyStatus": 5
-        }
-
-        # ✅ Send the withdrawal request
-        response = agent_session.post(WITHDRAW_WEBSITE_URL, json=payload)
-        response.raise_for_status()  # Raise error if request fails
-        data = response.json()
-
-        # ✅ Handle API response properly
-        if data.get("status") and isinstance(data.get("result"), dict):
-            # ✅ Deduct from website balance and add to bot wallet
-            cursor.execute(
-                "UPDATE wallets SET website_balance = website_balance - %s, bot_balance = bot_balance + %s WHERE user_id = %s",
-                (amount, amount, user_id)
-            )
+async def notify_transfer(transfer):
+    """Tell the user how a queued website deposit or withdrawal ended (called by the transfer outbox)."""
+    error_sticker_id ="CAACAgIAAxkBAeLfqGfdhv5zCSIhUgJGjM6LbmkaIB9wAAJxOwACtUNZSjpcwC49bZ4dNgQ"
+    success_sticker_id="CAACAgIAAxkBAeLaJGfddT5-nwAB0D9SFNMeScLbCI3V1QACfz0AAi3JKUp2tyZPFVNcFzYE"
+    bot = telegram_app.bot
+    keyboard = [[InlineKeyboardButton("🔙 رجوع", callback_data='back')]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    deposit = transfer.direction == transfers.DEPOSIT
 
-            # ✅ Log transaction
-          
-            return {"success": True, "message": f"Successfully withdrawn {amount} NSP from website to bot wallet!"}
+    if transfer.status == transfers.UNKNOWN:
+        # ✅ The website may have executed it: nothing is refunded or credited until it is reviewed
+        operation = "الشحن" if deposit else "السحب"
+        await bot.send_message(transfer.chat_id, f"⏳ لم نتلقَّ تأكيدًا من الموقع، عملية {operation} قيد المراجعة وسيتم إبلاغك بالنتيجة.")
+        return
 
+    if transfer.status == transfers.FAILED:
+        reason = SERVICE_BUSY_MESSAGE if transfer.error == transfers.ERROR_SERVICE_BUSY else transfer.error
+        if deposit:
+            text = f"❌ فشل في الإيداع في حساب الموقع!\n⚠️ السبب: {reason}"  # Reserved funds were refunded
         else:
-            # ✅ Handle failure correctly
-            notifications = data.get("notification", [])
-            if notifications and isinstance(notifications, list) and len(notifications) > 0:
-                error_message = notifications[0].get("content", "Unknown error")
-            else:
-                error_message = "Unknown error (No notifications provided)"
-            
-            return {"error": error_message}
-
-    except requests.exceptions.RequestException as e:
-        return {"error": f"Request failed: {str(e)}"}
-
-    except Exception as db_error:
-        return {"error": f"Database error: {str(db_error)}"}
+            text = f"❌ فشلت عملية السحب!\n📌 السبب: {reason or 'خطأ غير معروف'}"
+        await bot.send_sticker(transfer.chat_id, sticker=error_sticker_id)
+        await bot.send_message(transfer.chat_id, text, reply_markup=reply_markup)
+        return
 
-    finally:
-        cursor.close()
-        conn.close()  # ✅ Ensure database connection is closed
+    # ✅ Succeeded: show the balances after the transfer
+    snapshot = await get_user_snapshot(transfer.user_id)
+    balance_details = await fetch_player_balance(transfer.user_id, transfer.player_id, transfer.parent_id)
+    website_balance = balance_details.get("balance", "؟")
+    if deposit:
+        text = (
+            f"✅ تم تحويل المبلغ بنجاح إلى حسابك على الموقع!\n\n"
+            f"💰 المبلغ المحول: `{transfer.amount}` SYP\n"
+            f"🎰 رصيد أرباح اللعبة بعد الخصم: `{snapshot.game_balance}` SYP\n"
+            f"🤖 رصيدك في المحفظة بعد الخصم: `{snapshot.bot_balance}` SYP\n"
+            f"🌍 رصيدك في الموقع بعد التعبئة: `{website_balance}` SYP"
+        )
+    else:
+        text = (
+            f"✅ تمت عملية السحب بنجاح!\n\n"
+            f"💰 المبلغ المسحوب: `{transfer.amount}` SYP\n"
+            f"💳 رصيد الموقع الجديد: `{website_balance}` SYP\n"
+            f"🤖 رصيدك في البوت: `{snapshot.bot_balance}` SYP"
+        )
+    await bot.send_sticker(transfer.chat_id, sticker=success_sticker_id)
+    await bot.send_message(transfer.chat_id, text, parse_mode="Markdown", reply_markup=reply_markup)
 
 #-------------------------------- withdrawal_from_bot_to_user function--------------------------------------------
 async def process_withdrawal_amount_from_bot_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE, amount: str, method: str):
     """Handles withdrawals for different payment methods dynamically."""
-    print("Processing withdrawal request...")
-    conn = connect_db()
-    cursor = conn.cursor()
+    logger.debug("Processing withdrawal request...")
 
     # ✅ Detect whether the update is a message or callback query
     if update.message:
@@ -2371,14 +1898,13 @@ async def process_withdrawal_amount_from_bot_to_user(update: Update, context: Co
         return
 
     # ✅ Fetch user balance
-    cursor.execute("SELECT bot_balance FROM wallets WHERE user_id = %s", (user_id,))
-    result = cursor.fetchone()
+    result = await get_user_snapshot(user_id)
 
     if not result:
         await send_message("❌ لم يتم العثور على حساب المحفظة الخاص بك!")
         return
 
-    bot_balance = int(result[0])
+    bot_balance = int(result.bot_balance)
 
     # ✅ Check if the user has enough balance
     if amount > bot_balance:
@@ -2388,7 +1914,7 @@ async def process_withdrawal_amount_from_bot_to_user(update: Update, context: Co
 
     # ✅ Handle Payeer (USD to SYP conversion)
     if method == "payeer":
-        print("Method is Payeer")
+        logger.debug("Method is Payeer")
 
         # ✅ Ensure exchange rate is defined
         global exchange_rate
@@ -2448,17 +1974,11 @@ async def process_withdrawal_amount_from_bot_to_user(update: Update, context: Co
     # ✅ Set state for confirmation
     context.user_data["state"] = "confirm_withdraw"
 
-    # ✅ Close database connection
-    cursor.close()
-    conn.close()
-
 
 
 
 async def finalize_withdrawal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Calculates fees, updates transaction status, and confirms withdrawal request."""
-    conn = connect_db()
-    cursor = conn.cursor(dictionary=True)  # Using dictionary=True to fetch data as dict
     query = update.callback_query
     
     if update.message:
@@ -2503,36 +2023,39 @@ async def finalize_withdrawal(update: Update, context: ContextTypes.DEFAULT_TYPE
         await send_message("❌ المبلغ النهائي غير صالح، يرجى مراجعة التفاصيل!", parse_mode="Markdown")
         return
 
-    try:
-        # Deduct balance from bot wallet
-        cursor.execute("SELECT bot_balance FROM wallets WHERE user_id = %s", (user_id,))
-        result = cursor.fetchone()
-        bot_balance = result["bot_balance"] if result else 0
+    def record_withdrawal(cursor):
+        """Debit the wallet and record the withdrawal in one transaction."""
+        account = load_account_identity(cursor, user_id)
 
-        if bot_balance < final_amount:
-            await update.message.reply_sticker(sticker=success_sticker_id)
-            await send_message("❌ رصيدك غير كافٍ للسحب!", parse_mode="Markdown")
-            return
+        # Ensure player_id exists
+        if account is None or account.player_id is None:
+            return "missing_player_id"
 
-        cursor.execute("UPDATE wallets SET bot_balance = bot_balance - %s WHERE user_id = %s", (final_amount, user_id))
-        # Fetch player_id correctly
-        cursor.execute("SELECT player_id FROM accounts WHERE user_id = %s", (user_id,))
-        player_id_result = cursor.fetchone()
-        player_id = player_id_result["player_id"] if player_id_result else None
+        player_id = account.player_id
 
-# Ensure player_id exists
-        if player_id is None:
-            await send_message("❌ لا يوجد Player ID مرتبط بحسابك!", parse_mode="Markdown")
-            return
+        # Deduct balance from bot wallet (only if it covers the amount)
+        if not wallets.debit(cursor, user_id, bot_balance=final_amount):
+            return "insufficient_balance"
 
-# Insert transaction details (with player_id properly extracted)
+        # Insert transaction details (with player_id properly extracted)
         cursor.execute("INSERT INTO transactions (user_id, amount, player_id, transaction_type, status, payment_method, account_number, fee, final_amount) "
             "VALUES (%s, %s, %s, 'withdrawal', 'approved', %s, %s, %s, %s)",
          (user_id, amount, player_id, method, account_number, fee, final_amount)
-)
+        )
+        rollups.add_transaction(cursor, cursor.lastrowid)  # ✅ Keep admin summaries in step
+        return "ok"
+
+    try:
+        outcome = await transaction(record_withdrawal)  # ✅ Rolled back automatically on failure
 
+        if outcome == "insufficient_balance":
+            await update.message.reply_sticker(sticker=success_sticker_id)
+            await send_message("❌ رصيدك غير كافٍ للسحب!", parse_mode="Markdown")
+            return
 
-        conn.commit()
+        if outcome == "missing_player_id":
+            await send_message("❌ لا يوجد Player ID مرتبط بحسابك!", parse_mode="Markdown")
+            return
 
         # Notify the user
         await update.message.reply_sticker(sticker=success_sticker_id)
@@ -2549,11 +2072,6 @@ async def finalize_withdrawal(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     except mysql.connector.Error as err:
         await send_message(f"❌ خطأ في قاعدة البيانات: {err}", parse_mode="Markdown")
-        conn.rollback()  # Rollback on failure
-
-    finally:
-        cursor.close()
-        conn.close()
 
 
 async def start_slot_machine(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2561,19 +2079,30 @@ async def start_slot_machine(update: Update, context: ContextTypes.DEFAULT_TYPE)
      user_id = update.callback_query.from_user.id
      chat_id = update.callback_query.message.chat_id  # Get chat ID
  
-     
+     # ✅ Global prize-pool check: served from the in-process cache, no table scan
+     game_settings = await get_game_settings()
+     if game_settings.locked:
+         slot_sticker_id = "CAACAgIAAxkBAeLea2fdghlNXrLzSIKqJ_kW8t43fAE1AALzQQACb7NoSV-j4NDXxKN2NgQ"
+         await context.bot.send_sticker(chat_id=chat_id, sticker=slot_sticker_id)
+         message = "\n\n🚫 اللعبة مقفلة الآن! وصلت جميع الجوائز إلى الحد الأقصى (1,000,000 SYP)."
+         # ✅ Send result message
+         keyboard = [[InlineKeyboardButton("🔄 لعب مرة أخرى", callback_data="slot_machine")]]
+         reply_markup = InlineKeyboardMarkup(keyboard)
  
-     # ✅ Connect to the database
-     conn = connect_db()
-     cursor = conn.cursor()
-     
-     cursor.execute("update wallets set game_points = game_points - 1 where user_id = %s", (user_id,))
-     conn.commit()
-     
-     cursor.execute("select game_points from wallets where user_id = %s",(user_id,))
-     game_points = cursor.fetchone()[0]
-     print (f"{game_points}")
-     if game_points == 0 :
+         await update.callback_query.message.reply_text(message, reply_markup=reply_markup, parse_mode="Markdown")
+         return
+
+     def use_game_point(cursor):
+         # ✅ Spend one point only if the user has one left
+         spent = wallets.debit(cursor, user_id, game_points=1)
+         return spent, load_user_snapshot(cursor, user_id)
+
+     spent, snapshot = await transaction(use_game_point)
+     if not snapshot:
+         await update.callback_query.edit_message_text("❌ لم يتم العثور على حساب. يرجى إنشاء حساب أولا.")
+         return
+
+     if not spent:
          slot_sticker_id = "CAACAgIAAxkBAeLea2fdghlNXrLzSIKqJ_kW8t43fAE1AALzQQACb7NoSV-j4NDXxKN2NgQ"
          await context.bot.send_sticker(chat_id=chat_id, sticker=slot_sticker_id)# if the game status = 0 that's mean that the player reached his limits 
          await update.callback_query.message.reply_text(
@@ -2584,40 +2113,17 @@ async def start_slot_machine(update: Update, context: ContextTypes.DEFAULT_TYPE)
              "يلا اشحن وجمّع نقاطك! 💪🔥",
              parse_mode="Markdown"
          )
-         conn.close()
+         return
          
      
      
      
-     cursor.execute("SELECT SUM(total_game_balance) FROM wallets")
-     updated_total_game_balance = cursor.fetchone()[0] or 0
-     print(f"{updated_total_game_balance}")
-     if updated_total_game_balance >= 1000000:
-         slot_sticker_id = "CAACAgIAAxkBAeLea2fdghlNXrLzSIKqJ_kW8t43fAE1AALzQQACb7NoSV-j4NDXxKN2NgQ"
-         await context.bot.send_sticker(chat_id=chat_id, sticker=slot_sticker_id)
-         message = "\n\n🚫 اللعبة مقفلة الآن! وصلت جميع الجوائز إلى الحد الأقصى (1,000,000 SYP)."
-         # ✅ Send result message
-         keyboard = [[InlineKeyboardButton("🔄 لعب مرة أخرى", callback_data="slot_machine")]]
-         reply_markup = InlineKeyboardMarkup(keyboard)
- 
-         await update.callback_query.message.reply_text(message, reply_markup=reply_markup, parse_mode="Markdown")
-         conn.close()
-     
-     
-     
-         
- 
-     # ✅ Check user's game balance
-     cursor.execute("SELECT game_balance FROM wallets WHERE user_id = %s", (user_id,))
-     game_balance = cursor.fetchone()
- 
-     if not game_balance:
-         game_balance = (0,)  # Default to 0 if user has no record
+     # ✅ Check user's game balance (already loaded with the snapshot)
+     game_balance = snapshot.game_balance
  
      # ✅ Check if the user already hit their 50,000 SYP limit
-     cursor.execute("SELECT game_status from wallets where user_id =%s",(user_id,))
-     game_status = cursor.fetchone()
-     if game_balance[0] >= 50000 or game_status[0] == 0:
+     game_status = snapshot.game_status
+     if game_balance >= 50000 or game_status == 0:
          slot_sticker_id = "CAACAgIAAxkBAeLea2fdghlNXrLzSIKqJ_kW8t43fAE1AALzQQACb7NoSV-j4NDXxKN2NgQ"
          await context.bot.send_sticker(chat_id=chat_id, sticker=slot_sticker_id)# if the game status = 0 that's mean that the player reached his limits 
          await update.callback_query.message.reply_text(
@@ -2625,9 +2131,7 @@ async def start_slot_machine(update: Update, context: ContextTypes.DEFAULT_TYPE)
              "🚫 لا يمكنك اللعب مرة أخرى.",
              parse_mode="Markdown"
          )
-         cursor.execute("UPDATE wallets set game_status = %s where user_id = %s" ,(0,user_id))
-         conn.commit()
-         conn.close()
+         await execute("UPDATE wallets set game_status = %s where user_id = %s" ,(0,user_id))
          return
  
      # ✅ Generate slot machine result
@@ -2639,13 +2143,9 @@ async def start_slot_machine(update: Update, context: ContextTypes.DEFAULT_TYPE)
  
      if win_amount > 0:
          
-          # ✅ Add winnings to user's game balance
-         cursor.execute("UPDATE wallets SET game_balance = game_balance + %s WHERE user_id = %s", (win_amount, user_id))
-    
-         # ✅ Update the total game balance correctly
-         cursor.execute("UPDATE wallets SET total_game_balance = total_game_balance + %s WHERE user_id = %s", (win_amount, user_id))
-    
-         conn.commit()
+         # ✅ Wallet and global prize pool are updated in one transaction
+         game_settings = await transaction(record_win, user_id, win_amount)
+         game_settings_cache.set(game_settings)
          # ✅ Send Slot Machine Sticker (Replace with your own `file_id`)
          slot_sticker_id = "CAACAgIAAxkBAeLaJGfddT5-nwAB0D9SFNMeScLbCI3V1QACfz0AAi3JKUp2tyZPFVNcFzYE"
          await context.bot.send_sticker(chat_id=chat_id, sticker=slot_sticker_id)
@@ -2661,18 +2161,15 @@ async def start_slot_machine(update: Update, context: ContextTypes.DEFAULT_TYPE)
      if win_amount > 0:
          message += (
              f"🎉 مبروك! ربحت `{win_amount}` ل.س 🎉\n"
-             f"💰 رصيدك في اللعبة: `{game_balance[0] + win_amount}` ل.س\n"
+             f"💰 رصيدك في اللعبة: `{game_balance + win_amount}` ل.س\n"
              f"🚫لا يمكنك سحب رصيد اللعبة \n"
              "🔄 استخدم الأرباح لشحن حسابك في WayXbet!"
          )
      else:
          message += "😔 للأسف لم تفز هذه المرة.\n🔄 حاول مرة أخرى!"
  
-     # ✅ Check if the total game balance exceeded the global limit
-     if updated_total_game_balance >= 1000000:
-         cursor.execute("UPDATE game_settings SET game_locked = 1")
-         conn.commit()
-         conn.close()
+     # ✅ Check if this win pushed the prize pool over the global limit (already locked in the DB)
+     if win_amount > 0 and game_settings.locked:
          slot_sticker_id = "CAACAgIAAxkBAeLea2fdghlNXrLzSIKqJ_kW8t43fAE1AALzQQACb7NoSV-j4NDXxKN2NgQ"
          await context.bot.send_sticker(chat_id=chat_id, sticker=slot_sticker_id)
          message += "\n\n🚫 اللعبة مقفلة الآن! وصلت جميع الجوائز إلى الحد الأقصى (1,000,000 SYP)."
@@ -2691,5 +2188,4 @@ telegram_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_
 
 if __name__ == "__main__":
     
-    login_as_agent()
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,408 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import functools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import mysql.connector
+from mysql.connector import errors
+from dotenv import load_dotenv
+
+from migrations import run_migrations
+
+
+# Load environment variables
+load_dotenv()
+
+DATABASE_PASSWORD = os.getenv("DATABASE_PASSWORD")
+DATABASE_USER = os.getenv("DATABASE_USER")
+DATABASE_NAME = os.getenv("DATABASE_NAME")
+DATABASE_HOST = os.getenv("DATABASE_HOST")
+
+# Pool sizing: MIN connections are opened at startup, MAX caps concurrent checkouts.
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+# Idle connections older than this are pinged before being handed out again.
+DB_POOL_HEALTHCHECK_AFTER = float(os.getenv("DB_POOL_HEALTHCHECK_AFTER", "30"))
+
+# Async layer: blocking MySQL calls run on a dedicated executor sized to the pool.
+# At most DB_MAX_PENDING calls may queue behind the busy workers; further callers
+# wait up to DB_QUEUE_TIMEOUT seconds for a slot before failing with DatabaseBusy.
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(DB_POOL_MAX_SIZE)))
+DB_MAX_PENDING = int(os.getenv("DB_MAX_PENDING", "100"))
+DB_QUEUE_TIMEOUT = float(os.getenv("DB_QUEUE_TIMEOUT", "10"))
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(errors.PoolError):
+    """Raised when no pooled connection became free within the checkout timeout."""
+
+
+class DatabaseBusy(errors.PoolError):
+    """Raised when the async DB queue stays full for longer than DB_QUEUE_TIMEOUT."""
+
+
+class PooledConnection:
+    """Proxy around a pooled MySQL connection; close() hands it back to the pool."""
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+
+    def __getattr__(self, name):
+        raw = self.__dict__.get("_raw")
+        if raw is None:
+            raise errors.OperationalError("Connection already returned to the pool")
+        return getattr(raw, name)
+
+    def close(self):
+        """Return the connection to the pool (safe to call more than once)."""
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            self._pool.release(raw)
+
+    def discard(self):
+        """Close the connection instead of returning it, e.g. when it may still hold a named lock."""
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            self._pool._close_quietly(raw)
+            self._pool._forget(discarded=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __del__(self):
+        # Safety net for code paths that return without closing.
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """Thread-safe MySQL connection pool with health checks and usage counters."""
+
+    def __init__(self, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                 timeout=DB_POOL_TIMEOUT, healthcheck_after=DB_POOL_HEALTHCHECK_AFTER,
+                 **connect_args):
+        if max_size < 1 or min_size > max_size:
+            raise ValueError("Invalid pool size: min=%s max=%s" % (min_size, max_size))
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.healthcheck_after = healthcheck_after
+        self._connect_args = connect_args
+        self._idle = deque()  # (raw_connection, last_released_at)
+        self._size = 0  # open connections: idle + checked out
+        self._cond = threading.Condition()
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "created": 0,
+            "discarded": 0,
+            "healthcheck_failures": 0,
+        }
+
+    def _connect(self):
+        raw = mysql.connector.connect(**self._connect_args)
+        with self._cond:
+            self._stats["created"] += 1
+        return raw
+
+    def warm(self):
+        """Open connections until the pool holds at least min_size of them."""
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                raw = self._connect()
+            except Exception:
+                self._forget()
+                raise
+            with self._cond:
+                self._idle.append((raw, time.monotonic()))
+                self._cond.notify()
+
+    def get(self, timeout=None):
+        """Check out a healthy connection, waiting up to `timeout` seconds for one."""
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        raw = None
+        last_used = None
+
+        with self._cond:
+            waited = False
+            while True:
+                if self._idle:
+                    raw, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                if not waited:
+                    self._stats["waits"] += 1
+                    waited = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout("No database connection available after %.1fs" % timeout)
+                self._cond.wait(remaining)
+            self._stats["checkouts"] += 1
+
+        if raw is not None and time.monotonic() - last_used >= self.healthcheck_after:
+            if not self._is_healthy(raw):
+                with self._cond:
+                    self._stats["healthcheck_failures"] += 1
+                self._close_quietly(raw)
+                raw = None
+
+        if raw is None:
+            try:
+                raw = self._connect()
+            except Exception:
+                self._forget()
+                raise
+
+        return PooledConnection(self, raw)
+
+    def release(self, raw):
+        """Take a connection back, discarding it if it can no longer be reused."""
+        try:
+            # Never leak an open transaction (or its snapshot) to the next caller.
+            if raw.in_transaction:
+                raw.rollback()
+        except Exception:
+            self._close_quietly(raw)
+            self._forget(discarded=True)
+            return
+
+        with self._cond:
+            self._idle.append((raw, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self):
+        """Return a snapshot of the pool counters and current occupancy."""
+        with self._cond:
+            snapshot = dict(self._stats)
+            snapshot["size"] = self._size
+            snapshot["idle"] = len(self._idle)
+            snapshot["in_use"] = self._size - len(self._idle)
+        return snapshot
+
+    def close_all(self):
+        """Close every idle connection; checked-out ones still return to the pool."""
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+        for raw, _ in idle:
+            self._close_quietly(raw)
+
+    def _is_healthy(self, raw):
+        try:
+            return raw.is_connected()
+        except Exception:
+            return False
+
+    def _forget(self, discarded=False):
+        with self._cond:
+            self._size -= 1
+            if discarded:
+                self._stats["discarded"] += 1
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide connection pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    host=DATABASE_HOST,
+                    user=DATABASE_USER,
+                    password=DATABASE_PASSWORD,
+                    database=DATABASE_NAME,
+                )
+    return _pool
+
+
+def connect_db():
+    """Check a connection out of the shared pool. Calling close() returns it."""
+    return get_pool().get()
+
+
+def pool_stats():
+    """Counters for checkouts, waits and timeouts plus current pool occupancy."""
+    return get_pool().stats()
+
+
+def init_db():
+    """Open the minimum number of pooled connections and bring the schema up to date."""
+    get_pool().warm()
+    conn = connect_db()
+    try:
+        applied = run_migrations(conn)
+    finally:
+        conn.close()
+    if applied:
+        logger.info("✅ Applied schema migrations: %s", applied)
+    logger.info("✅ Database pool ready: %s", pool_stats())
+
+
+#================================ async data-access layer =========================================
+
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+_slots = None
+_slots_loop = None
+_queue_stats = {"calls": 0, "rejected": 0, "max_in_flight": 0}
+
+
+def _get_slots():
+    global _slots, _slots_loop
+    loop = asyncio.get_running_loop()
+    if _slots is None or _slots_loop is not loop:
+        _slots = asyncio.Semaphore(DB_EXECUTOR_WORKERS + DB_MAX_PENDING)
+        _slots_loop = loop
+    return _slots
+
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking database function on the DB executor and await its result."""
+    slots = _get_slots()
+    try:
+        await asyncio.wait_for(slots.acquire(), timeout=DB_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        _queue_stats["rejected"] += 1
+        raise DatabaseBusy("Database queue is full, try again later")
+
+    try:
+        _queue_stats["calls"] += 1
+        in_flight = DB_EXECUTOR_WORKERS + DB_MAX_PENDING - slots._value
+        _queue_stats["max_in_flight"] = max(_queue_stats["max_in_flight"], in_flight)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+    finally:
+        slots.release()
+
+
+def queue_stats():
+    """Counters for the async DB queue (calls, rejections, peak in-flight)."""
+    return dict(_queue_stats)
+
+
+def _run_query(sql, params, fetch, dictionary):
+    conn = connect_db()
+    cursor = conn.cursor(dictionary=dictionary)
+    try:
+        cursor.execute(sql, params or None)
+        if fetch == "one":
+            return cursor.fetchone()
+        if fetch == "all":
+            return cursor.fetchall()
+        conn.commit()
+        return cursor.rowcount
+    finally:
+        cursor.close()
+        conn.close()
+
+
+async def fetch_one(sql, params=(), dictionary=False):
+    """Run a SELECT and return its first row (or None)."""
+    return await run_db(_run_query, sql, params, "one", dictionary)
+
+
+async def fetch_all(sql, params=(), dictionary=False):
+    """Run a SELECT and return all rows."""
+    return await run_db(_run_query, sql, params, "all", dictionary)
+
+
+async def execute(sql, params=()):
+    """Run a single write statement, commit it and return the affected row count."""
+    return await run_db(_run_query, sql, params, None, False)
+
+
+def _run_transaction(func, args, kwargs, dictionary):
+    conn = connect_db()
+    cursor = conn.cursor(dictionary=dictionary)
+    try:
+        result = func(cursor, *args, **kwargs)
+        conn.commit()
+        return result
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+
+async def transaction(func, *args, dictionary=False, **kwargs):
+    """Run func(cursor, *args) on one pooled connection inside a single transaction.
+
+    The transaction is committed when func returns and rolled back if it raises.
+    """
+    return await run_db(_run_transaction, func, args, kwargs, dictionary)
+
+
+async def _loop_latency(seconds, slow_query, blocking):
+    """Event-loop lag seen by a 10 ms ticker (a stand-in for /webhook) while slow queries run."""
+    lags = []
+    deadline = time.perf_counter() + seconds
+
+    async def ticker():
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - started - 0.01)
+
+    async def slow_queries():
+        while time.perf_counter() < deadline:
+            if blocking:
+                _run_query(slow_query, (), "one", False)  # The old way: cursor.execute() on the loop
+            else:
+                await fetch_one(slow_query)
+            await asyncio.sleep(0.05)
+
+    await asyncio.gather(ticker(), slow_queries())
+    lags.sort()
+    return lags[len(lags) // 2], lags[int(len(lags) * 0.99)], lags[-1]
+
+
+async def _benchmark(seconds, query_seconds):
+    slow_query = f"SELECT SLEEP({query_seconds})"
+    for label, blocking in (("query on the event loop", True), ("query on the DB executor", False)):
+        p50, p99, worst = await _loop_latency(seconds, slow_query, blocking)
+        print(f"{label:25}: loop lag p50 {p50 * 1000:7.1f} ms  p99 {p99 * 1000:7.1f} ms  max {worst * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    if "--benchmark" not in sys.argv:
+        sys.exit("usage: python database.py --benchmark [seconds] [slow_query_seconds]")
+    args = [float(a) for a in sys.argv[sys.argv.index("--benchmark") + 1:]]
+    seconds, query_seconds = (args + [10, 0.5][len(args):])[:2]
+    logging.basicConfig(level=logging.INFO)
+    init_db()
+    asyncio.run(_benchmark(seconds, query_seconds))
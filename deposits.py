@@ -0,0 +1,37 @@
+from database import transaction
+
+
+DEPOSIT_NEW = "new"
+
+# One statement both looks up the player and claims the external ID. The unique
+# key on external_transaction_id makes a second submission of the same ID (by
+# anyone, at any time) hit the ON DUPLICATE branch instead of inserting.
+DEPOSIT_INTAKE_QUERY = """
+    INSERT INTO transactions (external_transaction_id, user_id, player_id, transaction_type, payment_method, status)
+    SELECT %s, user_id, player_id, 'deposit', %s, 'pending' FROM accounts WHERE user_id = %s
+    ON DUPLICATE KEY UPDATE
+        duplicate_submissions = duplicate_submissions + 1,
+        transaction_id = LAST_INSERT_ID(transaction_id)
+"""
+
+
+def register_deposit(cursor, external_transaction_id, user_id, payment_method):
+    """Claim an external transaction ID as a pending deposit.
+
+    Returns DEPOSIT_NEW if this call created it, the existing row's status if
+    the ID was already submitted, or None if the user has no account.
+    """
+    cursor.execute(DEPOSIT_INTAKE_QUERY, (external_transaction_id, payment_method, user_id))
+    if cursor.rowcount == 1:
+        return DEPOSIT_NEW
+    if cursor.rowcount == 0:
+        return None  # SELECT found no account, nothing inserted
+
+    # rowcount 2: duplicate; LAST_INSERT_ID() points at the existing row
+    cursor.execute("SELECT status FROM transactions WHERE transaction_id = %s", (cursor.lastrowid,))
+    return cursor.fetchone()[0]
+
+
+async def submit_deposit(external_transaction_id, user_id, payment_method):
+    """register_deposit() on the DB executor, committed on return."""
+    return await transaction(register_deposit, external_transaction_id, user_id, payment_method)
@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+import threading
+from dataclasses import dataclass
+
+import wallets
+from database import fetch_one, execute
+
+
+# Once the slot-machine winnings since the last unlock reach this amount the game locks.
+# Unlock with `python game.py --unlock`, which also starts a new prize pool.
+PRIZE_POOL_LIMIT = int(os.getenv("PRIZE_POOL_LIMIT", "1000000"))
+# Other processes (admin, extra workers) may change game_settings; re-read after this many seconds.
+GAME_SETTINGS_TTL = float(os.getenv("GAME_SETTINGS_TTL", "30"))
+
+GAME_SETTINGS_QUERY = "SELECT prize_pool, game_locked FROM game_settings LIMIT 1"
+
+
+@dataclass(frozen=True)
+class GameSettings:
+    """Global slot-machine state: total prizes paid out and the lock flag."""
+
+    prize_pool: float = 0
+    game_locked: bool = False
+
+    @property
+    def locked(self):
+        return bool(self.game_locked)  # record_win sets it when the pool reaches the limit
+
+
+class GameSettingsCache:
+    """In-process copy of game_settings, replaced whenever this process changes it."""
+
+    def __init__(self, ttl=GAME_SETTINGS_TTL):
+        self.ttl = ttl
+        self._settings = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._settings is None or time.monotonic() - self._loaded_at >= self.ttl:
+                return None
+            return self._settings
+
+    def set(self, settings):
+        with self._lock:
+            self._settings = settings
+            self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        with self._lock:
+            self._settings = None
+
+
+game_settings_cache = GameSettingsCache()
+
+
+def _settings_from_row(row):
+    if not row:
+        return GameSettings()
+    return GameSettings(prize_pool=row[0] or 0, game_locked=bool(row[1]))
+
+
+async def get_game_settings():
+    """Return the cached GameSettings, reading the single game_settings row when stale."""
+    settings = game_settings_cache.get()
+    if settings is None:
+        settings = _settings_from_row(await fetch_one(GAME_SETTINGS_QUERY))
+        game_settings_cache.set(settings)
+    return settings
+
+
+def record_win(cursor, user_id, amount):
+    """Credit a win and grow the prize pool in the caller's transaction.
+
+    The game locks itself in the same statement that pushes the pool over
+    PRIZE_POOL_LIMIT. Returns the GameSettings as of this win; pass it to
+    game_settings_cache.set() once the transaction has committed.
+    """
+    wallets.credit(cursor, user_id, game_balance=amount, total_game_balance=amount)
+    # Assignments run left to right, so game_locked sees the new prize_pool.
+    cursor.execute(
+        "UPDATE game_settings SET prize_pool = prize_pool + %s, "
+        "game_locked = IF(prize_pool >= %s, 1, game_locked)",
+        (amount, PRIZE_POOL_LIMIT),
+    )
+    cursor.execute(GAME_SETTINGS_QUERY)
+    return _settings_from_row(cursor.fetchone())
+
+
+async def unlock_game():
+    """Clear game_locked and start a new prize pool; returns the new GameSettings."""
+    await execute("UPDATE game_settings SET game_locked = 0, prize_pool = 0")
+    settings = _settings_from_row(await fetch_one(GAME_SETTINGS_QUERY))
+    game_settings_cache.set(settings)  # Other processes pick it up within GAME_SETTINGS_TTL
+    return settings
+
+
+if __name__ == "__main__":
+    import asyncio
+    from database import init_db
+
+    if "--unlock" not in sys.argv:
+        sys.exit("usage: python game.py --unlock")
+    init_db()
+    print(asyncio.run(unlock_game()))
@@ -0,0 +1,355 @@
+"""Versioned schema migrations for the bot database.
+
+Each migration is (version, description, step) where step(cursor) applies it.
+Applied versions are recorded in `schema_migrations`; init_db() runs whatever
+is missing at startup. Run `python migrations.py` to migrate by hand or
+`python migrations.py --explain` to check that the hot queries use an index.
+"""
+import sys
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Serializes concurrent runs (bot.py and admin.py start against the same database).
+MIGRATION_LOCK = "telegram_bot_schema_migrations"
+MIGRATION_LOCK_TIMEOUT = 30
+
+# Parent ID of the single agent every account was created under before AGENT_ACCOUNTS
+# (agent_api.FIXED_PARENT_ID; not imported so migrations run without the agent API deps).
+LEGACY_PARENT_ID = "2301209"
+
+
+def _create_index(cursor, table, name, columns, unique=False):
+    """CREATE INDEX unless an index with that name already exists (DDL can't be rolled back)."""
+    cursor.execute(
+        "SELECT 1 FROM information_schema.statistics "
+        "WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s LIMIT 1",
+        (table, name),
+    )
+    if cursor.fetchone():
+        return
+    if unique:
+        _check_no_duplicates(cursor, table, columns)
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    cursor.execute(f"CREATE {kind} {name} ON {table} ({columns})")
+
+
+def _check_no_duplicates(cursor, table, columns):
+    """Refuse to add a unique index over existing duplicates, listing them for manual cleanup."""
+    not_null = " AND ".join(f"{column.strip()} IS NOT NULL" for column in columns.split(","))  # NULLs never collide
+    cursor.execute(f"SELECT {columns}, COUNT(*) FROM {table} WHERE {not_null} "
+                   f"GROUP BY {columns} HAVING COUNT(*) > 1 ORDER BY COUNT(*) DESC LIMIT 20")
+    duplicates = cursor.fetchall()
+    if duplicates:
+        listed = ", ".join(f"{row[:-1]} x{row[-1]}" for row in duplicates)
+        raise RuntimeError(f"Can't add a unique index on {table}({columns}): duplicate values {listed}. "
+                           f"Merge or remove those rows, then restart to apply the migration.")
+
+
+def _add_column(cursor, table, name, definition):
+    """ALTER TABLE ... ADD COLUMN unless the column already exists."""
+    cursor.execute(
+        "SELECT 1 FROM information_schema.columns "
+        "WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s LIMIT 1",
+        (table, name),
+    )
+    if cursor.fetchone():
+        return
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+
+def _create_base_tables(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS accounts (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            username VARCHAR(64) NOT NULL,
+            password VARCHAR(255) NOT NULL,
+            player_id VARCHAR(64)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS wallets (
+            user_id BIGINT PRIMARY KEY,
+            bot_balance DECIMAL(15, 2) NOT NULL DEFAULT 0,
+            game_balance DECIMAL(15, 2) NOT NULL DEFAULT 0,
+            website_balance DECIMAL(15, 2) NOT NULL DEFAULT 0,
+            total_game_balance DECIMAL(15, 2) NOT NULL DEFAULT 0,
+            game_points INT NOT NULL DEFAULT 0,
+            game_status TINYINT NOT NULL DEFAULT 1
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS transactions (
+            transaction_id INT AUTO_INCREMENT PRIMARY KEY,
+            external_transaction_id VARCHAR(64),
+            user_id BIGINT NOT NULL,
+            player_id VARCHAR(64),
+            amount DECIMAL(15, 2),
+            transaction_type VARCHAR(20) NOT NULL,
+            payment_method VARCHAR(32),
+            account_number VARCHAR(64),
+            fee DECIMAL(15, 2),
+            final_amount DECIMAL(15, 2),
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            verification_source VARCHAR(20),
+            timestamp DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sms_logs (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            transaction_id VARCHAR(64) NOT NULL,
+            amount DECIMAL(15, 2),
+            sender_phone VARCHAR(32),
+            received_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS admins (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            username VARCHAR(64) NOT NULL UNIQUE,
+            password VARCHAR(255) NOT NULL,
+            user_id BIGINT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS game_settings (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            game_locked TINYINT NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("INSERT INTO game_settings (id, game_locked) SELECT 1, 0 FROM DUAL "
+                   "WHERE NOT EXISTS (SELECT 1 FROM game_settings)")
+
+
+def _add_hot_query_indexes(cursor):
+    # Deposit/SMS lookups; withdrawals have no external ID and NULLs never collide.
+    _create_index(cursor, "transactions", "uq_transactions_external_id", "external_transaction_id", unique=True)
+    # "Last 5 transactions" (WHERE user_id ORDER BY timestamp DESC)
+    _create_index(cursor, "transactions", "idx_transactions_user_time", "user_id, timestamp")
+    # Admin approved-withdrawals list and status/type filtered reports
+    _create_index(cursor, "transactions", "idx_transactions_status_type_time", "status, transaction_type, timestamp")
+    _create_index(cursor, "sms_logs", "idx_sms_logs_transaction_id", "transaction_id")
+    _create_index(cursor, "accounts", "uq_accounts_user_id", "user_id", unique=True)
+    _create_index(cursor, "accounts", "uq_accounts_username", "username", unique=True)
+
+
+def _add_prize_pool_counter(cursor):
+    # Running total of all slot-machine winnings, so spins never SUM over wallets.
+    _add_column(cursor, "game_settings", "prize_pool", "DECIMAL(15, 2) NOT NULL DEFAULT 0")
+    cursor.execute("UPDATE game_settings SET prize_pool = "
+                   "(SELECT COALESCE(SUM(total_game_balance), 0) FROM wallets)")
+
+
+def _create_rollup_tables(cursor):
+    # Admin summaries read these by primary key; see rollups.py for what is counted.
+    for table in ("transaction_rollups_daily", "transaction_rollups_monthly"):
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                period DATE NOT NULL,
+                payment_method VARCHAR(32) NOT NULL,
+                transaction_type VARCHAR(20) NOT NULL,
+                tx_count INT NOT NULL DEFAULT 0,
+                amount_total DECIMAL(18, 2) NOT NULL DEFAULT 0,
+                fee_total DECIMAL(18, 2) NOT NULL DEFAULT 0,
+                final_amount_total DECIMAL(18, 2) NOT NULL DEFAULT 0,
+                completed_count INT NOT NULL DEFAULT 0,
+                completed_amount DECIMAL(18, 2) NOT NULL DEFAULT 0,
+                PRIMARY KEY (period, payment_method, transaction_type)
+            )
+        """)
+
+
+def _add_deposit_intake_counter(cursor):
+    # Bumped by the ON DUPLICATE KEY branch of deposits.DEPOSIT_INTAKE_QUERY.
+    _add_column(cursor, "transactions", "duplicate_submissions", "INT NOT NULL DEFAULT 0")
+
+
+def _index_accounts_player_id(cursor):
+    # The bulk website-balance sync joins its page of balances to accounts by player_id.
+    _create_index(cursor, "accounts", "idx_accounts_player_id", "player_id")
+
+
+def _create_website_transfers(cursor):
+    # Outbox of website deposits/withdrawals; see transfers.py for the status flow.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS website_transfers (
+            transfer_id INT AUTO_INCREMENT PRIMARY KEY,
+            idempotency_key VARCHAR(64) NOT NULL,
+            user_id BIGINT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            player_id VARCHAR(64) NOT NULL,
+            direction VARCHAR(10) NOT NULL,
+            amount DECIMAL(15, 2) NOT NULL,
+            game_used DECIMAL(15, 2) NOT NULL DEFAULT 0,
+            bot_used DECIMAL(15, 2) NOT NULL DEFAULT 0,
+            status VARCHAR(10) NOT NULL DEFAULT 'pending',
+            attempts INT NOT NULL DEFAULT 0,
+            error VARCHAR(255),
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            UNIQUE KEY uq_website_transfers_key (idempotency_key),
+            KEY idx_website_transfers_status (status, created_at)
+        )
+    """)
+
+
+def _backfill_account_parent_id(cursor):
+    # Accounts created before multiple agents all belong to the original one.
+    cursor.execute("UPDATE accounts SET parent_id = %s WHERE parent_id IS NULL", (LEGACY_PARENT_ID,))
+
+
+def _add_account_parent_id(cursor):
+    # Agent that owns the player; agent_api.AgentPool routes every call for the player by it.
+    _add_column(cursor, "accounts", "parent_id", "VARCHAR(64)")
+    _backfill_account_parent_id(cursor)
+
+
+def _create_bot_user_data(cursor):
+    # Conversation state (context.user_data) shared by all workers; see persistence.py.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bot_user_data (
+            user_id BIGINT PRIMARY KEY,
+            revision CHAR(16) NOT NULL,
+            data MEDIUMTEXT NOT NULL,
+            updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ) DEFAULT CHARSET = utf8mb4
+    """)
+
+
+def _require_parent_ids(cursor):
+    # Databases that ran migration 8 before it backfilled still have NULL owners.
+    _backfill_account_parent_id(cursor)
+    cursor.execute("ALTER TABLE accounts MODIFY parent_id VARCHAR(64) NOT NULL")
+    # Queued transfers carry their player's agent, so the outbox never has to look it up.
+    _add_column(cursor, "website_transfers", "parent_id", "VARCHAR(64)")
+    cursor.execute("""
+        UPDATE website_transfers t
+        LEFT JOIN accounts a ON a.player_id = t.player_id
+        SET t.parent_id = COALESCE(a.parent_id, %s)
+        WHERE t.parent_id IS NULL
+    """, (LEGACY_PARENT_ID,))
+    cursor.execute("ALTER TABLE website_transfers MODIFY parent_id VARCHAR(64) NOT NULL")
+
+
+def _add_transfer_leases(cursor):
+    # Which worker is sending a transfer, and since when; see transfers.TransferOutbox.recover.
+    _add_column(cursor, "website_transfers", "claimed_by", "VARCHAR(64)")
+    _add_column(cursor, "website_transfers", "claimed_at", "DATETIME")
+
+
+def _index_transfers_by_user(cursor):
+    # transfers._check_not_in_flight looks up a user's pending/sending transfers on every queueing.
+    _create_index(cursor, "website_transfers", "idx_website_transfers_user", "user_id, status")
+
+
+MIGRATIONS = [
+    (1, "create base tables", _create_base_tables),
+    (2, "indexes for hot queries", _add_hot_query_indexes),
+    (3, "slot machine prize pool counter", _add_prize_pool_counter),
+    (4, "daily and monthly financial rollups", _create_rollup_tables),
+    (5, "deposit intake duplicate counter", _add_deposit_intake_counter),
+    (6, "index accounts.player_id", _index_accounts_player_id),
+    (7, "website transfer outbox", _create_website_transfers),
+    (8, "owning agent of each account", _add_account_parent_id),
+    (9, "shared conversation state", _create_bot_user_data),
+    (10, "owning agent required on accounts and transfers", _require_parent_ids),
+    (11, "website transfer claim leases", _add_transfer_leases),
+    (12, "index in-flight transfers per user", _index_transfers_by_user),
+]
+
+
+# Representative hot queries and the index each one must be served by.
+HOT_QUERIES = [
+    ("SELECT status FROM transactions WHERE external_transaction_id = %s", ("x",)),
+    ("SELECT amount, transaction_type, payment_method, status, timestamp FROM transactions "
+     "WHERE user_id = %s ORDER BY timestamp DESC LIMIT 5", (0,)),
+    ("SELECT amount FROM sms_logs WHERE transaction_id = %s", ("x",)),
+    ("SELECT user_id, username, player_id, parent_id FROM accounts WHERE user_id = %s", (0,)),
+    ("SELECT username FROM accounts WHERE username = %s", ("x",)),
+    ("SELECT transaction_id FROM transactions WHERE status = 'approved' AND transaction_type = 'withdrawal' "
+     "ORDER BY timestamp DESC LIMIT 10", ()),
+    ("SELECT transfer_id FROM website_transfers WHERE status = 'pending' ORDER BY created_at", ()),
+    ("SELECT transfer_id FROM website_transfers WHERE user_id = %s AND status IN ('pending', 'sending') "
+     "AND idempotency_key <> %s LIMIT 1", (0, "x")),
+    ("SELECT revision, data FROM bot_user_data WHERE user_id = %s", (0,)),
+]
+
+
+def _applied_versions(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            description VARCHAR(255) NOT NULL,
+            applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def run_migrations(conn):
+    """Apply every pending migration in version order; returns the versions applied."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (MIGRATION_LOCK, MIGRATION_LOCK_TIMEOUT))
+        if cursor.fetchone()[0] != 1:
+            raise RuntimeError("Timed out waiting for the schema migration lock")
+        try:
+            applied = _applied_versions(cursor)
+            newly_applied = []
+            for version, description, step in MIGRATIONS:
+                if version in applied:
+                    continue
+                logger.info("Applying migration %s: %s", version, description)
+                step(cursor)
+                cursor.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                               (version, description))
+                conn.commit()
+                newly_applied.append(version)
+            return newly_applied
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK,))
+            cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+def explain_hot_queries(conn):
+    """EXPLAIN each hot query; returns [(sql, keys_used)] with keys_used None if any table is scanned."""
+    # Imported here: repository and deposits import database, which imports this module
+    from repository import USER_SNAPSHOT_QUERY
+    from deposits import DEPOSIT_INTAKE_QUERY
+
+    queries = HOT_QUERIES + [(USER_SNAPSHOT_QUERY, (0,)), (DEPOSIT_INTAKE_QUERY, ("x", "x", 0))]
+    cursor = conn.cursor(dictionary=True)
+    try:
+        report = []
+        for sql, params in queries:
+            cursor.execute("EXPLAIN " + sql, params or None)
+            # Every table read must use an index; the INSERT target row has no key to use
+            keys = [row.get("key") for row in cursor.fetchall() if row.get("select_type") != "INSERT"]
+            report.append((" ".join(sql.split()), ", ".join(keys) if keys and all(keys) else None))
+        return report
+    finally:
+        cursor.close()
+
+
+if __name__ == "__main__":
+    from database import init_db, connect_db
+
+    logging.basicConfig(level=logging.INFO)
+    init_db()  # ✅ Applies pending migrations
+
+    if "--explain" in sys.argv:
+        conn = connect_db()
+        try:
+            missing = 0
+            for sql, key in explain_hot_queries(conn):
+                print(f"{'✅' if key else '❌'} {key or 'FULL SCAN'}: {sql}")
+                missing += key is None
+        finally:
+            conn.close()
+        sys.exit(1 if missing else 0)
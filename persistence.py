@@ -0,0 +1,164 @@
+"""Persistence backend for python-telegram-bot that keeps context.user_data shared.
+
+The conversation flow state lives in context.user_data: the menu state,
+pending transaction IDs, withdrawal details, the menu history and the
+account creation steps. BotPersistence stores it through a
+state_store.UserStateStore, so any uvicorn worker on any host can handle a
+user's next update, and a restart doesn't lose a deposit in progress.
+Each write only replaces the revision the worker based it on, so concurrent
+updates for one user are merged rather than lost (see state_store.py).
+
+STATE_BACKEND selects where the state lives:
+- "mysql" (default): the bot_user_data table, shared by every host.
+- "sqlite": a file at STATE_SQLITE_PATH, shared by the workers of one host.
+
+Only user_data is persisted; chat_data, bot_data, callback data and
+conversations aren't used by the bot. bot.py flushes after every update.
+STATE_FLUSH_INTERVAL covers state changed outside an update, for example
+by a provisioning worker.
+"""
+import os
+import json
+from decimal import Decimal
+
+import mysql.connector
+from mysql.connector import errorcode
+from telegram import InlineKeyboardButton
+from telegram.ext import BasePersistence, PersistenceInput
+
+from database import fetch_one, execute, transaction
+from state_store import UserStateStore, SQLiteStateBackend
+
+
+STATE_BACKEND = os.getenv("STATE_BACKEND", "mysql")  # "mysql" or "sqlite"
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "5"))
+# Only the last menus are ever navigated back to; older ones are not stored
+HISTORY_LIMIT = 20
+
+# Telegram objects that may appear in user_data (the keyboards in "history")
+_TELEGRAM_TYPES = {"InlineKeyboardButton": InlineKeyboardButton}
+
+
+def _encode_value(value):
+    if isinstance(value, Decimal):
+        return {"__decimal__": str(value)}
+    if type(value).__name__ in _TELEGRAM_TYPES:
+        return {"__telegram__": type(value).__name__, "data": value.to_dict()}
+    raise TypeError(f"Can't store {type(value).__name__} in user_data")
+
+
+def _decode_value(obj):
+    if "__decimal__" in obj:
+        return Decimal(obj["__decimal__"])
+    if "__telegram__" in obj:
+        return _TELEGRAM_TYPES[obj["__telegram__"]].de_json(obj["data"], None)
+    return obj
+
+
+def encode_user_data(data):
+    """JSON for one user's user_data; equal state always encodes to the same text."""
+    if len(data.get("history") or ()) > HISTORY_LIMIT:
+        data = {**data, "history": data["history"][-HISTORY_LIMIT:]}
+    return json.dumps(data, default=_encode_value, sort_keys=True, ensure_ascii=False)
+
+
+def decode_user_data(encoded):
+    return json.loads(encoded, object_hook=_decode_value)
+
+
+def _write_user_data(cursor, rows):
+    """Write each row only over the revision it was based on; returns the user IDs whose revision moved on."""
+    conflicts = set()
+    for user_id, expected, revision, data in rows:
+        if expected is None:
+            try:
+                cursor.execute("INSERT INTO bot_user_data (user_id, revision, data) VALUES (%s, %s, %s)",
+                               (user_id, revision, data))
+            except mysql.connector.IntegrityError as err:
+                if err.errno != errorcode.ER_DUP_ENTRY:
+                    raise
+                conflicts.add(user_id)  # Another worker stored this user first
+        else:
+            cursor.execute("UPDATE bot_user_data SET revision = %s, data = %s WHERE user_id = %s AND revision = %s",
+                           (revision, data, user_id, expected))
+            if cursor.rowcount != 1:
+                conflicts.add(user_id)
+    return conflicts
+
+
+class MySQLStateBackend:
+    """User state in the bot_user_data table."""
+
+    async def load(self, user_id):
+        return await fetch_one("SELECT revision, data FROM bot_user_data WHERE user_id = %s", (user_id,))
+
+    async def save_many(self, rows):
+        return await transaction(_write_user_data, rows)  # ✅ One commit for the whole batch
+
+    async def delete(self, user_id):
+        await execute("DELETE FROM bot_user_data WHERE user_id = %s", (user_id,))
+
+
+class BotPersistence(BasePersistence):
+    """Stores user_data in a UserStateStore; refreshed before and saved after each update."""
+
+    def __init__(self, store, update_interval=STATE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = store
+
+    @classmethod
+    def from_env(cls):
+        backend = SQLiteStateBackend() if STATE_BACKEND == "sqlite" else MySQLStateBackend()
+        return cls(UserStateStore(backend, encode=encode_user_data, decode=decode_user_data))
+
+    async def get_user_data(self):
+        return {}  # ✅ Loaded per user by refresh_user_data, never all at startup
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self.store.refresh(user_id, user_data)
+
+    async def update_user_data(self, user_id, data):
+        await self.store.save(user_id, data)
+
+    async def drop_user_data(self, user_id):
+        await self.store.drop(user_id)
+
+    async def flush(self):
+        await self.store.flush()
+
+    # Not persisted (see PersistenceInput above)
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
@@ -0,0 +1,253 @@
+"""Background account provisioning.
+
+Creating an account means registering the player on the website, hashing the
+password and inserting the accounts + wallets rows. The chat handler only
+enqueues a ProvisioningJob; PROVISIONING_WORKERS workers run the jobs and
+call the job's `notify` coroutine with a ProvisioningResult when done. At
+most PROVISIONING_QUEUE_SIZE jobs wait, so a burst of sign-ups is throttled
+instead of opening unbounded agent API calls.
+
+Once the website player may exist, a failure never leads to registering the
+username again. Database errors are retried with the player ID in hand. If
+they persist, or the new player's ID can't be confirmed, the result carries
+`resume` (player ID if known, agent parent ID, password hash). The bot keeps
+it in user_data and hands it back in the next job, which looks the player up
+and saves it instead of creating another one.
+"""
+import os
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+
+import bcrypt
+import mysql.connector
+
+from agent_api import agent_pool, AgentAPIError, AgentServiceBusy, AgentOutcomeUnknown
+from database import transaction
+from repository import remember_account
+
+
+PROVISIONING_WORKERS = int(os.getenv("PROVISIONING_WORKERS", "4"))
+PROVISIONING_QUEUE_SIZE = int(os.getenv("PROVISIONING_QUEUE_SIZE", "100"))
+PROVISIONING_DB_ATTEMPTS = int(os.getenv("PROVISIONING_DB_ATTEMPTS", "3"))
+
+# ProvisioningResult.error values
+ERROR_BUSY = "busy"  # The agent API is unavailable; nothing was created
+ERROR_WEBSITE = "website"  # Registration was refused or the player couldn't be found
+ERROR_DATABASE = "database"  # The player exists on the website but the local rows were not written
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ProvisioningResult:
+    username: str
+    player_id: Optional[str] = None
+    error: Optional[str] = None
+    resume: Optional[dict] = None  # Set when a website player may exist without a local account
+
+
+@dataclass(frozen=True)
+class ProvisioningJob:
+    user_id: int
+    username: str
+    password: Optional[str]  # None when resuming: the player was registered with an earlier password
+    notify: Callable[[ProvisioningResult], Awaitable[None]]
+    resume: Optional[dict] = None  # ProvisioningResult.resume of the previous attempt
+
+
+def hash_password(password):
+    """Securely hash passwords."""
+    salt = bcrypt.gensalt()
+    return bcrypt.hashpw(password.encode(), salt).decode()
+
+
+def _registered_player_id(created):
+    """Player ID from a registerPlayer result, when the API includes one."""
+    if not isinstance(created, dict):
+        return None  # Unexpected shape: the player may still exist, so the caller searches for it
+    player = created.get("player") if isinstance(created.get("player"), dict) else created
+    player_id = player.get("playerId") or player.get("id")
+    return str(player_id) if player_id else None
+
+
+class RegistrationUnconfirmed(Exception):
+    """registerPlayer may have created the player, but it couldn't be found either."""
+
+
+async def create_player(agent, username, password):
+    """Register the player under `agent`; returns the player ID, or None if registration was refused.
+
+    Raises RegistrationUnconfirmed when the player may exist without its ID being known.
+    """
+    try:
+        created = await agent.register_player(username, password)
+    except AgentOutcomeUnknown as e:
+        # The player may exist now; the search below settles it
+        logger.warning("⚠️ Registration of %s unconfirmed, searching for it: %s", username, e)
+        created = {}
+    if created is None:
+        return None
+
+    player_id = _registered_player_id(created)
+    if player_id:
+        return player_id
+
+    # ✅ Only when the register response carries no ID: one extra search round trip.
+    # Registration didn't fail, so from here on the player may exist.
+    try:
+        player = await agent.find_player(username)
+    except AgentAPIError as e:
+        raise RegistrationUnconfirmed(f"Player {username} not found after registering: {e}") from e
+    if player and player.username == username:
+        return str(player.player_id)
+    raise RegistrationUnconfirmed(f"Player {username} not found after registering")
+
+
+def insert_account(cursor, user_id, username, hashed_password, player_id, parent_id):
+    """Insert the account and its empty wallet; run inside one transaction.
+
+    Does nothing if the account is already there, so a retry after a lost commit is safe.
+    """
+    cursor.execute("SELECT player_id FROM accounts WHERE user_id = %s", (user_id,))
+    row = cursor.fetchone()
+    if row and str(row[0]) == str(player_id):
+        return
+    cursor.execute(
+        "INSERT INTO accounts (player_id, parent_id, username, password, user_id) VALUES (%s, %s, %s, %s, %s)",
+        (player_id, parent_id, username, hashed_password, user_id)
+    )
+    cursor.execute("INSERT INTO wallets (user_id) VALUES (%s)", (user_id,))
+
+
+async def save_account(user_id, username, hashed_password, player_id, parent_id):
+    """Write the local account of a website player; returns a ProvisioningResult.
+
+    Database errors are retried. If they persist, the result carries `resume`, so the
+    next attempt saves this same player instead of registering another one.
+    """
+    resume = {"player_id": player_id, "parent_id": parent_id, "hashed_password": hashed_password}
+    for attempt in range(1, PROVISIONING_DB_ATTEMPTS + 1):
+        try:
+            await transaction(insert_account, user_id, username, hashed_password, player_id, parent_id)
+            break
+        except mysql.connector.IntegrityError as err:
+            # Username or Telegram user taken by another account: retrying can't fix it
+            logger.error("❌ MySQL Error (Creating account %s, player %s): %s", username, player_id, err)
+            return ProvisioningResult(username, player_id=player_id, error=ERROR_DATABASE)
+        except mysql.connector.Error as err:
+            logger.error("❌ MySQL Error (Creating account %s, player %s, attempt %s): %s",
+                         username, player_id, attempt, err)
+            if attempt == PROVISIONING_DB_ATTEMPTS:
+                return ProvisioningResult(username, player_id=player_id, error=ERROR_DATABASE, resume=resume)
+            await asyncio.sleep(attempt)
+
+    remember_account(user_id, username, player_id, parent_id)  # ✅ Only after the insert committed
+    return ProvisioningResult(username, player_id=player_id)
+
+
+async def resume_account(user_id, username, resume):
+    """Finish an attempt that may have left a website player without a local account."""
+    parent_id, player_id = resume["parent_id"], resume.get("player_id")
+    if not player_id:
+        # ✅ Look the player up instead of registering the username a second time
+        try:
+            player = await agent_pool.for_player(None, parent_id).find_player(username)
+        except AgentServiceBusy:
+            return ProvisioningResult(username, error=ERROR_BUSY, resume=resume)
+        except AgentAPIError as e:
+            logger.error("❌ Player lookup failed for %s: %s", username, e)
+            return ProvisioningResult(username, error=ERROR_WEBSITE, resume=resume)
+        if player is None or player.username != username:
+            return ProvisioningResult(username, error=ERROR_WEBSITE)  # Never created: start over
+        player_id = str(player.player_id)
+    return await save_account(user_id, username, resume["hashed_password"], player_id, parent_id)
+
+
+async def provision_account(user_id, username, password):
+    """Create the website player and the local account; returns a ProvisioningResult."""
+    # ✅ bcrypt runs on a thread while the website registers the player
+    hashing = asyncio.ensure_future(asyncio.to_thread(hash_password, password))
+    agent = agent_pool.for_registration()  # ✅ New players are spread across the configured agents
+    try:
+        player_id = await create_player(agent, username, password)
+    except AgentServiceBusy:
+        return ProvisioningResult(username, error=ERROR_BUSY)
+    except RegistrationUnconfirmed as e:
+        logger.error("❌ %s; the next attempt looks it up again", e)
+        hashed_password = await hashing
+        return ProvisioningResult(username, error=ERROR_WEBSITE, resume={
+            "player_id": None, "parent_id": agent.parent_id, "hashed_password": hashed_password})
+    except AgentAPIError as e:
+        logger.error("❌ Player registration failed for %s: %s", username, e)
+        return ProvisioningResult(username, error=ERROR_WEBSITE)
+    finally:
+        hashed_password = await hashing
+
+    if not player_id:
+        return ProvisioningResult(username, error=ERROR_WEBSITE)
+    return await save_account(user_id, username, hashed_password, player_id, agent.parent_id)
+
+
+class ProvisioningPool:
+    """Bounded queue of ProvisioningJobs served by a fixed number of workers."""
+
+    def __init__(self, workers=PROVISIONING_WORKERS, queue_size=PROVISIONING_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queue = None
+        self._tasks = []
+        self._stats = {"submitted": 0, "rejected": 0, "succeeded": 0, "failed": 0}
+
+    def start(self):
+        """Start the workers on the running event loop."""
+        if not self._tasks:
+            self._queue = asyncio.Queue(self.queue_size)
+            self._tasks = [asyncio.get_running_loop().create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, job):
+        """Queue a job; returns False (and runs nothing) when the queue is full."""
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self._stats["rejected"] += 1
+            return False
+        self._stats["submitted"] += 1
+        return True
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                try:
+                    if job.resume:
+                        result = await resume_account(job.user_id, job.username, job.resume)
+                    else:
+                        result = await provision_account(job.user_id, job.username, job.password)
+                except Exception as e:
+                    logger.error("❌ Provisioning job for user %s failed: %s", job.user_id, e)
+                    result = ProvisioningResult(job.username, error=ERROR_WEBSITE, resume=job.resume)
+                self._stats["failed" if result.error else "succeeded"] += 1
+                await job.notify(result)
+            except Exception as e:
+                logger.error("❌ Could not report provisioning result to user %s: %s", job.user_id, e)
+            finally:
+                self._queue.task_done()
+
+    async def stop(self):
+        """Finish the queued jobs, then stop the workers."""
+        if self._queue is not None:
+            await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["queued"] = self._queue.qsize() if self._queue is not None else 0
+        return stats
+
+
+provisioning_pool = ProvisioningPool()
@@ -0,0 +1,230 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from database import run_db, connect_db
+
+
+# Max number of account identities kept in memory. Entries are only added for committed
+# account rows (remember_account runs after the insert commits; lookups read through from
+# the DB), and neither bot updates player_id / username / parent_id afterwards.
+ACCOUNT_CACHE_SIZE = int(os.getenv("ACCOUNT_CACHE_SIZE", "10000"))
+
+logger = logging.getLogger(__name__)
+
+# One round trip for everything a screen needs to know about a user.
+USER_SNAPSHOT_QUERY = """
+    SELECT a.user_id, a.username, a.player_id, a.parent_id,
+           COALESCE(w.bot_balance, 0), COALESCE(w.game_balance, 0),
+           COALESCE(w.website_balance, 0), COALESCE(w.game_points, 0),
+           w.game_status
+    FROM accounts a
+    LEFT JOIN wallets w ON w.user_id = a.user_id
+    WHERE a.user_id = %s
+"""
+
+# Used instead of the JOIN when the account identity is already cached.
+WALLET_QUERY = """
+    SELECT COALESCE(bot_balance, 0), COALESCE(game_balance, 0),
+           COALESCE(website_balance, 0), COALESCE(game_points, 0),
+           game_status
+    FROM wallets
+    WHERE user_id = %s
+"""
+
+ACCOUNT_IDENTITY_QUERY = "SELECT user_id, username, player_id, parent_id FROM accounts WHERE user_id = %s"
+
+
+@dataclass(frozen=True)
+class AccountIdentity:
+    """The immutable part of an account: who the user is on the website, and under which agent."""
+
+    user_id: int
+    username: str
+    player_id: Optional[str]
+    parent_id: str
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """Account identity and wallet balances of one Telegram user."""
+
+    user_id: int
+    username: str
+    player_id: Optional[str]
+    parent_id: str
+    bot_balance: float = 0
+    game_balance: float = 0
+    website_balance: float = 0
+    game_points: int = 0
+    game_status: Optional[int] = None
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row)
+
+    @property
+    def identity(self):
+        return AccountIdentity(self.user_id, self.username, self.player_id, self.parent_id)
+
+
+class AccountIdentityCache:
+    """Bounded, thread-safe LRU cache of AccountIdentity keyed by Telegram user ID."""
+
+    def __init__(self, maxsize=ACCOUNT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, user_id):
+        with self._lock:
+            identity = self._entries.get(user_id)
+            if identity is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self._hits += 1
+            return identity
+
+    def put(self, identity):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[identity.user_id] = identity
+            self._entries.move_to_end(identity.user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+            }
+
+
+account_cache = AccountIdentityCache()
+
+
+def load_account_identity(cursor, user_id):
+    """Read-through lookup of a user's AccountIdentity with an open cursor."""
+    identity = account_cache.get(user_id)
+    if identity is not None:
+        return identity
+
+    cursor.execute(ACCOUNT_IDENTITY_QUERY, (user_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None  # Not cached: the account may be created at any moment
+    if isinstance(row, dict):
+        row = tuple(row.values())
+    identity = AccountIdentity(*row)
+    account_cache.put(identity)
+    return identity
+
+
+def load_user_snapshot(cursor, user_id):
+    """Load a UserSnapshot with an open cursor (for use inside a transaction)."""
+    identity = account_cache.get(user_id)
+
+    if identity is not None:
+        cursor.execute(WALLET_QUERY, (user_id,))
+        row = cursor.fetchone()
+        if isinstance(row, dict):
+            row = tuple(row.values())
+        return UserSnapshot(identity.user_id, identity.username, identity.player_id, identity.parent_id,
+                            *(row or ()))
+
+    cursor.execute(USER_SNAPSHOT_QUERY, (user_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    if isinstance(row, dict):
+        row = tuple(row.values())
+    snapshot = UserSnapshot.from_row(row)
+    account_cache.put(snapshot.identity)
+    return snapshot
+
+
+def _with_cursor(func, *args):
+    conn = connect_db()
+    cursor = conn.cursor()
+    try:
+        return func(cursor, *args)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def read_account_identity(user_id):
+    """Blocking variant of get_account_identity for code already on a worker thread."""
+    identity = account_cache.get(user_id)
+    if identity is not None:
+        return identity
+    return _with_cursor(load_account_identity, user_id)
+
+
+def read_user_snapshot(user_id):
+    """Blocking variant of get_user_snapshot for code already on a worker thread."""
+    return _with_cursor(load_user_snapshot, user_id)
+
+
+async def get_account_identity(user_id):
+    """Return the user's AccountIdentity, or None if they have no account yet."""
+    identity = account_cache.get(user_id)
+    if identity is not None:
+        return identity  # ✅ Served from memory, no executor hop
+    return await run_db(_with_cursor, load_account_identity, user_id)
+
+
+async def get_user_snapshot(user_id):
+    """Return the user's UserSnapshot, or None if they have no account yet."""
+    return await run_db(read_user_snapshot, user_id)
+
+
+def remember_account(user_id, username, player_id, parent_id):
+    """Record a freshly created account so the next lookup is a cache hit.
+
+    Call only after the accounts row has been committed.
+    """
+    account_cache.invalidate(user_id)
+    account_cache.put(AccountIdentity(user_id, username, player_id, parent_id))
+
+
+def _warm_account_cache(limit):
+    conn = connect_db()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT user_id, username, player_id, parent_id FROM accounts LIMIT %s", (limit,))
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.close()
+    for row in rows:
+        account_cache.put(AccountIdentity(*row))
+    return len(rows)
+
+
+async def warm_account_cache(limit=None):
+    """Preload account identities at startup; returns how many were loaded."""
+    limit = account_cache.maxsize if limit is None else limit
+    loaded = await run_db(_warm_account_cache, limit)
+    logger.info("✅ Account cache warmed with %s accounts", loaded)
+    return loaded
@@ -0,0 +1,261 @@
+"""Failure handling for calls to the agent API.
+
+- CircuitBreaker: after BREAKER_FAILURE_THRESHOLD consecutive failures the
+  breaker opens and calls fail fast with ServiceBusy for BREAKER_RECOVERY_TIMEOUT
+  seconds; then a single trial call decides whether it closes again.
+- retry_with_jitter: exponential backoff with full jitter, for idempotent
+  reads only. Deposits and withdrawals are never retried.
+- TrafficGovernor: token-bucket rate limits and in-flight caps per lane
+  (reads, money-moving writes) under one shared in-flight cap; waiting
+  writes get a freed shared slot before waiting reads.
+"""
+import os
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import logging
+from collections import Counter
+from contextlib import asynccontextmanager
+
+
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RECOVERY_TIMEOUT = float(os.getenv("BREAKER_RECOVERY_TIMEOUT", "30"))
+
+READ_RETRY_ATTEMPTS = int(os.getenv("READ_RETRY_ATTEMPTS", "3"))
+READ_RETRY_BASE_DELAY = float(os.getenv("READ_RETRY_BASE_DELAY", "0.2"))
+READ_RETRY_MAX_DELAY = float(os.getenv("READ_RETRY_MAX_DELAY", "2"))
+
+# Outbound agent API budgets; a rate of 0 means unlimited.
+AGENT_MAX_IN_FLIGHT = int(os.getenv("AGENT_MAX_IN_FLIGHT", "16"))
+AGENT_READ_RATE = float(os.getenv("AGENT_READ_RATE", "20"))
+AGENT_READ_BURST = int(os.getenv("AGENT_READ_BURST", "40"))
+AGENT_READ_MAX_IN_FLIGHT = int(os.getenv("AGENT_READ_MAX_IN_FLIGHT", "12"))
+AGENT_WRITE_RATE = float(os.getenv("AGENT_WRITE_RATE", "5"))
+AGENT_WRITE_BURST = int(os.getenv("AGENT_WRITE_BURST", "10"))
+AGENT_WRITE_MAX_IN_FLIGHT = int(os.getenv("AGENT_WRITE_MAX_IN_FLIGHT", "8"))
+# Reads are user-facing: give up (ServiceBusy) rather than queue longer than this.
+AGENT_READ_QUEUE_TIMEOUT = float(os.getenv("AGENT_READ_QUEUE_TIMEOUT", "5"))
+
+READ = "read"
+WRITE = "write"
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceBusy(Exception):
+    """Raised instead of calling a dependency whose circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with one trial call while half-open."""
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD,
+                 recovery_timeout=BREAKER_RECOVERY_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._transitions = Counter()
+        self._rejected = 0
+
+    def _move_to(self, state):
+        if state == self.state:
+            return
+        self._transitions[f"{self.state}->{state}"] += 1
+        logger.warning("⚠️ Circuit breaker %s: %s -> %s", self.name, self.state, state)
+        self.state = state
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+
+    def fail_fast(self):
+        """Raise ServiceBusy while the breaker is open, without claiming the half-open trial."""
+        if self.state == OPEN and time.monotonic() - self._opened_at < self.recovery_timeout:
+            self._rejected += 1
+            raise ServiceBusy(f"{self.name} is unavailable, try again later")
+
+    def before_call(self):
+        """Raise ServiceBusy unless a call may go through now."""
+        if self.state == OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+            self._move_to(HALF_OPEN)
+        if self.state == OPEN or (self.state == HALF_OPEN and self._trial_in_flight):
+            self._rejected += 1
+            raise ServiceBusy(f"{self.name} is unavailable, try again later")
+        if self.state == HALF_OPEN:
+            self._trial_in_flight = True
+
+    def record_success(self):
+        self._failures = 0
+        self._trial_in_flight = False
+        self._move_to(CLOSED)
+
+    def record_failure(self):
+        self._failures += 1
+        self._trial_in_flight = False
+        if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+            self._move_to(OPEN)
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self._failures,
+            "rejected": self._rejected,
+            "transitions": dict(self._transitions),
+        }
+
+
+async def retry_with_jitter(call, retry_on, attempts=READ_RETRY_ATTEMPTS, base_delay=READ_RETRY_BASE_DELAY,
+                            max_delay=READ_RETRY_MAX_DELAY, on_retry=None):
+    """Await call() up to `attempts` times, sleeping a random 0..backoff between tries.
+
+    Only use for idempotent requests.
+    """
+    for attempt in range(attempts):
+        try:
+            return await call()
+        except retry_on:
+            if attempt == attempts - 1:
+                raise
+            if on_retry is not None:
+                on_retry()
+            await asyncio.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, up to `burst` at once."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:  # First come, first served
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class PrioritySemaphore:
+    """Semaphore whose waiters are woken lowest priority value first (FIFO within a priority)."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self._waiters = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+
+    async def acquire(self, priority):
+        if self.in_use < self.limit and not self._waiters:
+            self.in_use += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._seq), future)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await future  # release() hands its slot over, in_use already counts us
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # Slot was handed to us just as we were cancelled
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_use -= 1
+
+    def waiting(self):
+        return len(self._waiters)
+
+
+class TrafficGovernor:
+    """Rate and concurrency budgets for one downstream service, per lane (READ or WRITE)."""
+
+    PRIORITY = {WRITE: 0, READ: 1}
+
+    def __init__(self, name, max_in_flight=AGENT_MAX_IN_FLIGHT,
+                 read_rate=AGENT_READ_RATE, read_burst=AGENT_READ_BURST, read_in_flight=AGENT_READ_MAX_IN_FLIGHT,
+                 write_rate=AGENT_WRITE_RATE, write_burst=AGENT_WRITE_BURST,
+                 write_in_flight=AGENT_WRITE_MAX_IN_FLIGHT, read_queue_timeout=AGENT_READ_QUEUE_TIMEOUT):
+        self.name = name
+        self._shared = PrioritySemaphore(max_in_flight)
+        self._lanes = {
+            READ: (asyncio.Semaphore(read_in_flight), TokenBucket(read_rate, read_burst)),
+            WRITE: (asyncio.Semaphore(write_in_flight), TokenBucket(write_rate, write_burst)),
+        }
+        self._queue_timeout = {READ: read_queue_timeout or None, WRITE: None}
+        self._stats = {lane: {"calls": 0, "rejected": 0, "waiting": 0, "in_flight": 0,
+                              "wait_total": 0.0, "wait_max": 0.0} for lane in self._lanes}
+
+    async def _acquire(self, lane):
+        semaphore, bucket = self._lanes[lane]
+        await semaphore.acquire()
+        try:
+            await bucket.acquire()
+            await self._shared.acquire(self.PRIORITY[lane])
+        except BaseException:
+            semaphore.release()
+            raise
+
+    @asynccontextmanager
+    async def slot(self, lane):
+        """Wait for the lane's budget, then hold one in-flight slot for the body.
+
+        Raises ServiceBusy if a read waits longer than the read queue timeout.
+        """
+        stats = self._stats[lane]
+        stats["waiting"] += 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._acquire(lane), self._queue_timeout[lane])
+        except asyncio.TimeoutError:
+            stats["rejected"] += 1
+            raise ServiceBusy(f"{self.name} {lane} queue is full, try again later") from None
+        finally:
+            waited = time.monotonic() - started
+            stats["waiting"] -= 1
+            stats["wait_total"] += waited
+            stats["wait_max"] = max(stats["wait_max"], waited)
+
+        stats["calls"] += 1
+        stats["in_flight"] += 1
+        try:
+            yield
+        finally:
+            stats["in_flight"] -= 1
+            self._shared.release()
+            self._lanes[lane][0].release()
+
+    def stats(self):
+        stats = {}
+        for lane, lane_stats in self._stats.items():
+            lane_stats = dict(lane_stats)
+            admitted = lane_stats["calls"] + lane_stats["rejected"]
+            lane_stats["wait_avg"] = lane_stats["wait_total"] / admitted if admitted else 0.0
+            stats[lane] = lane_stats
+        stats["shared_in_flight"] = self._shared.in_use
+        stats["shared_waiting"] = self._shared.waiting()
+        return stats
@@ -0,0 +1,202 @@
+"""Daily and monthly financial rollups for the admin summaries.
+
+Every row of `transaction_rollups_daily` / `transaction_rollups_monthly` holds
+running totals for one (period, payment_method, transaction_type). They are
+updated in the same transaction that creates, approves or completes a
+transaction, so a summary reads a handful of rows by primary key instead of
+scanning `transactions`. What counts:
+
+- withdrawals when they are recorded (they are created already approved)
+- deposits when they are approved (pending deposits are not money received)
+- completed_* when an admin marks a withdrawal as completed
+
+The summaries therefore differ from the queries they replaced. Those
+summed pending deposits (the amount a user typed, before any SMS matched
+it) too, and the overall summary only counted fees and payments of
+deposits. Now all three summaries (day, month, all time) count:
+- fees and payments: approved deposits and withdrawals
+- received: approved deposits
+The admin bot states this under each summary (SUMMARY_SCOPE_NOTE).
+
+Run `python rollups.py --backfill` once to rebuild both tables from history.
+`python rollups.py --check` compares both tables with the same totals
+computed from `transactions`. It also prints what the old queries would
+show for today, this month and all time.
+"""
+import sys
+import logging
+
+from database import fetch_one, connect_db
+
+
+ROLLUP_TABLES = {
+    "transaction_rollups_daily": "DATE(timestamp)",
+    "transaction_rollups_monthly": "DATE(timestamp) - INTERVAL (DAYOFMONTH(timestamp) - 1) DAY",
+}
+
+# Which transactions count, shared by the incremental updates and the backfill so both agree.
+COUNTED = ("(transaction_type = 'withdrawal' "
+           "OR (transaction_type = 'deposit' AND status IN ('approved', 'completed')))")
+COMPLETED = "(transaction_type = 'withdrawal' AND status = 'completed')"
+
+# Shown under every admin summary: what the totals include (see the module docstring).
+SUMMARY_SCOPE_NOTE = ("ℹ️ _الإيداعات المعتمدة فقط (لا تُحسب الطلبات المعلقة). "
+                      "الرسوم والمدفوعات تشمل الإيداعات المعتمدة والسحوبات._")
+
+_TOTAL_COLUMNS = "tx_count, amount_total, fee_total, final_amount_total, completed_count, completed_amount"
+
+_UPSERT_TOTALS = """
+    ON DUPLICATE KEY UPDATE
+        tx_count = tx_count + VALUES(tx_count),
+        amount_total = amount_total + VALUES(amount_total),
+        fee_total = fee_total + VALUES(fee_total),
+        final_amount_total = final_amount_total + VALUES(final_amount_total),
+        completed_count = completed_count + VALUES(completed_count),
+        completed_amount = completed_amount + VALUES(completed_amount)
+"""
+
+
+def _add_from_transaction(cursor, where, params, completed):
+    if completed:
+        totals = "0, 0, 0, 0, 1, COALESCE(final_amount, 0)"
+        counted = COMPLETED
+    else:
+        totals = "1, COALESCE(amount, 0), COALESCE(fee, 0), COALESCE(final_amount, 0), 0, 0"
+        counted = COUNTED
+    for table, period in ROLLUP_TABLES.items():
+        cursor.execute(
+            f"INSERT INTO {table} (period, payment_method, transaction_type, {_TOTAL_COLUMNS}) "
+            f"SELECT {period}, COALESCE(payment_method, ''), transaction_type, {totals} "
+            f"FROM transactions WHERE {where} AND {counted} " + _UPSERT_TOTALS,
+            params,
+        )
+
+
+def add_transaction(cursor, transaction_id):
+    """Count a recorded withdrawal or an approved deposit (by internal ID)."""
+    _add_from_transaction(cursor, "transaction_id = %s", (transaction_id,), completed=False)
+
+
+def add_approved_deposit(cursor, external_transaction_id):
+    """Count a deposit that has just been approved (by external transaction ID)."""
+    _add_from_transaction(cursor, "external_transaction_id = %s", (external_transaction_id,), completed=False)
+
+
+def add_completed(cursor, transaction_id):
+    """Count a withdrawal an admin has just marked as completed."""
+    _add_from_transaction(cursor, "transaction_id = %s", (transaction_id,), completed=True)
+
+
+def _summary_query(table, where):
+    return (
+        "SELECT COALESCE(SUM(fee_total), 0), COALESCE(SUM(final_amount_total), 0), "
+        "COALESCE(SUM(CASE WHEN transaction_type = 'deposit' THEN amount_total END), 0) "
+        f"FROM {table} {where}"
+    )
+
+
+async def daily_summary():
+    """(total_fees, total_payments, total_received) for today."""
+    return await fetch_one(_summary_query("transaction_rollups_daily", "WHERE period = CURDATE()"))
+
+
+async def monthly_summary():
+    """(total_fees, total_payments, total_received) for the current month."""
+    return await fetch_one(_summary_query(
+        "transaction_rollups_monthly",
+        "WHERE period = CURDATE() - INTERVAL (DAYOFMONTH(CURDATE()) - 1) DAY",
+    ))
+
+
+async def overall_summary():
+    """(total_fees, total_payments, total_received) over all time (one row per month and method)."""
+    return await fetch_one(_summary_query("transaction_rollups_monthly", ""))
+
+
+# The queries the rollups replaced, for --check: (label, where clause on transactions)
+_OLD_SUMMARIES = [
+    ("today", "DATE(timestamp) = CURDATE()"),
+    ("this month", "DATE_FORMAT(timestamp, '%Y-%m') = DATE_FORMAT(NOW(), '%Y-%m')"),
+]
+
+
+def _raw_totals_query(period):
+    return (
+        f"SELECT {period}, COALESCE(payment_method, ''), transaction_type, "
+        f"SUM({COUNTED}), "
+        f"COALESCE(SUM(CASE WHEN {COUNTED} THEN amount END), 0), "
+        f"COALESCE(SUM(CASE WHEN {COUNTED} THEN fee END), 0), "
+        f"COALESCE(SUM(CASE WHEN {COUNTED} THEN final_amount END), 0), "
+        f"SUM({COMPLETED}), "
+        f"COALESCE(SUM(CASE WHEN {COMPLETED} THEN final_amount END), 0) "
+        "FROM transactions GROUP BY 1, 2, 3"
+    )
+
+
+def _check():
+    """Compare every rollup row with the totals recomputed from transactions; returns the mismatches."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    try:
+        mismatches = []
+        for table, period in ROLLUP_TABLES.items():
+            cursor.execute(_raw_totals_query(period))
+            # Groups with nothing counted (e.g. only pending deposits) have no rollup row, or an all-zero one
+            raw = {tuple(row[:3]): tuple(row[3:]) for row in cursor.fetchall() if row[3] or row[7]}
+            cursor.execute(f"SELECT period, payment_method, transaction_type, {_TOTAL_COLUMNS} FROM {table}")
+            stored = {tuple(row[:3]): tuple(row[3:]) for row in cursor.fetchall() if row[3] or row[7]}
+            for key in sorted(raw.keys() | stored.keys(), key=str):
+                if raw.get(key) != stored.get(key):
+                    mismatches.append((table, key, raw.get(key), stored.get(key)))
+
+        for label, where in _OLD_SUMMARIES:
+            cursor.execute(f"SELECT COALESCE(SUM(fee), 0), COALESCE(SUM(final_amount), 0), "
+                           f"COALESCE(SUM(CASE WHEN transaction_type = 'deposit' THEN amount END), 0) "
+                           f"FROM transactions WHERE {where}")
+            print(f"old query, {label:10}: fees, payments, received = {cursor.fetchone()}")
+        cursor.execute("SELECT COALESCE(SUM(fee), 0), COALESCE(SUM(final_amount), 0), COALESCE(SUM(amount), 0) "
+                       "FROM transactions WHERE transaction_type = 'deposit'")
+        print(f"old query, {'all time':10}: fees, payments, received = {cursor.fetchone()}")
+        return mismatches
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def _backfill():
+    conn = connect_db()
+    cursor = conn.cursor()
+    try:
+        for table, period in ROLLUP_TABLES.items():
+            cursor.execute(f"DELETE FROM {table}")
+            cursor.execute(
+                f"INSERT INTO {table} (period, payment_method, transaction_type, {_TOTAL_COLUMNS}) "
+                + _raw_totals_query(period)
+            )
+        conn.commit()
+        cursor.execute("SELECT COUNT(*) FROM transaction_rollups_daily")
+        return cursor.fetchone()[0]
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    from database import init_db
+
+    if "--backfill" not in sys.argv and "--check" not in sys.argv:
+        sys.exit("usage: python rollups.py --backfill | --check")
+
+    logging.basicConfig(level=logging.INFO)
+    init_db()
+    if "--backfill" in sys.argv:
+        print(f"✅ Rollups rebuilt: {_backfill()} daily rows")
+    else:
+        mismatches = _check()
+        for table, key, raw, stored in mismatches:
+            print(f"❌ {table} {key}: transactions {raw}, rollup {stored}")
+        print("✅ Rollups match transactions" if not mismatches else f"❌ {len(mismatches)} rollup rows differ")
+        sys.exit(1 if mismatches else 0)
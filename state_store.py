@@ -0,0 +1,319 @@
+"""Shared storage for per-user conversation state (context.user_data).
+
+Each worker keeps its own copy of a user's state. UserStateStore keeps that
+copy consistent with a shared backend:
+- refresh() runs before a handler sees the state. It reloads the state
+  only when another worker wrote a newer revision.
+- save() encodes the state and does nothing if it is unchanged since the
+  last load or write (dirty tracking). Changed users that arrive while a
+  write is running are written together in the next single batch
+  (write coalescing).
+
+Each write stores a new random revision. A worker compares revisions to
+tell whether it still holds the latest state, without decoding it. Writes
+are conditional on the revision the worker last loaded or wrote, so two
+workers updating the same user at once can't silently overwrite each other.
+The loser of such a race reloads the stored state, re-applies the keys it
+changed on top (its own value wins where both changed a key) and tries
+again, up to STATE_CONFLICT_RETRIES times; its copy is reloaded by the next
+refresh().
+
+Backends implement load(user_id) -> (revision, data) | None,
+save_many([(user_id, expected_revision, revision, data)]) -> set of user IDs
+whose stored revision wasn't expected_revision (None: no row yet), and
+delete(user_id). The MySQL backend lives in persistence.py.
+SQLiteStateBackend here is a key-value file that the worker processes of a
+single host can share.
+
+`python state_store.py --multiprocess-check [workers] [users] [rounds]`
+sends each user's updates to random worker processes and verifies that
+every step sees the state the previous step left, with and without the
+shared store. It then sends each user two updates at once, to different
+workers, and verifies that neither is lost.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import secrets
+import sqlite3
+import logging
+import tempfile
+import contextlib
+import multiprocessing
+
+
+STATE_SQLITE_PATH = os.getenv("STATE_SQLITE_PATH", "bot_state.sqlite3")
+STATE_CONFLICT_RETRIES = int(os.getenv("STATE_CONFLICT_RETRIES", "3"))
+
+_MISSING = object()
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStateBackend:
+    """User state in a local SQLite file, shared by the worker processes of one host."""
+
+    def __init__(self, path=STATE_SQLITE_PATH):
+        self.path = path
+        with contextlib.closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")  # ✅ Readers don't wait for the writer
+            conn.execute("CREATE TABLE IF NOT EXISTS user_state "
+                         "(user_id INTEGER PRIMARY KEY, revision TEXT NOT NULL, data TEXT NOT NULL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _run(self, sql, params):
+        with contextlib.closing(self._connect()) as conn, conn:
+            return conn.execute(sql, params).fetchone()
+
+    def _write(self, rows):
+        conflicts = set()
+        with contextlib.closing(self._connect()) as conn, conn:  # One transaction for the batch
+            for user_id, expected, revision, data in rows:
+                if expected is None:
+                    cursor = conn.execute("INSERT INTO user_state (user_id, revision, data) VALUES (?, ?, ?) "
+                                          "ON CONFLICT(user_id) DO NOTHING", (user_id, revision, data))
+                else:
+                    cursor = conn.execute("UPDATE user_state SET revision = ?, data = ? "
+                                          "WHERE user_id = ? AND revision = ?", (revision, data, user_id, expected))
+                if cursor.rowcount != 1:
+                    conflicts.add(user_id)
+        return conflicts
+
+    async def load(self, user_id):
+        return await asyncio.to_thread(self._run, "SELECT revision, data FROM user_state WHERE user_id = ?",
+                                       (user_id,))
+
+    async def save_many(self, rows):
+        return await asyncio.to_thread(self._write, rows)
+
+    async def delete(self, user_id):
+        await asyncio.to_thread(self._run, "DELETE FROM user_state WHERE user_id = ?", (user_id,))
+
+
+class UserStateStore:
+    """Keeps workers' copies of user state in step with `backend`; see the module docstring."""
+
+    def __init__(self, backend, encode=None, decode=json.loads):
+        self.backend = backend
+        self.encode = encode or (lambda data: json.dumps(data, sort_keys=True, ensure_ascii=False))
+        self.decode = decode
+        self._revisions = {}  # user_id -> revision this worker last loaded or wrote
+        self._saved = {}  # user_id -> encoded state at that revision
+        self._pending = {}  # user_id -> encoded state waiting for the next write
+        self._merged = set()  # Users whose stored state has changes this worker's copy lacks
+        self._lock = asyncio.Lock()
+        self._stats = {"refreshes": 0, "reloads": 0, "unchanged": 0, "writes": 0, "batches": 0,
+                       "conflicts": 0}
+
+    async def refresh(self, user_id, data):
+        """Update `data` (this worker's copy, in place) if another worker stored a newer revision."""
+        self._stats["refreshes"] += 1
+        if user_id in self._pending:
+            return  # Our own state is newer than the stored one until it is written
+        row = await self.backend.load(user_id)
+        if row is None or (row[0] == self._revisions.get(user_id) and user_id not in self._merged):
+            return
+        revision, encoded = row
+        data.clear()
+        data.update(self.decode(encoded))
+        self._revisions[user_id] = revision
+        self._saved[user_id] = encoded
+        self._merged.discard(user_id)
+        self._stats["reloads"] += 1
+
+    async def save(self, user_id, data):
+        """Write the user's state unless it is unchanged."""
+        encoded = self.encode(data)  # Before any await: this is the snapshot being saved
+        if encoded == self._pending.get(user_id, self._saved.get(user_id)):
+            self._stats["unchanged"] += 1
+            return
+        self._pending[user_id] = encoded
+        await self.flush()
+
+    async def flush(self):
+        """Write every pending user in one batch; users another worker wrote meanwhile are merged and retried."""
+        async with self._lock:  # ✅ Whoever gets the lock writes what everyone queued meanwhile
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            for attempt in range(STATE_CONFLICT_RETRIES + 1):
+                rows = [(user_id, self._revisions.get(user_id), secrets.token_hex(8), encoded)
+                        for user_id, encoded in batch.items()]
+                try:
+                    conflicts = await self.backend.save_many(rows)
+                    for user_id, _, revision, encoded in rows:
+                        if user_id not in conflicts:
+                            self._revisions[user_id] = revision
+                            self._saved[user_id] = encoded
+                    self._stats["writes"] += len(rows) - len(conflicts)
+                    self._stats["batches"] += 1
+                    batch = {user_id: batch[user_id] for user_id in conflicts}
+                    if batch and attempt < STATE_CONFLICT_RETRIES:
+                        self._stats["conflicts"] += len(batch)
+                        batch = await self._rebase(batch)
+                except Exception:
+                    for user_id, encoded in batch.items():
+                        self._pending.setdefault(user_id, encoded)  # Retried by the next flush
+                    raise
+                if not batch:
+                    return
+            logger.warning("⚠️ State of users %s kept changing under us; retrying on the next flush", sorted(batch))
+            for user_id, encoded in batch.items():
+                self._pending.setdefault(user_id, encoded)
+
+    async def _rebase(self, batch):
+        """Re-apply each user's local changes onto the state another worker stored."""
+        stored = {user_id: await self.backend.load(user_id) for user_id in batch}  # Load all before changing anything
+        rebased = {}
+        for user_id, encoded in batch.items():
+            row = stored[user_id]
+            base = self.decode(self._saved[user_id]) if user_id in self._saved else {}
+            local = self.decode(encoded)
+            merged = self.decode(row[1]) if row else {}
+            for key in base.keys() | local.keys():
+                value = local.get(key, _MISSING)
+                if value == base.get(key, _MISSING):
+                    continue  # Unchanged here: keep the stored value
+                if value is _MISSING:
+                    merged.pop(key, None)
+                else:
+                    merged[key] = value
+            if row:
+                self._revisions[user_id], self._saved[user_id] = row
+            else:
+                self._revisions.pop(user_id, None)
+                self._saved.pop(user_id, None)
+            self._merged.add(user_id)  # ✅ This worker's copy reloads on the next refresh()
+            rebased[user_id] = self.encode(merged)
+        return rebased
+
+    async def drop(self, user_id):
+        self._pending.pop(user_id, None)
+        self._revisions.pop(user_id, None)
+        self._saved.pop(user_id, None)
+        self._merged.discard(user_id)
+        await self.backend.delete(user_id)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["pending"] = len(self._pending)
+        return stats
+
+
+def _check_worker(worker_id, path, shared, jobs, results):
+    async def run():
+        store = UserStateStore(SQLiteStateBackend(path))
+        user_data = {}  # This worker's copies, like Application.user_data
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            user_id, step, key = job
+            data = user_data.setdefault(user_id, {})
+            if shared:
+                await store.refresh(user_id, data)
+            if key is None:
+                seen = data.get("step", 0)
+                data["step"] = step
+                data.setdefault("history", []).append(worker_id)
+            else:
+                seen = None
+                data.setdefault(key, []).append(step)  # Concurrent updates each own a key
+            if shared:
+                await store.save(user_id, data)
+            results.put((user_id, step, seen))
+        results.put(("stats", worker_id, store.stats()))
+
+    asyncio.run(run())
+
+
+def _run_check(workers, shared, drive):
+    """Start the worker processes, let drive(queues, results, path) feed them, then collect their stats."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "state.sqlite3")
+        SQLiteStateBackend(path)
+        context = multiprocessing.get_context("spawn")
+        queues = [context.Queue() for _ in range(workers)]
+        results = context.Queue()
+        processes = [context.Process(target=_check_worker, args=(i, path, shared, queues[i], results))
+                     for i in range(workers)]
+        for process in processes:
+            process.start()
+
+        started = time.perf_counter()
+        outcome = drive(queues, results, path)
+        elapsed = time.perf_counter() - started
+
+        for jobs in queues:
+            jobs.put(None)
+        totals = {}
+        for _ in range(workers):
+            _, _, stats = results.get()
+            for key, value in stats.items():
+                totals[key] = totals.get(key, 0) + value
+        for process in processes:
+            process.join()
+    return outcome, elapsed, totals
+
+
+def _multiprocess_check(workers, users, rounds, shared):
+    def drive(queues, results, path):
+        stale = 0
+        for step in range(1, rounds + 1):
+            # Users in parallel; each user's next update waits for the previous one, on any worker
+            for user_id in range(users):
+                random.choice(queues).put((user_id, step, None))
+            for _ in range(users):
+                user_id, done, seen = results.get()
+                stale += seen != done - 1
+        return stale
+
+    stale, elapsed, totals = _run_check(workers, shared, drive)
+    label = "shared store" if shared else "in-memory only"
+    print(f"{label:15}: {workers} workers, {users} users x {rounds} steps, stale reads {stale:5}, "
+          f"{users * rounds / elapsed:6.0f} updates/s")
+    if shared:
+        print(f"{'':15}  {totals}")
+    return stale
+
+
+def _concurrent_check(workers, users, rounds):
+    def drive(queues, results, path):
+        for step in range(1, rounds + 1):
+            # Two updates per user at the same time, on two different workers
+            for user_id in range(users):
+                first, second = random.sample(queues, 2)
+                first.put((user_id, step, "a"))
+                second.put((user_id, step, "b"))
+            for _ in range(2 * users):
+                results.get()
+
+        lost = 0
+        expected = list(range(1, rounds + 1))
+        with contextlib.closing(sqlite3.connect(path)) as conn:
+            for user_id, encoded in conn.execute("SELECT user_id, data FROM user_state"):
+                data = json.loads(encoded)
+                lost += sum(len(set(expected) - set(data.get(key, []))) for key in ("a", "b"))
+        return lost
+
+    lost, elapsed, totals = _run_check(workers, True, drive)
+    print(f"{'concurrent':15}: {workers} workers, {users} users x {rounds} steps x 2, lost updates {lost:5}, "
+          f"{2 * users * rounds / elapsed:6.0f} updates/s")
+    print(f"{'':15}  {totals}")
+    return lost
+
+
+if __name__ == "__main__":
+    if "--multiprocess-check" not in sys.argv:
+        sys.exit("usage: python state_store.py --multiprocess-check [workers] [users] [rounds]")
+    args = [int(a) for a in sys.argv[sys.argv.index("--multiprocess-check") + 1:]]
+    workers, users, rounds = (args + [4, 50, 20][len(args):])[:3]
+    _multiprocess_check(workers, users, rounds, shared=False)
+    stale = _multiprocess_check(workers, users, rounds, shared=True)
+    lost = _concurrent_check(max(workers, 2), users, rounds)
+    sys.exit(1 if stale or lost else 0)
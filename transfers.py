@@ -0,0 +1,356 @@
+"""Durable outbox for website deposits and withdrawals.
+
+A handler records the transfer in `website_transfers` and returns; the
+TransferOutbox workers call the agent API and settle the result. Status flow:
+
+    pending -> sending -> succeeded | failed | unknown
+
+- submit_deposit() debits the bot wallet in the same transaction that inserts
+  the row, so the funds are reserved before anything is sent. A failed
+  deposit refunds exactly what was reserved.
+- A withdrawal credits the bot wallet only once it succeeded.
+- `failed` only when the website refused the transfer or the call was never
+  attempted (agent API busy, or no configured agent owns the player); `unknown` for every other error, since the
+  request may have executed (no response, an unreadable response, or the
+  process died while it was `sending`). Nothing is retried or refunded; an admin
+  settles it with `python transfers.py --resolve <id> succeeded|failed`.
+
+The idempotency key (derived from the Telegram message) is unique, so a
+redelivered update cannot queue the same transfer twice; it is also sent to
+the agent API as the transfer comment, for reconciliation. A user with a
+transfer still `pending` or `sending` can't queue another one
+(TransferInFlight). The check runs under the user's wallet row lock, so it
+holds across every worker and host.
+
+Every claim records the worker (TRANSFER_WORKER_ID, host:pid) and the time.
+On startup, recover() queues every `pending` row again and moves to `unknown`
+the `sending` rows whose worker is gone: claimed under this worker's ID (a
+previous process with the same pid on this host), or whose lease of
+TRANSFER_LEASE_SECONDS ran out. Rows another live worker is sending are left
+alone; a sweep every TRANSFER_LEASE_SECONDS catches leases that expire later.
+"""
+import os
+import sys
+import socket
+import asyncio
+import logging
+from dataclasses import dataclass
+from decimal import Decimal
+
+import mysql.connector
+from mysql.connector import errorcode
+
+import wallets
+from agent_api import agent_pool, AgentServiceBusy, AgentNotConfigured
+from balances import balance_cache
+from database import fetch_all, transaction
+
+
+TRANSFER_WORKERS = int(os.getenv("TRANSFER_WORKERS", "4"))
+# Identifies the process that claimed a transfer; a live process's pid is unique on its host.
+TRANSFER_WORKER_ID = os.getenv("TRANSFER_WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+# A `sending` row claimed longer ago than this belongs to a dead worker; keep it well above
+# AGENT_TRANSFER_DEADLINE, or a slow but live call would be sent to review.
+TRANSFER_LEASE_SECONDS = int(os.getenv("TRANSFER_LEASE_SECONDS", "300"))
+
+# Deposits of at least this much earn game points.
+GAME_POINTS_DEPOSIT_THRESHOLD = 100000
+GAME_POINTS_PER_DEPOSIT = 10
+
+DEPOSIT = "deposit"
+WITHDRAW = "withdraw"
+
+PENDING = "pending"
+SENDING = "sending"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+UNKNOWN = "unknown"
+
+# Transfer.error when the call was not attempted because the agent API is unavailable.
+ERROR_SERVICE_BUSY = "service_busy"
+
+TRANSFER_COLUMNS = ("transfer_id, idempotency_key, user_id, chat_id, player_id, parent_id, direction, "
+                    "amount, game_used, bot_used, status, error")
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Transfer:
+    transfer_id: int
+    idempotency_key: str
+    user_id: int
+    chat_id: int
+    player_id: str
+    parent_id: str  # Agent that owns the player (accounts.parent_id when queued)
+    direction: str
+    amount: Decimal
+    game_used: Decimal
+    bot_used: Decimal
+    status: str
+    error: str
+
+
+class InsufficientFunds(Exception):
+    """The bot wallet can't cover the deposit; nothing was queued."""
+
+
+class TransferInFlight(Exception):
+    """The user already has a transfer pending or sending; nothing was queued."""
+
+
+def _check_not_in_flight(cursor, key, user_id):
+    # ✅ Locking the wallet row serializes this user's transfers across workers until commit
+    cursor.execute("SELECT user_id FROM wallets WHERE user_id = %s FOR UPDATE", (user_id,))
+    cursor.fetchone()
+    cursor.execute("SELECT transfer_id FROM website_transfers WHERE user_id = %s AND status IN (%s, %s) "
+                   "AND idempotency_key <> %s LIMIT 1", (user_id, PENDING, SENDING, key))
+    if cursor.fetchone():
+        raise TransferInFlight(f"User {user_id} already has a transfer in flight")
+
+
+def _insert(cursor, key, user_id, chat_id, player_id, parent_id, direction, amount, game_used=0, bot_used=0):
+    try:
+        cursor.execute(
+            "INSERT INTO website_transfers "
+            "(idempotency_key, user_id, chat_id, player_id, parent_id, direction, amount, game_used, bot_used) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+            (key, user_id, chat_id, player_id, parent_id, direction, amount, game_used, bot_used),
+        )
+    except mysql.connector.IntegrityError as err:
+        if err.errno != errorcode.ER_DUP_ENTRY:
+            raise
+        return None  # Same key already queued
+    return cursor.lastrowid
+
+
+def queue_deposit(cursor, key, user_id, chat_id, player_id, parent_id, amount, game_used, bot_used):
+    """Insert a pending deposit and reserve its funds; None if the key was already used."""
+    _check_not_in_flight(cursor, key, user_id)
+    transfer_id = _insert(cursor, key, user_id, chat_id, player_id, parent_id, DEPOSIT, amount, game_used, bot_used)
+    if transfer_id is None:
+        return None
+    if not wallets.debit(cursor, user_id, game_balance=game_used, bot_balance=bot_used):
+        raise InsufficientFunds(f"User {user_id} can't cover {amount}")  # Rolls the insert back too
+    return transfer_id
+
+
+def queue_withdrawal(cursor, key, user_id, chat_id, player_id, parent_id, amount):
+    """Insert a pending withdrawal; None if the key was already used."""
+    _check_not_in_flight(cursor, key, user_id)
+    return _insert(cursor, key, user_id, chat_id, player_id, parent_id, WITHDRAW, amount)
+
+
+def _load(cursor, transfer_id):
+    cursor.execute(f"SELECT {TRANSFER_COLUMNS} FROM website_transfers WHERE transfer_id = %s", (transfer_id,))
+    row = cursor.fetchone()
+    return Transfer(*row) if row else None
+
+
+def _claim(cursor, transfer_id):
+    cursor.execute("UPDATE website_transfers SET status = %s, attempts = attempts + 1, "
+                   "claimed_by = %s, claimed_at = NOW() WHERE transfer_id = %s AND status = %s",
+                   (SENDING, TRANSFER_WORKER_ID, transfer_id, PENDING))
+    if cursor.rowcount != 1:
+        return None  # Already claimed (or settled) elsewhere
+    return _load(cursor, transfer_id)
+
+
+def settle(cursor, transfer_id, from_status, status, error=None):
+    """Move a transfer from from_status to status and apply its wallet effect; None if it wasn't in from_status."""
+    cursor.execute("UPDATE website_transfers SET status = %s, error = %s WHERE transfer_id = %s AND status = %s",
+                   (status, error[:255] if error else None, transfer_id, from_status))
+    if cursor.rowcount != 1:
+        return None
+    transfer = _load(cursor, transfer_id)
+
+    if transfer.direction == DEPOSIT:
+        if status == SUCCEEDED and transfer.amount >= GAME_POINTS_DEPOSIT_THRESHOLD:
+            wallets.credit(cursor, transfer.user_id, game_points=GAME_POINTS_PER_DEPOSIT)
+        elif status == FAILED:
+            # ✅ Give back exactly what was reserved
+            wallets.credit(cursor, transfer.user_id, game_balance=transfer.game_used, bot_balance=transfer.bot_used)
+    elif status == SUCCEEDED:
+        wallets.adjust(cursor, transfer.user_id, website_balance=-transfer.amount, bot_balance=transfer.amount)
+    return transfer
+
+
+async def submit_deposit(key, user_id, chat_id, player_id, parent_id, amount, game_used, bot_used):
+    """Queue a website deposit paid from game_used + bot_used; returns the transfer ID, or None for a duplicate.
+
+    Raises InsufficientFunds if the wallet no longer covers it, and TransferInFlight if the user
+    already has a transfer pending or sending.
+    """
+    transfer_id = await transaction(queue_deposit, key, user_id, chat_id, player_id, parent_id, amount,
+                                    game_used, bot_used)
+    if transfer_id is not None:
+        outbox.submit(transfer_id)
+    return transfer_id
+
+
+async def submit_withdrawal(key, user_id, chat_id, player_id, parent_id, amount):
+    """Queue a website withdrawal into the bot wallet; returns the transfer ID, or None for a duplicate.
+
+    Raises TransferInFlight if the user already has a transfer pending or sending.
+    """
+    transfer_id = await transaction(queue_withdrawal, key, user_id, chat_id, player_id, parent_id, amount)
+    if transfer_id is not None:
+        outbox.submit(transfer_id)
+    return transfer_id
+
+
+async def resolve(transfer_id, succeeded):
+    """Settle an `unknown` transfer after checking it on the website; returns the Transfer or None."""
+    return await transaction(settle, transfer_id, UNKNOWN, SUCCEEDED if succeeded else FAILED,
+                             "resolved by admin")
+
+
+class TransferOutbox:
+    """Worker pool executing queued website transfers."""
+
+    def __init__(self, workers=TRANSFER_WORKERS):
+        self.workers = workers
+        self._queue = None
+        self._tasks = []
+        self._notify = None
+        self._stats = {"succeeded": 0, "failed": 0, "unknown": 0, "recovered": 0}
+
+    async def start(self, notify):
+        """Start the workers, then recover() leftovers; notify(transfer) is awaited after each settlement."""
+        self._notify = notify
+        if not self._tasks:
+            self._queue = asyncio.Queue()
+            loop = asyncio.get_running_loop()
+            self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+            self._tasks.append(loop.create_task(self._sweep()))
+        await self.recover()
+
+    def submit(self, transfer_id):
+        self._queue.put_nowait(transfer_id)
+
+    async def _interrupted(self, include_own):
+        """Move `sending` rows whose worker is gone to `unknown`; returns how many."""
+        # claimed_at IS NULL: claimed before leases were recorded
+        sql = ("SELECT transfer_id FROM website_transfers WHERE status = %s AND (claimed_at IS NULL "
+               "OR claimed_at < NOW() - INTERVAL %s SECOND")
+        params = [SENDING, TRANSFER_LEASE_SECONDS]
+        if include_own:
+            sql += " OR claimed_by = %s"  # Only at startup: this process has nothing in flight yet
+            params.append(TRANSFER_WORKER_ID)
+        moved = 0
+        for (transfer_id,) in await fetch_all(sql + ")", params):
+            transfer = await transaction(settle, transfer_id, SENDING, UNKNOWN, "worker stopped while sending")
+            if transfer is not None:
+                logger.error("❌ Transfer %s was in flight when its worker stopped; needs review", transfer_id)
+                self._stats["unknown"] += 1
+                moved += 1
+                await self._report(transfer)
+        return moved
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(TRANSFER_LEASE_SECONDS)
+            try:
+                await self._interrupted(include_own=False)
+            except Exception as e:
+                logger.error("❌ Transfer lease sweep failed: %s", e)
+
+    async def recover(self):
+        """Queue `pending` rows again; `sending` rows whose worker is gone become `unknown`."""
+        interrupted = await self._interrupted(include_own=True)
+
+        pending = await fetch_all("SELECT transfer_id FROM website_transfers WHERE status = %s "
+                                  "ORDER BY created_at", (PENDING,))
+        for (transfer_id,) in pending:
+            self.submit(transfer_id)
+        self._stats["recovered"] += len(pending)
+        if interrupted or pending:
+            logger.info("✅ Transfer recovery: %s resumed, %s sent to review", len(pending), interrupted)
+
+    async def _worker(self):
+        while True:
+            transfer_id = await self._queue.get()
+            try:
+                await self._process(transfer_id)
+            except Exception as e:
+                # Left `pending` or `sending`; the next recover() picks it up
+                logger.error("❌ Transfer %s failed unexpectedly: %s", transfer_id, e)
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, transfer_id):
+        transfer = await transaction(_claim, transfer_id)
+        if transfer is None:
+            return
+
+        call = agent_pool.deposit if transfer.direction == DEPOSIT else agent_pool.withdraw
+        status, error = SUCCEEDED, None
+        try:
+            # Amounts are whole SYP; DECIMAL comes back as Decimal, which JSON can't encode
+            result = await call(transfer.player_id, transfer.parent_id, int(transfer.amount),
+                                comment=transfer.idempotency_key)
+            if not result.success:
+                status, error = FAILED, result.error
+        except AgentServiceBusy:
+            status, error = FAILED, ERROR_SERVICE_BUSY  # Refused before anything was sent
+        except AgentNotConfigured as e:
+            status, error = FAILED, str(e)  # No agent to send it to
+        except Exception as e:
+            # ✅ Anything else may have reached the website (even a 200 with a body we couldn't read):
+            # refunding now could pay twice, so an admin checks it
+            logger.error("❌ Transfer %s outcome unknown: %s", transfer_id, e)
+            status, error = UNKNOWN, str(e)
+        finally:
+            balance_cache.invalidate(transfer.player_id)  # ✅ Website balance changed (or may have)
+
+        settled = await transaction(settle, transfer_id, SENDING, status, error)
+        if settled is not None:
+            self._stats[status] += 1
+            await self._report(settled)
+
+    async def _report(self, transfer):
+        if self._notify is None:
+            return
+        try:
+            await self._notify(transfer)
+        except Exception as e:
+            logger.error("❌ Could not notify user %s about transfer %s: %s",
+                         transfer.user_id, transfer.transfer_id, e)
+
+    async def stop(self):
+        """Finish the queued transfers, then stop the workers."""
+        if self._queue is not None:
+            await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["queued"] = self._queue.qsize() if self._queue is not None else 0
+        return stats
+
+
+outbox = TransferOutbox()
+
+
+async def _cli(args):
+    if args[:1] == ["--resolve"] and len(args) == 3 and args[2] in (SUCCEEDED, FAILED):
+        transfer = await resolve(int(args[1]), args[2] == SUCCEEDED)
+        print(transfer or f"Transfer {args[1]} is not awaiting review")
+    elif args[:1] == ["--list-unknown"]:
+        rows = await fetch_all(f"SELECT {TRANSFER_COLUMNS} FROM website_transfers WHERE status = %s "
+                               "ORDER BY created_at", (UNKNOWN,))
+        for row in rows:
+            print(Transfer(*row))
+    else:
+        sys.exit("usage: python transfers.py --list-unknown | --resolve <transfer_id> succeeded|failed")
+
+
+if __name__ == "__main__":
+    from database import init_db
+
+    logging.basicConfig(level=logging.INFO)
+    init_db()
+    asyncio.run(_cli(sys.argv[1:]))
@@ -0,0 +1,167 @@
+"""Bounded, per-chat ordered scheduling of webhook updates.
+
+The webhook validates an update, enqueues it and answers Telegram at once.
+Each chat gets a lane: its updates run strictly one after another, in the
+order they arrived, while lanes of different chats run concurrently, at
+most UPDATE_WORKERS updates at a time. A slow deposit therefore only delays
+later updates from the same chat, never another user's menu click.
+
+When UPDATE_QUEUE_SIZE updates are already waiting:
+- low-priority updates (anything that isn't a message or a button press,
+  e.g. edits or chat member changes) are dropped and still acknowledged;
+- everything else is refused, and the webhook answers 503 so Telegram
+  redelivers it later.
+
+`python update_queue.py --stress [chats] [updates_per_chat]` checks the
+ordering guarantee and compares throughput with one-at-a-time processing.
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from types import SimpleNamespace
+
+
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+
+# enqueue() outcomes
+QUEUED = "queued"
+SHED = "shed"
+REJECTED = "rejected"
+
+logger = logging.getLogger(__name__)
+
+
+def is_low_priority(update):
+    """True for updates a user is not waiting on."""
+    return update.message is None and update.callback_query is None
+
+
+def lane_key(update):
+    """Updates with the same key are processed in order: the chat, else the user, else nothing shared."""
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return ("user", update.effective_user.id)
+    return ("update", update.update_id)
+
+
+class UpdateQueue:
+    """Runs `process(update)` for queued updates: in order per chat, concurrently across chats."""
+
+    def __init__(self, process, workers=UPDATE_WORKERS, max_size=UPDATE_QUEUE_SIZE):
+        self.process = process
+        self.workers = workers
+        self.max_size = max_size
+        self._slots = None
+        self._lanes = {}  # lane key -> deque of (queued_at, update)
+        self._running = {}  # lane key -> asyncio.Task draining that lane
+        self._pending = 0
+        self._started = False
+        self._stats = {"queued": 0, "processed": 0, "failed": 0, "shed": 0, "rejected": 0,
+                       "age_total": 0.0, "age_max": 0.0, "age_last": 0.0}
+
+    def enqueue(self, update):
+        """Queue an update; returns QUEUED, SHED (dropped, low priority) or REJECTED (queue full)."""
+        if self._pending >= self.max_size:
+            if is_low_priority(update):
+                self._stats["shed"] += 1
+                return SHED
+            self._stats["rejected"] += 1
+            return REJECTED
+
+        key = lane_key(update)
+        self._lanes.setdefault(key, deque()).append((time.monotonic(), update))
+        self._pending += 1
+        self._stats["queued"] += 1
+        if self._started and key not in self._running:
+            self._start_lane(key)
+        return QUEUED
+
+    def start(self):
+        """Start processing on the running event loop (updates queued before now included)."""
+        if not self._started:
+            self._slots = asyncio.Semaphore(self.workers)
+            self._started = True
+            for key in list(self._lanes):
+                self._start_lane(key)
+
+    def _start_lane(self, key):
+        self._running[key] = asyncio.get_running_loop().create_task(self._drain(key))
+
+    async def _drain(self, key):
+        lane = self._lanes[key]
+        try:
+            while lane:
+                queued_at, update = lane.popleft()
+                async with self._slots:  # ✅ Bounded global concurrency; taken per update, not per lane
+                    age = time.monotonic() - queued_at
+                    self._stats["age_last"] = age
+                    self._stats["age_total"] += age
+                    self._stats["age_max"] = max(self._stats["age_max"], age)
+                    try:
+                        await self.process(update)
+                        self._stats["processed"] += 1
+                    except Exception as e:
+                        self._stats["failed"] += 1
+                        logger.error("❌ Error processing update %s: %s", update.update_id, e)
+                    finally:
+                        self._pending -= 1
+        finally:
+            # Nothing is awaited between the empty check and here, so no update can be stranded
+            del self._lanes[key]
+            del self._running[key]
+
+    async def stop(self):
+        """Process what is already queued, then return."""
+        while self._running:
+            await asyncio.gather(*list(self._running.values()), return_exceptions=True)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["depth"] = self._pending
+        stats["active_lanes"] = len(self._running)
+        done = stats["processed"] + stats["failed"]
+        stats["age_avg"] = stats["age_total"] / done if done else 0.0
+        return stats
+
+
+def _fake_update(update_id, chat_id):
+    chat = SimpleNamespace(id=chat_id)
+    return SimpleNamespace(update_id=update_id, message=SimpleNamespace(chat=chat), callback_query=None,
+                           effective_chat=chat, effective_user=SimpleNamespace(id=chat_id))
+
+
+async def _stress(chats, per_chat, workers):
+    seen = {}
+
+    async def process(update):
+        await asyncio.sleep(random.uniform(0.001, 0.01))  # Handler doing I/O
+        seen.setdefault(update.effective_chat.id, []).append(update.update_id)
+
+    queue = UpdateQueue(process, workers=workers, max_size=chats * per_chat)
+    queue.start()
+    updates = [_fake_update(i, i % chats) for i in range(chats * per_chat)]  # Chats interleaved
+    started = time.perf_counter()
+    for update in updates:
+        queue.enqueue(update)
+    await queue.stop()
+    elapsed = time.perf_counter() - started
+
+    ordered = all(ids == sorted(ids) and len(ids) == per_chat for ids in seen.values())
+    print(f"workers {workers:3}: {len(updates) / elapsed:8.0f} updates/s  "
+          f"per-chat order {'OK' if ordered else 'VIOLATED'}  max queue age {queue.stats()['age_max']:.3f}s")
+    return ordered
+
+
+if __name__ == "__main__":
+    if "--stress" not in sys.argv:
+        sys.exit("usage: python update_queue.py --stress [chats] [updates_per_chat]")
+    args = [int(a) for a in sys.argv[sys.argv.index("--stress") + 1:]]
+    chats, per_chat = (args + [200, 20][len(args):])[:2]
+    results = [asyncio.run(_stress(chats, per_chat, workers)) for workers in (1, UPDATE_WORKERS)]
+    sys.exit(0 if all(results) else 1)
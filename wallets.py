@@ -0,0 +1,66 @@
+"""Wallet mutations as single conditional UPDATE statements.
+
+Balances are never read into Python and written back: every change is one
+`UPDATE wallets SET col = col + delta ... WHERE user_id = %s [AND col >= x]`
+and success is decided by the affected-row count. That makes concurrent
+requests from the same user safe without SELECT ... FOR UPDATE, and a
+debit costs one round trip.
+
+The cursor functions run inside the caller's transaction; the async
+wrappers run them in a transaction of their own.
+"""
+from database import transaction
+
+
+WALLET_COLUMNS = ("bot_balance", "game_balance", "website_balance", "total_game_balance", "game_points")
+
+
+def _update(cursor, user_id, deltas, guarded):
+    deltas = {column: delta for column, delta in deltas.items() if delta}
+    for column in deltas:
+        if column not in WALLET_COLUMNS:
+            raise ValueError(f"Unknown wallet column: {column}")
+    if not deltas:
+        return True  # Nothing to change (MySQL would report 0 affected rows)
+
+    assignments = ", ".join(f"{column} = {column} + %s" for column in deltas)
+    params = list(deltas.values()) + [user_id]
+    where = "user_id = %s"
+    if guarded:
+        for column, delta in deltas.items():
+            if delta < 0:
+                where += f" AND {column} >= %s"
+                params.append(-delta)
+
+    cursor.execute(f"UPDATE wallets SET {assignments} WHERE {where}", params)
+    return cursor.rowcount == 1
+
+
+def debit(cursor, user_id, **amounts):
+    """Subtract each amount only if every balance covers it; False if any does not (or no wallet)."""
+    return _update(cursor, user_id, {column: -amount for column, amount in amounts.items()}, guarded=True)
+
+
+def credit(cursor, user_id, **amounts):
+    """Add each amount to the user's wallet; False if the user has no wallet."""
+    return _update(cursor, user_id, amounts, guarded=False)
+
+
+def adjust(cursor, user_id, **deltas):
+    """Apply signed deltas without a funds check (e.g. mirroring a website transfer)."""
+    return _update(cursor, user_id, deltas, guarded=False)
+
+
+async def debit_wallet(user_id, **amounts):
+    """debit() in its own transaction."""
+    return await transaction(debit, user_id, **amounts)
+
+
+async def credit_wallet(user_id, **amounts):
+    """credit() in its own transaction."""
+    return await transaction(credit, user_id, **amounts)
+
+
+async def adjust_wallet(user_id, **deltas):
+    """adjust() in its own transaction."""
+    return await transaction(adjust, user_id, **deltas)